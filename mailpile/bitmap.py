@@ -0,0 +1,321 @@
+#
+# Compressed bitmaps for representing sets of message index positions.
+#
+# This is a pure-Python take on "roaring" bitmaps: the 32-bit key space is
+# split into chunks of 65536 values, each of which is stored either as a
+# sorted array of 16-bit integers (when sparse) or as a Python long used
+# as a bit set (when dense), so the set algebra happens in C either way.
+#
+# If the pyroaring module is available, we use that instead.
+#
+import binascii
+from array import array
+from bisect import bisect_left
+
+try:
+    from pyroaring import BitMap as RoaringBitMap
+except ImportError:
+    RoaringBitMap = None
+
+
+CHUNK_BITS = 16
+CHUNK_SIZE = 1 << CHUNK_BITS
+CHUNK_MASK = CHUNK_SIZE - 1
+ARRAY_MAX = 4096
+FULL_CHUNK = (1 << CHUNK_SIZE) - 1
+
+_BYTE_BITS = [tuple(b for b in range(0, 8) if (n >> b) & 1)
+              for n in range(0, 256)]
+
+
+def _to_bits(c):
+    if not isinstance(c, array):
+        return c
+    data = bytearray(CHUNK_SIZE // 8)
+    for v in c:
+        data[v >> 3] |= (1 << (v & 7))
+    data.reverse()
+    return int(binascii.hexlify(data), 16)
+
+
+def _to_array(c):
+    if isinstance(c, array):
+        return c
+    values = array('H')
+    hexed = '%x' % c
+    data = bytearray(binascii.unhexlify('0' * (len(hexed) % 2) + hexed))
+    data.reverse()
+    for i, byte in enumerate(data):
+        if byte:
+            base = i << 3
+            for b in _BYTE_BITS[byte]:
+                values.append(base + b)
+    return values
+
+
+def _count(c):
+    if isinstance(c, array):
+        return len(c)
+    return bin(c).count('1')
+
+
+def _copy(c):
+    # Array chunks are mutated in place by add() and discard()
+    return array('H', c) if isinstance(c, array) else c
+
+
+def _normalize(c):
+    """Pick the most compact representation, None if empty."""
+    if isinstance(c, array):
+        if len(c) > ARRAY_MAX:
+            return _to_bits(c)
+        return c if c else None
+    if not c:
+        return None
+    if _count(c) <= ARRAY_MAX:
+        return _to_array(c)
+    return c
+
+
+def _and(a, b):
+    if isinstance(a, array) and isinstance(b, array):
+        return _normalize(array('H', sorted(set(a) & set(b))))
+    return _normalize(_to_bits(a) & _to_bits(b))
+
+
+def _or(a, b):
+    if isinstance(a, array) and isinstance(b, array):
+        return _normalize(array('H', sorted(set(a) | set(b))))
+    return _normalize(_to_bits(a) | _to_bits(b))
+
+
+def _sub(a, b):
+    if isinstance(a, array) and isinstance(b, array):
+        return _normalize(array('H', sorted(set(a) - set(b))))
+    return _normalize(_to_bits(a) & (FULL_CHUNK ^ _to_bits(b)))
+
+
+class PyBitmap(object):
+    """
+    A compressed set of non-negative integers.
+
+    >>> a = PyBitmap([1, 2, 3, 70000])
+    >>> b = PyBitmap(xrange(2, 100000))
+    >>> (len(a), len(b), 70000 in a, 1 in b)
+    (4, 99998, True, False)
+    >>> list(PyBitmap.Load(a.dump())), PyBitmap.Load(b.dump()) == b
+    ([1, 2, 3, 70000], True)
+    >>> list(a & b)
+    [2, 3, 70000]
+    >>> len(a | b), list(a - b)
+    (99999, [1])
+    >>> b -= PyBitmap(xrange(10, 100000))
+    >>> list(b)
+    [2, 3, 4, 5, 6, 7, 8, 9]
+    >>> b.add(1); b.add(5); b.discard(9); b.discard(10)
+    >>> list(b)
+    [1, 2, 3, 4, 5, 6, 7, 8]
+    >>> b.difference_update([2, 4]); b.update([20])
+    >>> list(b)
+    [1, 3, 5, 6, 7, 8, 20]
+    """
+    def __init__(self, values=None):
+        self._chunks = {}
+        if values:
+            self.update(values)
+
+    @classmethod
+    def Range(cls, count):
+        """Create a bitmap containing all integers below count."""
+        bm = cls()
+        full, rest = divmod(count, CHUNK_SIZE)
+        for hi in xrange(0, full):
+            bm._chunks[hi] = FULL_CHUNK
+        if rest:
+            bm._chunks[full] = _normalize((1 << rest) - 1)
+        return bm
+
+    def copy(self):
+        bm = PyBitmap()
+        bm._chunks = dict((hi, _copy(c)) for hi, c in self._chunks.iteritems())
+        return bm
+
+    def dump(self):
+        """Return a representation of the bitmap which marshal can save."""
+        return ('chunks', [(hi, c.tostring() if isinstance(c, array) else c)
+                           for hi, c in self._chunks.iteritems()])
+
+    @classmethod
+    def Load(cls, data):
+        """Recreate a bitmap from the output of dump()."""
+        kind, chunks = data
+        if kind != 'chunks':
+            raise ValueError('Unsupported bitmap format: %s' % kind)
+        bm = cls()
+        for hi, c in chunks:
+            bm._chunks[hi] = array('H', c) if isinstance(c, str) else c
+        return bm
+
+    def update(self, values):
+        if isinstance(values, PyBitmap):
+            self |= values
+            return
+        groups = {}
+        for v in values:
+            hi = v >> CHUNK_BITS
+            if hi in groups:
+                groups[hi].append(v & CHUNK_MASK)
+            else:
+                groups[hi] = [v & CHUNK_MASK]
+        for hi, lows in groups.iteritems():
+            lows = _normalize(array('H', sorted(set(lows))))
+            if hi in self._chunks:
+                lows = _or(self._chunks[hi], lows)
+            if lows is not None:
+                self._chunks[hi] = lows
+
+    def difference_update(self, values):
+        self -= _bitmap(values)
+
+    def add(self, value):
+        hi, lo = value >> CHUNK_BITS, value & CHUNK_MASK
+        c = self._chunks.get(hi)
+        if c is None:
+            self._chunks[hi] = array('H', [lo])
+        elif isinstance(c, array):
+            i = bisect_left(c, lo)
+            if i >= len(c) or c[i] != lo:
+                c.insert(i, lo)
+                if len(c) > ARRAY_MAX:
+                    self._chunks[hi] = _to_bits(c)
+        else:
+            self._chunks[hi] = c | (1 << lo)
+
+    def discard(self, value):
+        hi, lo = value >> CHUNK_BITS, value & CHUNK_MASK
+        c = self._chunks.get(hi)
+        if c is None:
+            return
+        elif isinstance(c, array):
+            i = bisect_left(c, lo)
+            if i < len(c) and c[i] == lo:
+                del c[i]
+                if not c:
+                    del self._chunks[hi]
+        elif (c >> lo) & 1:
+            self._chunks[hi] = _normalize(c ^ (1 << lo))
+            if self._chunks[hi] is None:
+                del self._chunks[hi]
+
+    def __contains__(self, value):
+        c = self._chunks.get(value >> CHUNK_BITS)
+        if c is None:
+            return False
+        value &= CHUNK_MASK
+        if isinstance(c, array):
+            i = bisect_left(c, value)
+            return (i < len(c) and c[i] == value)
+        return bool((c >> value) & 1)
+
+    def __len__(self):
+        return sum(_count(c) for c in self._chunks.itervalues())
+
+    def __nonzero__(self):
+        return bool(self._chunks)
+
+    def __iter__(self):
+        for hi in sorted(self._chunks.keys()):
+            base = hi << CHUNK_BITS
+            for lo in _to_array(self._chunks[hi]):
+                yield base + lo
+
+    def __eq__(self, other):
+        if isinstance(other, PyBitmap):
+            return (sorted(self._chunks.items()) ==
+                    sorted(other._chunks.items()))
+        return NotImplemented
+
+    def __ne__(self, other):
+        rv = self.__eq__(other)
+        return rv if (rv is NotImplemented) else not rv
+
+    def __and__(self, other):
+        other = _bitmap(other)
+        bm = PyBitmap()
+        for hi in set(self._chunks.keys()) & set(other._chunks.keys()):
+            c = _and(self._chunks[hi], other._chunks[hi])
+            if c is not None:
+                bm._chunks[hi] = c
+        return bm
+
+    def __or__(self, other):
+        other = _bitmap(other)
+        bm = self.copy()
+        for hi, c in other._chunks.iteritems():
+            bm._chunks[hi] = _copy(c) if (hi not in bm._chunks) else _or(
+                bm._chunks[hi], c)
+        return bm
+
+    def __sub__(self, other):
+        other = _bitmap(other)
+        bm = self.copy()
+        for hi, c in other._chunks.iteritems():
+            if hi in bm._chunks:
+                c = _sub(bm._chunks[hi], c)
+                if c is None:
+                    del bm._chunks[hi]
+                else:
+                    bm._chunks[hi] = c
+        return bm
+
+    def __iand__(self, other):
+        self._chunks = (self & other)._chunks
+        return self
+
+    def __ior__(self, other):
+        self._chunks = (self | other)._chunks
+        return self
+
+    def __isub__(self, other):
+        self._chunks = (self - other)._chunks
+        return self
+
+    def __repr__(self):
+        return '<PyBitmap(%d)>' % len(self)
+
+
+def _bitmap(values):
+    return values if isinstance(values, PyBitmap) else PyBitmap(values)
+
+
+if RoaringBitMap is not None:
+    class Bitmap(RoaringBitMap):
+        @classmethod
+        def Range(cls, count):
+            return cls(xrange(0, count))
+
+        def dump(self):
+            return ('roaring', self.serialize())
+
+        @classmethod
+        def Load(cls, data):
+            kind, payload = data
+            if kind == 'roaring':
+                return cls(RoaringBitMap.deserialize(payload))
+            return cls(PyBitmap.Load(data))
+else:
+    Bitmap = PyBitmap
+
+
+def AsBitmap(values):
+    """Return values as a Bitmap, avoiding a copy if it already is one."""
+    return values if isinstance(values, Bitmap) else Bitmap(values)
+
+
+if __name__ == "__main__":
+    import doctest
+    import sys
+    result = doctest.testmod()
+    print '%s' % (result, )
+    if result.failed:
+        sys.exit(1)
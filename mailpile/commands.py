@@ -1549,14 +1549,48 @@ class ProgramStatus(Command):
             else:
                 locks = _('Nothing Found')
 
+            cache = self.result.get('msg_cache')
+            if cache:
+                cache = ('  %(items)d/%(max_items)d messages, %(bytes)d bytes,'
+                         ' hits=%(hits)d misses=%(misses)d'
+                         ' evictions=%(evictions)d (%(hit_rate).3f)' % cache)
+            else:
+                cache = '  ' + _('Nothing Found')
+
+            pl_cache = self.result.get('pl_cache')
+            if pl_cache:
+                pl_cache = ('  %(items)d containers, %(bytes)d/%(max_bytes)d'
+                            ' bytes, hits=%(hits)d misses=%(misses)d'
+                            ' loads=%(loads)d evictions=%(evictions)d'
+                            ' writebacks=%(writebacks)d (%(hit_rate).3f)'
+                            % pl_cache)
+            else:
+                pl_cache = '  ' + _('Nothing Found')
+
+            crypto = self.result.get('crypto_workers')
+            if crypto:
+                crypto = ('  %(busy)d/%(max_workers)d busy, %(idle)d idle,'
+                          ' started=%(started)d jobs=%(jobs)d'
+                          ' errors=%(errors)d in=%(bytes_in)d'
+                          ' out=%(bytes_out)d wait=%(avg_wait_ms).3fms'
+                          ' run=%(avg_run_ms).3fms' % crypto)
+            else:
+                crypto = '  ' + _('Nothing Found')
+
             return ('Recent events:\n%s\n\n'
                     'Events in progress:\n%s\n\n'
                     'Live sessions:\n%s\n\n'
                     'Postinglist timers:\n%s\n\n'
+                    'Postinglist cache:\n%s\n\n'
+                    'Crypto workers:\n%s\n\n'
+                    'Metadata cache:\n%s\n\n'
                     'Threads: (bg delay %.3fs, live=%s, httpd=%s)\n%s\n\n'
                     'Locks:\n%s'
                     ) % (cevents, ievents, sessions,
                          self.result['pl_timers'],
+                         pl_cache,
+                         crypto,
+                         cache,
                          self.result['delay'],
                          self.result['live'],
                          self.result['httpd'],
@@ -1564,6 +1598,7 @@ class ProgramStatus(Command):
 
     def command(self, args=None):
         import mailpile.auth
+        import mailpile.crypto.workers
         import mailpile.mail_source
         import mailpile.plugins.compose
         import mailpile.plugins.contacts
@@ -1619,12 +1654,16 @@ class ProgramStatus(Command):
                           'userinfo': v.auth} for k, v in
                          mailpile.auth.SESSION_CACHE.iteritems()],
             'pl_timers': mailpile.postinglist.TIMERS,
+            'pl_cache': mailpile.postinglist.PLC_CACHE_Stats(),
+            'crypto_workers': mailpile.crypto.workers.Status(),
             'delay': play_nice_with_threads(sleep=False),
             'live': mailpile.util.LIVE_USER_ACTIVITIES,
             'httpd': mailpile.httpd.LIVE_HTTP_REQUESTS,
             'threads': threads,
             'locks': sorted(locks)
         }
+        if config.index:
+            result['msg_cache'] = config.index.CACHE.stats()
         if config.event_log:
             result.update({
                 'cevents': list(config.event_log.events(flag='c'))[-10:],
@@ -25,7 +25,7 @@ from mailpile.i18n import gettext as _
 from mailpile.i18n import ngettext as _n
 from mailpile.mailboxes import OpenMailbox, NoSuchMailboxError, wervd
 from mailpile.mailutils import FormatMbxId, MBX_ID_LEN
-from mailpile.search import MailIndex
+from mailpile.search import MailIndex, ConfigureParsePool
 from mailpile.search_history import SearchHistory
 from mailpile.ui import Session, BackgroundInteraction
 from mailpile.util import *
@@ -1622,14 +1622,10 @@ class ConfigManager(ConfigDict):
     def load_pickle(self, pfn):
         with open(os.path.join(self.workdir, pfn), 'rb') as fd:
             if self.master_key:
-                from mailpile.crypto.streamer import DecryptingStreamer
-                with DecryptingStreamer(fd,
-                                        mep_key=self.master_key,
-                                        name='load_pickle'
-                                        ) as streamer:
-                    rv = cPickle.loads(streamer.read())
-                    streamer.verify(_raise=IOError)
-                    return rv
+                data = []
+                decrypt_and_parse_lines(fd, lambda ll: data.extend(ll), self,
+                                        newlines=True, decode=None)
+                return cPickle.loads(''.join(data))
             else:
                 return cPickle.loads(fd.read())
 
@@ -1898,6 +1894,9 @@ class ConfigManager(ConfigDict):
     def mailindex_file(self):
         return os.path.join(self.workdir, 'mailpile.idx')
 
+    def mailindex_columns_file(self):
+        return os.path.join(self.workdir, 'mailpile.cdx')
+
     def mailpile_path(self, path):
         base = (self.workdir + os.sep).replace(os.sep+os.sep, os.sep)
         if path.startswith(base):
@@ -2004,6 +2003,14 @@ class ConfigManager(ConfigDict):
                  start_httpd(httpd_spec)
             return
 
+        # (Re)size the pool of mail parsing processes. This forks, so we
+        # do it before starting any of the worker threads below.
+        ConfigureParsePool(config, config.sys.index_processes)
+
+        # (Re)size the pool of crypto coprocesses
+        import mailpile.crypto.workers
+        mailpile.crypto.workers.Configure(config.sys.crypto_workers)
+
         # Start the other workers
         if daemons:
             for src_id, src_config in config.sources.iteritems():
@@ -2083,6 +2090,11 @@ class ConfigManager(ConfigDict):
                                                        ratio=0.25, runtime=15))
             config.cron_worker.add_task('gpl_optimize', 29, optimizer)
 
+            def index_deferred():
+                if config.index is not None:
+                    config.index.schedule_deferred(config.background)
+            config.cron_worker.add_task('index_deferred', 307, index_deferred)
+
             # Schedule plugin jobs
             from mailpile.plugins import PluginManager
 
@@ -2145,11 +2157,17 @@ class ConfigManager(ConfigDict):
         if config.sys.debug:
             print 'Waiting for %s' % save_worker
 
+        from mailpile.postinglist import GlobalPostingList
         from mailpile.postinglist import PLC_CACHE_FlushAndClean
+        GlobalPostingList.Flush(config.background)
         PLC_CACHE_FlushAndClean(config.background, keep=0)
         config.search_history.save(config)
         save_worker.quit(join=True)
 
+        ConfigureParsePool(config, 0)
+        import mailpile.crypto.workers
+        mailpile.crypto.workers.Configure(0)
+
         if config.sys.debug:
             # Hooray!
             print 'All stopped!'
@@ -0,0 +1,359 @@
+#
+# Random-access, block-encrypted containers.
+#
+# Mailpile's usual encrypted data format is a single openssl stream, so
+# reading any part of it means decrypting all of it. This container
+# instead splits the data into fixed-size blocks which are encrypted and
+# authenticated independently, so readers can decrypt just the blocks
+# they need. The file looks like this:
+#
+#   X-Mailpile-Encrypted-Blocks: v1     (plain-text header, ending with
+#   cipher: aes-256-cbc                  an empty line)
+#   mac: hmac-sha256
+#   block-size: 65536
+#   nonce: ...
+#
+#   <block 0><block 1>...<block N-1>    (IV + AES-CBC ciphertext + MAC)
+#   <offset table>                      (N x (file offset, length))
+#   <trailer>                           (table offset, N, data size,
+#                                        MAC of header + table + trailer)
+#
+# Each block's MAC covers its index, so blocks cannot be swapped around
+# or truncated without detection. The offset table only reveals where
+# the (equally sized) blocks are, nothing about the contents. Blocks may
+# be written in any order; the writer uses this to let callers go back
+# and patch the first block (e.g. a header) before the file is closed.
+#
+# This requires an AES module (pycrypto or pycryptodome); if there is
+# none, AVAILABLE is False and callers should stick to other formats.
+#
+import hashlib
+import hmac
+import mmap
+import os
+import struct
+
+from mailpile.util import LRUCache
+
+try:
+    from Crypto.Cipher import AES
+except ImportError:
+    AES = None
+
+
+AVAILABLE = (AES is not None)
+
+MARKER = 'X-Mailpile-Encrypted-Blocks: v1\n'
+HEADER = (MARKER +
+          'cipher: aes-256-cbc\n'
+          'mac: hmac-sha256\n'
+          'block-size: %(block_size)d\n'
+          'nonce: %(nonce)s\n'
+          '\n')
+TABLE_ENTRY = struct.Struct('<QI')
+TRAILER = struct.Struct('<QIQ32s8s')
+TRAILER_MAGIC = 'MPBLKEND'
+BLOCK_SIZE = 64 * 1024
+IV_LEN = 16
+MAC_LEN = 32
+
+
+def _keys(key, nonce):
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return (hmac.new(key, 'encrypt:%s' % nonce, hashlib.sha256).digest(),
+            hmac.new(key, 'mac:%s' % nonce, hashlib.sha256).digest())
+
+
+def _block_mac(mac_key, index, iv, ciphertext):
+    return hmac.new(mac_key, struct.pack('<Q', index) + iv + ciphertext,
+                    hashlib.sha256).digest()
+
+
+try:
+    _compare_digest = hmac.compare_digest
+except AttributeError:
+    # Python < 2.7.7
+    def _compare_digest(a, b):
+        if len(a) != len(b):
+            return False
+        result = 0
+        for x, y in zip(a, b):
+            result |= ord(x) ^ ord(y)
+        return (result == 0)
+
+
+def IsBlockEncrypted(filename):
+    """Check whether a file is a block-encrypted container."""
+    try:
+        with open(filename, 'rb') as fd:
+            return (fd.read(len(MARKER)) == MARKER)
+    except (IOError, OSError):
+        return False
+
+
+class BlockEncryptingWriter(object):
+    """
+    Write data to a block-encrypted container. This is a minimal file-like
+    object: data is written sequentially, but since the first block is
+    encrypted last, seeking back to overwrite data within it (a header,
+    for example) is allowed until the writer is closed.
+
+    >>> import tempfile
+    >>> tf = tempfile.NamedTemporaryFile()
+    >>> with BlockEncryptingWriter(open(tf.name, 'wb'), 'k', 16) as fd:
+    ...     fd.write('XXXX, hello world and all that')
+    ...     fd.seek(0)
+    ...     fd.write('Why')
+    >>> blocks = BlockDecryptingReader(tf.name, 'k')
+    >>> (len(blocks), blocks.count, blocks[0:10], blocks[29], blocks[-5:])
+    (30, 2, 'WhyX, hell', 't', ' that')
+    """
+    def __init__(self, fd, key, block_size=BLOCK_SIZE):
+        if not AVAILABLE:
+            raise IOError('No AES module available')
+        self.fd = fd
+        self.block_size = block_size
+        self.nonce = os.urandom(16).encode('hex')
+        self.enc_key, self.mac_key = _keys(key, self.nonce)
+        self.header = HEADER % {'block_size': block_size,
+                                'nonce': self.nonce}
+        self.table = []
+        self.first = None
+        self.buffer = []
+        self.buffered = 0
+        self.size = 0
+        self.pos = 0
+        self.closed = False
+        self.fd.write(self.header)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, pos, whence=0):
+        if whence == 2:
+            pos += self.size
+        elif whence == 1:
+            pos += self.pos
+        if pos != self.size and not (0 <= pos < min(self.size,
+                                                    self.block_size)):
+            raise IOError('Cannot seek to %d' % pos)
+        self.pos = pos
+
+    def _patch(self, data):
+        end = self.pos + len(data)
+        if end > min(self.size, self.block_size):
+            raise IOError('Can only overwrite data in the first block')
+        if self.first is not None:
+            self.first = self.first[:self.pos] + data + self.first[end:]
+        else:
+            current = ''.join(self.buffer)
+            self.buffer = [current[:self.pos] + data + current[end:]]
+        self.pos = end
+
+    def write(self, data):
+        if self.pos < self.size:
+            return self._patch(data)
+        self.buffer.append(data)
+        self.buffered += len(data)
+        self.size += len(data)
+        self.pos = self.size
+        if self.buffered >= 2 * self.block_size:
+            self._flush_blocks()
+
+    def _flush_blocks(self, final=False):
+        data = ''.join(self.buffer)
+        full = len(data) if final else (len(data) -
+                                        len(data) % self.block_size)
+        for ofs in range(0, full, self.block_size):
+            self._write_block(data[ofs:ofs + self.block_size])
+        self.buffer = [data[full:]]
+        self.buffered = len(data) - full
+
+    def _encrypt(self, index, plaintext):
+        iv = os.urandom(IV_LEN)
+        padding = 16 - (len(plaintext) % 16)
+        ciphertext = AES.new(self.enc_key, AES.MODE_CBC, iv).encrypt(
+            plaintext + chr(padding) * padding)
+        return iv + ciphertext + _block_mac(self.mac_key, index, iv,
+                                            ciphertext)
+
+    def _write_block(self, plaintext):
+        if not self.table:
+            # The first block is written last, so it can still be patched
+            self.first = plaintext
+            self.table.append(None)
+        else:
+            encrypted = self._encrypt(len(self.table), plaintext)
+            self.table.append((self.fd.tell(), len(encrypted)))
+            self.fd.write(encrypted)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._flush_blocks(final=True)
+        if self.first is not None:
+            encrypted = self._encrypt(0, self.first)
+            self.table[0] = (self.fd.tell(), len(encrypted))
+            self.fd.write(encrypted)
+
+        table = ''.join(TABLE_ENTRY.pack(*entry) for entry in self.table)
+        table_offset = self.fd.tell()
+        trailer = struct.pack('<QIQ', table_offset, len(self.table),
+                              self.size)
+        self.fd.write(table)
+        self.fd.write(TRAILER.pack(table_offset, len(self.table), self.size,
+                                   hmac.new(self.mac_key,
+                                            self.header + table + trailer,
+                                            hashlib.sha256).digest(),
+                                   TRAILER_MAGIC))
+        self.fd.close()
+
+
+class BlockDecryptingReader(object):
+    """
+    Random access to the plain-text of a block-encrypted container. The
+    object behaves like a read-only string (or mmap): it can be sliced
+    and has a length, but only the blocks touched are ever decrypted.
+    Recently used blocks are cached. Tampering or the wrong key raise
+    IOError.
+
+    >>> import tempfile
+    >>> tf = tempfile.NamedTemporaryFile()
+    >>> with BlockEncryptingWriter(open(tf.name, 'wb'), 'k', 1024) as fd:
+    ...     fd.write(''.join('%5.5d' % i for i in range(0, 2000)))
+    >>> blocks = BlockDecryptingReader(tf.name, 'k')
+    >>> (blocks[5000:5010], blocks.count, blocks.decrypted)
+    ('0100001001', 10, 1)
+    >>> BlockDecryptingReader(tf.name, 'wrong key')
+    Traceback (most recent call last):
+      ...
+    IOError: Block table authentication failed
+
+    >>> with open(tf.name, 'r+b') as fd:
+    ...     fd.seek(200)
+    ...     fd.write('!')
+    >>> blocks = BlockDecryptingReader(tf.name, 'k')
+    >>> blocks[9000:9010]
+    '0180001801'
+    >>> blocks[2000:2010]
+    Traceback (most recent call last):
+      ...
+    IOError: Block 1 authentication failed
+
+    >>> open(tf.name, 'wb').close()
+    >>> BlockDecryptingReader(tf.name, 'k')
+    Traceback (most recent call last):
+      ...
+    ValueError: Truncated block container: ...
+    """
+    def __init__(self, filename, key, cache_blocks=8):
+        if not AVAILABLE:
+            raise IOError('No AES module available')
+        self.filename = filename
+        self._mmap = None
+        try:
+            with open(filename, 'rb') as fd:
+                if os.fstat(fd.fileno()).st_size < TRAILER.size:
+                    raise ValueError('Truncated block container: %s'
+                                     % filename)
+                self._mmap = mmap.mmap(fd.fileno(), 0,
+                                       access=mmap.ACCESS_READ)
+            header_end = self._mmap.find('\n\n', 0, 4096)
+            if not self._mmap[:len(MARKER)] == MARKER or header_end < 0:
+                raise ValueError('Not block encrypted: %s' % filename)
+            header = self._mmap[:header_end + 2]
+            headers = dict(l.split(': ', 1)
+                           for l in header.strip().split('\n')[1:])
+            self.block_size = int(headers['block-size'])
+            self.enc_key, self.mac_key = _keys(key, headers['nonce'])
+
+            trailer = self._mmap[-TRAILER.size:]
+            (table_offset, self.count, self.size, mac, magic
+             ) = TRAILER.unpack(trailer)
+            if magic != TRAILER_MAGIC:
+                raise ValueError('Truncated block container: %s' % filename)
+            table = self._mmap[table_offset:
+                               table_offset + self.count * TABLE_ENTRY.size]
+            expected = hmac.new(self.mac_key, header + table + trailer[:20],
+                                hashlib.sha256).digest()
+            if not _compare_digest(expected, mac):
+                raise IOError('Block table authentication failed')
+            self.table = [TABLE_ENTRY.unpack_from(table, i * TABLE_ENTRY.size)
+                          for i in range(0, self.count)]
+        except (KeyError, ValueError, struct.error), e:
+            self.close()
+            raise ValueError(str(e))
+        except:
+            self.close()
+            raise
+
+        self.cache = LRUCache(max_items=cache_blocks)
+        self.decrypted = 0
+
+    def close(self):
+        mm, self._mmap = self._mmap, None
+        if mm is not None:
+            mm.close()
+
+    def __len__(self):
+        return self.size
+
+    def block(self, index):
+        """Return the decrypted contents of a single block."""
+        plaintext = self.cache.get(index)
+        if plaintext is None:
+            offset, length = self.table[index]
+            data = self._mmap[offset:offset + length]
+            iv, ciphertext, mac = (data[:IV_LEN], data[IV_LEN:-MAC_LEN],
+                                   data[-MAC_LEN:])
+            if not _compare_digest(
+                    _block_mac(self.mac_key, index, iv, ciphertext), mac):
+                raise IOError('Block %d authentication failed' % index)
+            plaintext = AES.new(self.enc_key, AES.MODE_CBC, iv
+                                ).decrypt(ciphertext)
+            plaintext = plaintext[:-ord(plaintext[-1])]
+            self.cache[index] = plaintext
+            self.decrypted += 1
+        return plaintext
+
+    def __getitem__(self, which):
+        if isinstance(which, slice):
+            start, stop, step = which.indices(self.size)
+            if step != 1:
+                raise ValueError('Slice steps are unsupported')
+            if stop <= start:
+                return ''
+            first = start // self.block_size
+            last = (stop - 1) // self.block_size
+            data = ''.join(self.block(i) for i in range(first, last + 1))
+            skip = first * self.block_size
+            return data[start - skip:stop - skip]
+        if which < 0:
+            which += self.size
+        if which < 0 or which >= self.size:
+            raise IndexError('Index out of range')
+        return self[which:which + 1]
+
+    def __iter__(self):
+        for i in range(0, self.count):
+            yield self.block(i)
+
+
+if __name__ == "__main__":
+    import doctest
+    import sys
+    if not AVAILABLE:
+        print 'No AES module, skipping tests'
+        sys.exit(0)
+    result = doctest.testmod(optionflags=doctest.ELLIPSIS)
+    print '%s' % (result, )
+    if result.failed:
+        sys.exit(1)
@@ -1,4 +1,6 @@
 import os
+import binascii
+import cStringIO
 import hashlib
 import random
 import sys
@@ -15,6 +17,8 @@ from mailpile.crypto.gpgi import GPG_BINARY
 from mailpile.safe_popen import Popen, PIPE
 from mailpile.util import md5_hex, CryptoLock, safe_remove
 from mailpile.util import sha512b64 as genkey
+import mailpile.crypto.workers
+from mailpile.crypto.workers import AES, IN_PROCESS_CIPHERS, openssl_kdf
 
 
 LEN_MD5 = len(md5_hex('testing'))
@@ -381,6 +385,10 @@ class EncryptingDelimitedStreamer(ChecksummingStreamer):
     # (yet) behave well with it.
     DEFAULT_CIPHER = "aes-256-cbc"
 
+    # Streams up to this size are handed to the crypto worker pool (if
+    # there is one) when finished, larger ones get their own coprocess.
+    MAX_POOLED_BYTES = 8 * 1024 * 1024
+
     def __init__(self, key,
                  dir=None, cipher=None, name=None, header_data=None,
                  long_running=False, use_filter=FILTER_MD5):
@@ -388,6 +396,9 @@ class EncryptingDelimitedStreamer(ChecksummingStreamer):
         self.nonce, self.key = self._nonce_and_mutated_key(key)
         self.header_data = (header_data if header_data is not None
                             else self.EXTRA_DATA)
+        self.workers = (None if long_running
+                        else mailpile.crypto.workers.CRYPTO_WORKERS)
+        self._plaintext = None
 
         ChecksummingStreamer.__init__(self, dir=dir, name=name,
                                       long_running=long_running,
@@ -398,15 +409,45 @@ class EncryptingDelimitedStreamer(ChecksummingStreamer):
         self.inner_md5.update(self.key)
         self.inner_md5.update(self.nonce or '')
 
-        self._send_key()
+        if self.workers is not None:
+            self._fd = self._plaintext = cStringIO.StringIO()
+        else:
+            self._send_key()
 
     def _write_filter(self, data):
         if data:
             self.inner_md5.update(data)
         return data
 
+    def write(self, data, *args, **kwargs):
+        rv = ChecksummingStreamer.write(self, data, *args, **kwargs)
+        if (self._plaintext is not None and
+                self._plaintext.tell() > self.MAX_POOLED_BYTES):
+            self._start_coprocess()
+        return rv
+
+    def _start_coprocess(self):
+        plaintext, self._plaintext = self._plaintext.getvalue(), None
+        self._proc, self._fd = self._popen(self._openssl_command(),
+                                           self.fd, False)
+        self._send_key()
+        self._fd.write(plaintext)
+
+    def _encrypt_with_workers(self):
+        try:
+            encrypted = self.workers.run('enc', self.cipher, self.key,
+                                         self._plaintext.getvalue())
+        except IOError:
+            # Fall back to doing things the old-fashioned way
+            return self._start_coprocess()
+        self._plaintext = None
+        self._fd = self.fd
+        self.fd.write(encrypted)
+
     def finish(self, *args, **kwargs):
         if not self.finished:
+            if self._plaintext is not None:
+                self._encrypt_with_workers()
             rv = ChecksummingStreamer.finish(self, *args, **kwargs)
             self._write_inner_md5sum()
             return rv
@@ -441,10 +482,15 @@ class EncryptingDelimitedStreamer(ChecksummingStreamer):
         # inner MD5 sum (calculated using the _write_filter() above).
         self._fd.write('%s\n' % self.key)
 
-    def _mk_command(self):
+    def _openssl_command(self):
         return [OPENSSL_COMMAND, "enc", "-e", "-a", "-%s" % self.cipher,
                 "-pass", "stdin", "-bufsize", "0"]
 
+    def _mk_command(self):
+        if self.workers is not None:
+            return None
+        return self._openssl_command()
+
     def _write_preamble(self):
         self.fd.write(self.BEGIN_DATA)
         self.fd.write('cipher: %s\n' % self.cipher)
@@ -702,6 +748,108 @@ class DecryptingStreamer(InputCoprocess):
                 "-pass", "stdin"]
 
 
+# The digest "openssl enc" uses to derive keys from passphrases changed
+# from MD5 to SHA256 in OpenSSL 1.1.0, so data on disk may use either.
+# Whichever worked last gets tried first; it is replaced with a single
+# assignment, so concurrent decryptions never see the list half-changed.
+OPENSSL_KDF_DIGESTS = (hashlib.sha256, hashlib.md5)
+OPENSSL_KDF_PREFERRED = OPENSSL_KDF_DIGESTS[0]
+
+
+def _parse_encrypted(data, mep_key):
+    # Split a block of Mailpile encrypted data into its parts, returning
+    # (cipher, mutated key, nonce, expected md5sum, base64 data) or None
+    # if this is something else (or has no MD5 sum to verify against).
+    if not (data.startswith(DecryptingStreamer.BEGIN_MED) or
+            data.startswith(DecryptingStreamer.BEGIN_MED2)):
+        return None
+
+    data = data.replace('\r\n', '\n')
+    if '\n\n' not in data:
+        return None
+    header, body = data.split('\n\n', 1)
+    try:
+        headers = dict([l.split(': ', 1)
+                        for l in header.strip().split('\n')[1:]])
+    except ValueError:
+        return None
+    if data.startswith(DecryptingStreamer.BEGIN_MED):
+        body = body.split('\n\n-', 1)[0]
+
+    md5sum = headers.get('md5sum', '0' * LEN_MD5)
+    if md5sum == '0' * LEN_MD5:
+        return None
+
+    nonce = headers.get('nonce', '')
+    mutated = genkey(mep_key or '', nonce)[:32].strip()
+    return (headers.get('cipher', DecryptingStreamer.DEFAULT_CIPHER),
+            mutated, nonce, md5sum, body)
+
+
+def DecryptInProcess(data, mep_key):
+    """
+    Decrypt a block of Mailpile encrypted data without forking openssl.
+
+    Returns the plaintext, or None if the data cannot be handled in-process
+    (no AES module, PGP data, unknown cipher, no MD5 sum to check against),
+    in which case the caller should fall back to the DecryptingStreamer.
+    The result is only returned if it matches the inner MD5 sum, exactly
+    as DecryptingStreamer.verify() would check it.
+    """
+    global OPENSSL_KDF_PREFERRED
+    parsed = (AES is not None) and _parse_encrypted(data, mep_key)
+    if not parsed:
+        return None
+    cipher, mutated, nonce, md5sum, body = parsed
+    key_len = IN_PROCESS_CIPHERS.get(cipher)
+    if not key_len:
+        return None
+
+    try:
+        ciphertext = binascii.a2b_base64(body)
+    except binascii.Error:
+        return None
+    if (not ciphertext.startswith('Salted__') or len(ciphertext) < 32
+            or len(ciphertext) % 16):
+        return None
+    salt, ciphertext = ciphertext[8:16], ciphertext[16:]
+
+    preferred = OPENSSL_KDF_PREFERRED
+    for digest in ((preferred, ) +
+                   tuple(d for d in OPENSSL_KDF_DIGESTS if d != preferred)):
+        key, iv = openssl_kdf(digest, mutated, salt, key_len)
+        plaintext = AES.new(key, AES.MODE_CBC, iv).decrypt(ciphertext)
+        padding = ord(plaintext[-1])
+        if not (1 <= padding <= 16 and
+                plaintext[-padding:] == plaintext[-1] * padding):
+            continue
+        plaintext = plaintext[:-padding]
+        if md5_hex(mutated, nonce, plaintext) == md5sum:
+            OPENSSL_KDF_PREFERRED = digest
+            return plaintext
+    return None
+
+
+def DecryptWithWorkers(data, mep_key):
+    """
+    Decrypt a block of Mailpile encrypted data using the crypto worker
+    pool, if there is one. Like DecryptInProcess, this returns None if
+    the caller should fall back to the DecryptingStreamer.
+    """
+    pool = mailpile.crypto.workers.CRYPTO_WORKERS
+    parsed = (pool is not None) and _parse_encrypted(data, mep_key)
+    if not parsed:
+        return None
+    cipher, mutated, nonce, md5sum, body = parsed
+    try:
+        plaintext = pool.run('dec', cipher, mutated, body)
+    except IOError:
+        return None
+    if md5_hex(mutated, nonce, plaintext) != md5sum:
+        return None
+    return plaintext
+
+
 class ReadLineIOFilter(IOFilter):
     """
     This is a line-based IOFilter, which can stop when it sees a
@@ -854,6 +1002,13 @@ if __name__ == "__main__":
                      assert(ds.verify(testing=True))
              assert(fdcheck('Decrypting test, delimited=%s' % delim))
 
+             if AES is not None:
+                 print 'In-process decryption test, delim=%s' % delim
+                 with open(fn, 'rb') as bfd:
+                     encrypted = bfd.read()
+                 assert(DecryptInProcess(encrypted, 'test key') == data)
+                 assert(DecryptInProcess(encrypted, 'bad key') is None)
+
          # Cleanup
          os.unlink(fn)
 
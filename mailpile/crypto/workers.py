@@ -0,0 +1,280 @@
+#
+# A pool of long-lived crypto coprocesses.
+#
+# Starting a fresh openssl process (and a thread or two to feed it) for
+# every encrypted stream is expensive, doubly so when it is a large,
+# multi-threaded Mailpile which has to fork. Instead, we keep a few small
+# helper processes around (this file, run as a script) and hand them
+# framed encrypt/decrypt jobs over their stdin/stdout pipes.
+#
+# The wire format is a request line of "<op> <cipher> <keylen> <datalen>",
+# followed by the key and data, and a response line of "<status> <len>",
+# followed by the result (or an error message). The ops are "enc" and
+# "dec", which behave like `openssl enc -e|-d -a -<cipher> -pass stdin`.
+#
+# The helpers only use the standard library (and an AES module, if one
+# is available), as they run without the rest of Mailpile on the path.
+#
+import binascii
+import hashlib
+import os
+import subprocess
+import sys
+import threading
+import time
+
+try:
+    from Crypto.Cipher import AES
+except ImportError:
+    AES = None
+
+
+OPENSSL_COMMAND = ('OpenSSL\\bin\\openssl.exe'
+                   if sys.platform.startswith('win') else 'openssl')
+
+# Key sizes of the ciphers the helpers can handle without openssl
+IN_PROCESS_CIPHERS = {
+    'aes-128-cbc': 16,
+    'aes-192-cbc': 24,
+    'aes-256-cbc': 32
+}
+
+
+##[ The helper process ]######################################################
+
+def _openssl(op, cipher, key, data):
+    proc = subprocess.Popen([OPENSSL_COMMAND, 'enc', '-%s' % op[0], '-a',
+                             '-%s' % cipher, '-pass', 'stdin'],
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+    out, err = proc.communicate('%s\n%s' % (key, data))
+    if proc.returncode != 0:
+        raise IOError(err or 'openssl exited with %s' % proc.returncode)
+    return out
+
+
+def openssl_kdf(digest, passphrase, salt, key_len, iv_len=16):
+    # This is OpenSSL's EVP_BytesToKey(), with a single iteration.
+    material, block = '', ''
+    while len(material) < key_len + iv_len:
+        block = digest(block + passphrase + salt).digest()
+        material += block
+    return material[:key_len], material[key_len:key_len + iv_len]
+
+
+def _openssl_kdf_digest():
+    # Figure out which digest the local openssl uses to derive keys, so
+    # the data we encrypt is exactly what openssl itself would produce.
+    salt = '\0' * 8
+    try:
+        proc = subprocess.Popen([OPENSSL_COMMAND, 'enc', '-e',
+                                 '-aes-256-cbc', '-pass', 'pass:mailpile',
+                                 '-S', binascii.hexlify(salt), '-P'],
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        out = proc.communicate('')[0]
+        for line in out.splitlines():
+            if line.strip().lower().startswith('key='):
+                key = binascii.unhexlify(line.strip().split('=', 1)[1])
+                for digest in (hashlib.sha256, hashlib.md5):
+                    if openssl_kdf(digest, 'mailpile', salt, 32)[0] == key:
+                        return digest
+    except (OSError, IOError, TypeError):
+        pass
+    return None
+
+
+def _aes_encrypt(digest, cipher, key, data):
+    salt = os.urandom(8)
+    aes_key, iv = openssl_kdf(digest, key, salt, IN_PROCESS_CIPHERS[cipher])
+    padding = 16 - (len(data) % 16)
+    encrypted = 'Salted__' + salt + AES.new(aes_key, AES.MODE_CBC, iv
+                                            ).encrypt(data + chr(padding) *
+                                                      padding)
+    # Wrap the base64 at 64 characters, like openssl does
+    encoded = binascii.b2a_base64(encrypted).replace('\n', '')
+    return ''.join('%s\n' % encoded[i:i + 64]
+                   for i in range(0, len(encoded), 64))
+
+
+def _read_exactly(fd, length):
+    data = fd.read(length)
+    if len(data) != length:
+        raise IOError('Short read')
+    return data
+
+
+def worker_main(infd, outfd):
+    digest = _openssl_kdf_digest() if (AES is not None) else None
+    while True:
+        request = infd.readline()
+        if not request:
+            break
+        op, cipher, key_len, data_len = request.split()
+        key = _read_exactly(infd, int(key_len))
+        data = _read_exactly(infd, int(data_len))
+        try:
+            if op == 'enc' and digest and cipher in IN_PROCESS_CIPHERS:
+                status, result = 'ok', _aes_encrypt(digest, cipher, key, data)
+            elif op in ('enc', 'dec'):
+                status, result = 'ok', _openssl(op, cipher, key, data)
+            else:
+                status, result = 'error', 'Unknown op: %s' % op
+        except (IOError, OSError), e:
+            status, result = 'error', str(e)
+        outfd.write('%s %d\n' % (status, len(result)))
+        outfd.write(result)
+        outfd.flush()
+
+
+##[ The pool, used by Mailpile itself ]#######################################
+
+class CryptoWorkerPool(object):
+    """
+    A bounded pool of crypto helper processes. Workers are started on
+    demand, up to the configured maximum; callers wait for an idle one
+    after that.
+    """
+    SCRIPT = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+
+    def __init__(self, max_workers=2):
+        self.max_workers = max_workers
+        self.cond = threading.Condition()
+        self.idle = []
+        self.running = 0
+        self.stats = {
+            'started': 0,
+            'jobs': 0,
+            'errors': 0,
+            'bytes_in': 0,
+            'bytes_out': 0,
+            'wait_time': 0.0,
+            'run_time': 0.0
+        }
+
+    def _start_worker(self):
+        from mailpile.safe_popen import Popen, PIPE
+        with open(os.devnull, 'w') as devnull:
+            proc = Popen([sys.executable, self.SCRIPT],
+                         stdin=PIPE, stdout=PIPE, stderr=devnull,
+                         long_running=True)
+        with self.cond:
+            self.stats['started'] += 1
+        return proc
+
+    def _acquire(self):
+        t0 = time.time()
+        with self.cond:
+            while not self.idle and self.running >= self.max_workers:
+                self.cond.wait()
+            self.running += 1
+            worker = self.idle.pop() if self.idle else None
+            self.stats['wait_time'] += time.time() - t0
+        if worker is None:
+            try:
+                worker = self._start_worker()
+            except (IOError, OSError):
+                self._release(None)
+                raise
+        return worker
+
+    def _release(self, worker):
+        with self.cond:
+            self.running -= 1
+            if worker is not None:
+                if self.running + len(self.idle) < self.max_workers:
+                    self.idle.append(worker)
+                else:
+                    self._stop_worker(worker)
+            self.cond.notify()
+
+    def _stop_worker(self, worker):
+        try:
+            worker.stdin.close()
+            worker.wait()
+        except (IOError, OSError):
+            pass
+
+    def run(self, op, cipher, key, data):
+        """Run a job on one of our workers, raising IOError on failure."""
+        worker = self._acquire()
+        t0 = time.time()
+        try:
+            worker.stdin.write('%s %s %d %d\n%s%s' % (op, cipher, len(key),
+                                                     len(data), key, data))
+            worker.stdin.flush()
+            status, length = worker.stdout.readline().split()
+            result = _read_exactly(worker.stdout, int(length))
+        except (IOError, OSError, ValueError):
+            try:
+                worker.kill()
+                worker.wait()
+            except OSError:
+                pass
+            worker, status, result = None, 'error', 'Crypto worker died'
+        finally:
+            self._release(worker)
+
+        with self.cond:
+            self.stats['jobs'] += 1
+            self.stats['run_time'] += time.time() - t0
+            self.stats['bytes_in'] += len(data)
+            if status != 'ok':
+                self.stats['errors'] += 1
+            else:
+                self.stats['bytes_out'] += len(result)
+        if status != 'ok':
+            raise IOError(result)
+        return result
+
+    def close(self):
+        with self.cond:
+            self.max_workers = 0
+            idle, self.idle = self.idle, []
+        for worker in idle:
+            self._stop_worker(worker)
+
+    def status(self):
+        stats = dict(self.stats)
+        jobs = max(1, stats['jobs'])
+        stats.update({
+            'max_workers': self.max_workers,
+            'idle': len(self.idle),
+            'busy': self.running,
+            'avg_wait_ms': 1000 * stats['wait_time'] / jobs,
+            'avg_run_ms': 1000 * stats['run_time'] / jobs
+        })
+        return stats
+
+
+CRYPTO_WORKERS = None
+
+
+def Configure(max_workers):
+    """Create, resize or (if max_workers is 0) shut down the global pool."""
+    global CRYPTO_WORKERS
+    pool = CRYPTO_WORKERS
+    if (max_workers > 0 and not getattr(sys, 'frozen', False)
+            and os.path.exists(CryptoWorkerPool.SCRIPT)):
+        if pool is None:
+            CRYPTO_WORKERS = CryptoWorkerPool(max_workers)
+        else:
+            with pool.cond:
+                pool.max_workers = max_workers
+                pool.cond.notify_all()
+    elif pool is not None:
+        CRYPTO_WORKERS = None
+        pool.close()
+
+
+def Status():
+    pool = CRYPTO_WORKERS
+    return pool.status() if (pool is not None) else None
+
+
+if __name__ == "__main__":
+    if sys.platform.startswith('win'):
+        import msvcrt
+        msvcrt.setmode(sys.stdin.fileno(), os.O_BINARY)
+        msvcrt.setmode(sys.stdout.fileno(), os.O_BINARY)
+    worker_main(sys.stdin, sys.stdout)
@@ -33,9 +33,20 @@ CONFIG_RULES = {
     'sys': p(_('Technical system settings'), False, {
         'fd_cache_size':  (_('Max files kept open at once'), int,         500),
         'history_length': (_('History length (lines, <0=no save)'), int,  100),
+        'index_threads':  (_('Parallel decryption jobs at startup'), int,   4),
+        'index_processes': (_('Parallel mail parsing processes (0=off)'),
+                            int,                                        0),
+        'index_headers_first': (_('Index headers first on large imports'),
+                                bool,                                  True),
         'http_port':     p(_('Listening port for web UI'), int,         33411),
         'http_path':     p(_('HTTP path of web UI'), 'webroot',            ''),
         'postinglist_kb': (_('Posting list target size in KB'), int,       64),
+        'postinglist_segments': (_('Store new postings in merged segments'),
+                                 bool,                                   True),
+        'postinglist_cache_mb': (_('Max. size of posting list cache in MB'),
+                                 int,                                      32),
+        'crypto_workers': (_('Max. number of crypto coprocesses to keep'),
+                           int,                                         2),
         'sort_max':       (_('Max results we sort "well"'), int,         2500),
         'snippet_max':    (_('Max length of metadata snippets'), int,     250),
         'debug':         p(_('Debugging flags'), str,                      ''),
@@ -47,6 +58,11 @@ CONFIG_RULES = {
                            'hostname', 'localhost'),
         'local_mailbox_id': (_('Local read/write Maildir'), 'b36',         ''),
         'mailindex_file': (_('Metadata index file'), 'file',               ''),
+        'metadata_cache': (_('Max. messages in metadata cache'), int,   20000),
+        'metadata_cache_kb': (_('Max. size of metadata cache in KB, 0=any'),
+                              int,                                          0),
+        'metadata_columns': (_('Keep a columnar copy of the metadata index'),
+                             bool,                                       True),
         'postinglist_dir': (_('Search index directory'), 'dir',            ''),
         'mailbox':        [_('Mailboxes we index'), 'bin',                 []],
         'plugins':        [_('Plugins to load on startup'),
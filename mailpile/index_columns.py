@@ -0,0 +1,530 @@
+import bisect
+import cStringIO
+import hashlib
+import marshal
+import mmap
+import os
+import struct
+import tempfile
+import threading
+from array import array
+
+from mailpile.crypto.blocks import BlockDecryptingReader, BlockEncryptingWriter
+from mailpile.crypto.blocks import IsBlockEncrypted
+from mailpile.util import *
+
+
+class ColumnarIndex(object):
+    #
+    # This is a read-only, memory-mapped, column-oriented snapshot of the
+    # metadata index (mailpile.idx).
+    #
+    # The numeric fields we need for sorting and threading (date, size and
+    # conversation ID) are stored as fixed-width arrays, everything else
+    # lives in offset-addressed string heaps. Reading a message is a matter
+    # of a few slices and UTF-8 decodes, no tab-splitting required.
+    #
+    # The snapshot also records how much of the plain-text index it covers,
+    # so lines appended to mailpile.idx after the snapshot was written (by
+    # incremental saves) can be replayed on top of it.
+    #
+    # Derived state which would otherwise have to be rebuilt by decoding
+    # every row (tag and mailbox bitmaps, sort columns, threads) is stored
+    # alongside, as an opaque marshalled blob provided by the caller.
+    #
+    # If a key is given, the snapshot is written to (and read from) a
+    # block-encrypted container instead, which still allows random access.
+    #
+    MAGIC = 'MPCOLIX4'
+    BYTE_ORDER = 0x01020304
+    HEADER_FMT = '=8sIIQQ32s'
+    HEADER_LEN = struct.calcsize(HEADER_FMT)
+
+    # The fixed-width columns: (name, msg_info field, array type code)
+    FIXED = (
+        ('date', 3, 'I'),
+        ('kb', 7, 'i'),
+        ('thread', 12, 'i')
+    )
+    LIMITS = {'I': 2**32, 'i': 2**31}
+    # The string heaps: (name, msg_info field)
+    HEAPS = (
+        ('ptrs', 1),
+        ('msgid', 2),
+        ('from', 4),
+        ('to', 5),
+        ('cc', 6),
+        ('subject', 8),
+        ('body', 9),
+        ('tags', 10),
+        ('replies', 11),
+        ('raw', None),
+        ('emails', None)
+    )
+    # The digest tables for looking up messages by pointer or Message-ID
+    DIGESTS = ('ptrs', 'msgids')
+    SECTIONS = ([f[0] for f in FIXED] +
+                [h[0] for h in HEAPS] +
+                ['%s.ofs' % h[0] for h in HEAPS] +
+                ['%s.high' % d for d in DIGESTS] +
+                ['%s.low' % d for d in DIGESTS] +
+                ['%s.positions' % d for d in DIGESTS] +
+                ['state'])
+    TABLE_FMT = '=' + ('QQ' * len(SECTIONS))
+
+    MSG_FIELDS = 13
+    SIG_BYTES = 64 * 1024
+
+    def __init__(self, filename, source=None, key=None):
+        self.filename = filename
+        self._fd = open(filename, 'rb')
+        try:
+            if IsBlockEncrypted(filename):
+                if not key:
+                    raise IOError('Columnar index is encrypted: %s'
+                                  % filename)
+                self._buf = BlockDecryptingReader(filename, key)
+            else:
+                self._buf = mmap.mmap(self._fd.fileno(), 0,
+                                      access=mmap.ACCESS_READ)
+            (magic, byte_order, self.count, self.source_size,
+             self.email_count, self.source_sig
+             ) = self._unpack(self.HEADER_FMT, 0)
+            if magic != self.MAGIC or byte_order != self.BYTE_ORDER:
+                raise ValueError('Not a columnar index: %s' % filename)
+
+            table = self._unpack(self.TABLE_FMT, self.HEADER_LEN)
+            self._sections = {}
+            for i, name in enumerate(self.SECTIONS):
+                self._sections[name] = (table[i*2], table[i*2 + 1])
+
+            if source and not self.covers(source):
+                raise ValueError('Stale columnar index: %s' % filename)
+        except:
+            self.close()
+            raise
+
+    def close(self):
+        buf, self._buf = getattr(self, '_buf', None), None
+        if buf is not None:
+            buf.close()
+        fd, self._fd = self._fd, None
+        if fd is not None:
+            fd.close()
+
+    def __len__(self):
+        return self.count
+
+    @classmethod
+    def SourceSignature(cls, filename, size):
+        """Fingerprint the first `size` bytes of the plain-text index."""
+        md5 = hashlib.md5()
+        with open(filename, 'rb') as fd:
+            md5.update(fd.read(min(size, cls.SIG_BYTES)))
+            fd.seek(max(0, size - cls.SIG_BYTES))
+            md5.update(fd.read(min(size, cls.SIG_BYTES)))
+        md5.update(str(size))
+        return md5.hexdigest()
+
+    def covers(self, source):
+        """Check whether this snapshot is a snapshot of the given index."""
+        try:
+            if os.path.getsize(source) < self.source_size:
+                return False
+            sig = self.SourceSignature(source, self.source_size)
+            return (sig == self.source_sig)
+        except (IOError, OSError):
+            return False
+
+    def _unpack(self, fmt, offset):
+        # Works on both mmaps and BlockDecryptingReaders
+        size = struct.calcsize(fmt)
+        return struct.unpack(fmt, self._buf[offset:offset + size])
+
+    def _section(self, name):
+        offset, length = self._sections[name]
+        return self._buf[offset:offset + length]
+
+    def column(self, name):
+        """Return an entire fixed-width column as an array."""
+        tc = [f[2] for f in self.FIXED if f[0] == name][0]
+        col = array(tc)
+        col.fromstring(self._section(name))
+        return col
+
+    def digest_index(self, name):
+        """Return a DigestIndex for looking up pointers or Message-IDs."""
+        high, low, positions = array('I'), array('I'), array('i')
+        high.fromstring(self._section('%s.high' % name))
+        low.fromstring(self._section('%s.low' % name))
+        positions.fromstring(self._section('%s.positions' % name))
+        return DigestIndex(high, low, positions)
+
+    def _heap_item(self, name, pos):
+        ofs, length = self._sections['%s.ofs' % name]
+        start, end = self._unpack('=II', ofs + 4 * pos)
+        offset = self._sections[name][0]
+        return self._buf[offset + start:offset + end]
+
+    def _fixed_item(self, name, tc, pos):
+        width = struct.calcsize(tc)
+        return self._unpack('=' + tc,
+                            self._sections[name][0] + width * pos)[0]
+
+    def iter_heap(self, name):
+        """Iterate through all the (undecoded) strings in a heap."""
+        offset = self._sections[name][0]
+        ofs = array('I')
+        ofs.fromstring(self._section('%s.ofs' % name))
+        for i in xrange(0, len(ofs) - 1):
+            yield self._buf[offset + ofs[i]:offset + ofs[i + 1]]
+
+    def emails(self):
+        return [e.decode('utf-8') for e in self.iter_heap('emails')]
+
+    def state(self):
+        """Return the derived state saved with the snapshot, if any."""
+        data = self._section('state')
+        return marshal.loads(data) if data else None
+
+    def get_msg_info(self, pos):
+        """Reassemble the msg_info list for a given index position."""
+        if pos < 0 or pos >= self.count:
+            raise IndexError('Index position out of range: %s' % pos)
+        raw = self._heap_item('raw', pos)
+        if raw:
+            return raw.decode('utf-8').split(u'\t')
+        if self._fixed_item('thread', 'i', pos) < 0:
+            return [u'']
+        msg_info = [None] * self.MSG_FIELDS
+        msg_info[0] = unicode(b36(pos))
+        for name, field, tc in self.FIXED:
+            msg_info[field] = unicode(b36(self._fixed_item(name, tc, pos)))
+        for name, field in self.HEAPS:
+            if field is not None:
+                msg_info[field] = self._heap_item(name, pos).decode('utf-8')
+        return msg_info
+
+    def get_msg_ptrs(self, pos):
+        """Return just the message pointers for a given index position."""
+        if pos < 0 or pos >= self.count:
+            raise IndexError('Index position out of range: %s' % pos)
+        raw = self._heap_item('raw', pos)
+        if raw:
+            fields = raw.split('\t', 2)
+            return fields[1].decode('utf-8') if (len(fields) > 1) else u''
+        return self._heap_item('ptrs', pos).decode('utf-8')
+
+    @classmethod
+    def _regular(cls, pos, msg_info):
+        # Only rows which survive the round-trip through our binary
+        # representation unchanged get stored in columns.
+        if len(msg_info) != cls.MSG_FIELDS:
+            return False
+        try:
+            if msg_info[0] != b36(pos):
+                return False
+            for name, field, tc in cls.FIXED:
+                if b36(long(msg_info[field], 36)) != msg_info[field]:
+                    return False
+                if long(msg_info[field], 36) >= cls.LIMITS[tc]:
+                    return False
+        except ValueError:
+            return False
+        return True
+
+    @classmethod
+    def Write(cls, filename, source, source_size, msg_infos, emails,
+              tempdir=None, key=None, state=None):
+        """
+        Write a columnar snapshot of the index to disk. The msg_infos
+        argument should be an iterable of msg_info lists (or None for
+        unused index positions), in index order. The source and
+        source_size describe the plain-text index this is a snapshot of.
+        If given, state must be something marshal can save; it is handed
+        back by state() when the snapshot is read.
+        If a key is given, the snapshot is block-encrypted.
+        """
+        # The heaps are spooled to disk, unless that would leak plain-text
+        if key:
+            heaps = dict((h[0], cStringIO.StringIO()) for h in cls.HEAPS)
+        else:
+            heaps = dict((h[0], tempfile.TemporaryFile(dir=tempdir))
+                         for h in cls.HEAPS)
+        heap_ofs = dict((h[0], array('I', [0])) for h in cls.HEAPS)
+        fixed = dict((f[0], array(f[2])) for f in cls.FIXED)
+
+        def heap_add(name, data):
+            if isinstance(data, unicode):
+                data = data.encode('utf-8')
+            heaps[name].write(data)
+            heap_ofs[name].append(heap_ofs[name][-1] + len(data))
+
+        digests = dict((d, {}) for d in cls.DIGESTS)
+        count = 0
+        for msg_info in msg_infos:
+            if msg_info and len(msg_info) == cls.MSG_FIELDS:
+                for ptr in msg_info[1].split(','):
+                    digests['ptrs'][DigestIndex.Digest(ptr)] = count
+                digests['msgids'][DigestIndex.Digest(msg_info[2])] = count
+            if msg_info and cls._regular(count, msg_info):
+                for name, field, tc in cls.FIXED:
+                    fixed[name].append(long(msg_info[field], 36))
+                for name, field in cls.HEAPS:
+                    if field is not None:
+                        heap_add(name, msg_info[field])
+                heap_add('raw', '')
+            else:
+                fixed['date'].append(0)
+                fixed['kb'].append(0)
+                fixed['thread'].append(-1)
+                for name, field in cls.HEAPS:
+                    if field is not None:
+                        heap_add(name, '')
+                heap_add('raw', u'\t'.join(msg_info or []))
+            count += 1
+
+        email_count = 0
+        for email in emails:
+            heap_add('emails', email)
+            email_count += 1
+
+        sections = [(f[0], fixed[f[0]].tostring()) for f in cls.FIXED]
+        sections += [(h[0], heaps[h[0]]) for h in cls.HEAPS]
+        sections += [('%s.ofs' % h[0], heap_ofs[h[0]].tostring())
+                     for h in cls.HEAPS]
+        for name in cls.DIGESTS:
+            digests[name] = DigestIndex.Arrays(
+                sorted(digests[name].iteritems()))
+        for i, part in enumerate(('high', 'low', 'positions')):
+            sections += [('%s.%s' % (d, part), digests[d][i].tostring())
+                         for d in cls.DIGESTS]
+        sections += [('state', marshal.dumps(state)
+                               if (state is not None) else '')]
+
+        newfile = '%s.new' % filename
+        try:
+            fd = open(newfile, 'wb')
+            if key:
+                fd = BlockEncryptingWriter(fd, key)
+            with fd:
+                header = struct.pack(cls.HEADER_FMT, cls.MAGIC,
+                                     cls.BYTE_ORDER, count,
+                                     source_size, email_count,
+                                     cls.SourceSignature(source, source_size))
+                fd.write(header)
+                fd.write('\0' * struct.calcsize(cls.TABLE_FMT))
+
+                table = []
+                for name, data in sections:
+                    # Align each section to 8 bytes
+                    fd.write('\0' * (-fd.tell() % 8))
+                    start = fd.tell()
+                    if isinstance(data, str):
+                        fd.write(data)
+                    else:
+                        data.seek(0)
+                        chunk = data.read(64 * 1024)
+                        while chunk:
+                            fd.write(chunk)
+                            chunk = data.read(64 * 1024)
+                    table.extend([start, fd.tell() - start])
+
+                fd.seek(len(header))
+                fd.write(struct.pack(cls.TABLE_FMT, *table))
+
+            if os.path.exists(filename):
+                safe_remove(filename)
+            os.rename(newfile, filename)
+        finally:
+            for heap in heaps.values():
+                heap.close()
+            if os.path.exists(newfile):
+                safe_remove(newfile)
+        return count
+
+
+class ColumnarIndexList(object):
+    #
+    # This is a drop-in replacement for the MailIndex.INDEX list of lines,
+    # backed by a ColumnarIndex snapshot. Lines which have been changed
+    # since the snapshot are kept in an overlay and take precedence.
+    #
+    def __init__(self, columns, l2m, m2l):
+        self.columns = columns
+        self.overlay = {}
+        self._count = len(columns)
+        self._l2m = l2m
+        self._m2l = m2l
+
+    def __len__(self):
+        return self._count
+
+    def __nonzero__(self):
+        return (self._count > 0)
+
+    def __iter__(self):
+        for i in xrange(0, self._count):
+            yield self[i]
+
+    def _check(self, pos):
+        if pos < 0:
+            pos += self._count
+        if pos < 0 or pos >= self._count:
+            raise IndexError('list index out of range')
+        return pos
+
+    def __getitem__(self, pos):
+        pos = self._check(pos)
+        line = self.overlay.get(pos)
+        if line is None:
+            if pos >= len(self.columns):
+                return ''
+            msg_info = self.columns.get_msg_info(pos)
+            return self._m2l(msg_info) if (len(msg_info) > 1) else ''
+        return line
+
+    def __setitem__(self, pos, line):
+        self.overlay[self._check(pos)] = line
+
+    def append(self, line):
+        self.overlay[self._count] = line
+        self._count += 1
+
+    def get_msg_info(self, pos):
+        pos = self._check(pos)
+        line = self.overlay.get(pos)
+        if line is None:
+            if pos >= len(self.columns):
+                return self._l2m('')
+            return self.columns.get_msg_info(pos)
+        return self._l2m(line)
+
+    def get_msg_ptrs(self, pos):
+        pos = self._check(pos)
+        line = self.overlay.get(pos)
+        if line is None:
+            if pos >= len(self.columns):
+                return u''
+            return self.columns.get_msg_ptrs(pos)
+        fields = line.split('\t', 2)
+        return fields[1].decode('utf-8') if (len(fields) > 1) else u''
+
+
+class DigestIndex(object):
+    #
+    # This is a compact replacement for a dict mapping strings (message
+    # pointers or Message-IDs) to index positions. Keys are reduced to
+    # 64-bit digests, and most entries live in sorted arrays which we
+    # binary search. The digests are split into 32-bit halves, as array
+    # has no portable 64-bit type code.
+    #
+    # Changes go to an overlay dict, where a position of -1 marks a
+    # deleted entry. Once the overlay grows too large, it gets merged
+    # into the sorted arrays.
+    #
+    DELETED = -1
+    COMPACT_MIN = 4096
+
+    def __init__(self, high=None, low=None, positions=None):
+        if high is None:
+            high, low, positions = array('I'), array('I'), array('i')
+        self._sorted = (high, low, positions)
+        self.overlay = {}
+        self._count = len(positions)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def Digest(cls, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return struct.unpack('<Q', hashlib.md5(key).digest()[:8])[0]
+
+    @classmethod
+    def Arrays(cls, entries):
+        """Convert sorted (digest, position) pairs to (high, low, pos)."""
+        high, low, positions = array('I'), array('I'), array('i')
+        for digest, pos in entries:
+            high.append(digest >> 32)
+            low.append(digest & 0xffffffff)
+            positions.append(pos)
+        return high, low, positions
+
+    def _get(self, digest):
+        pos = self.overlay.get(digest)
+        if pos is None:
+            high, low, positions = self._sorted
+            dhigh, dlow = digest >> 32, digest & 0xffffffff
+            i = bisect.bisect_left(high, dhigh)
+            while i < len(high) and high[i] == dhigh:
+                if low[i] == dlow:
+                    return positions[i]
+                i += 1
+            return None
+        return None if (pos == self.DELETED) else pos
+
+    def _merged(self, changes):
+        high, low, positions = self._sorted
+        ci = 0
+        for i in xrange(0, len(positions)):
+            digest = (high[i] << 32) | low[i]
+            while ci < len(changes) and changes[ci][0] < digest:
+                yield changes[ci]
+                ci += 1
+            if ci < len(changes) and changes[ci][0] == digest:
+                yield changes[ci]
+                ci += 1
+            else:
+                yield digest, positions[i]
+        for change in changes[ci:]:
+            yield change
+
+    def compact(self):
+        """Merge the overlay into the sorted arrays."""
+        with self._lock:
+            changes = sorted(self.overlay.iteritems())
+            self._sorted = self.Arrays((d, p) for d, p
+                                       in self._merged(changes)
+                                       if p != self.DELETED)
+            self.overlay = {}
+
+    def _changed(self):
+        if len(self.overlay) > max(self.COMPACT_MIN,
+                                   len(self._sorted[2]) // 4):
+            self.compact()
+
+    def __len__(self):
+        return self._count
+
+    def __nonzero__(self):
+        return (self._count > 0)
+
+    def __contains__(self, key):
+        return (self._get(self.Digest(key)) is not None)
+
+    def get(self, key, default=None):
+        pos = self._get(self.Digest(key))
+        return default if (pos is None) else pos
+
+    def __getitem__(self, key):
+        pos = self._get(self.Digest(key))
+        if pos is None:
+            raise KeyError(key)
+        return pos
+
+    def __setitem__(self, key, pos):
+        digest = self.Digest(key)
+        with self._lock:
+            if self._get(digest) is None:
+                self._count += 1
+            self.overlay[digest] = pos
+        self._changed()
+
+    def __delitem__(self, key):
+        digest = self.Digest(key)
+        with self._lock:
+            if self._get(digest) is None:
+                raise KeyError(key)
+            self.overlay[digest] = self.DELETED
+            self._count -= 1
+        self._changed()
@@ -0,0 +1,328 @@
+#
+# A lazy, streaming MIME parser.
+#
+# The standard email.parser reads the entire message into memory and
+# builds the full MIME tree, payloads and all, even though the indexer
+# only needs the text parts and the file names of everything else. This
+# parser makes one pass over the message instead, reading it in chunks
+# and recording where each part's payload starts and ends. Payloads are
+# read (from the original file) only when somebody calls get_payload(),
+# so the memory needed to parse a message no longer depends on the size
+# of its attachments.
+#
+# The resulting tree should be indistinguishable from what email.parser
+# would have built, preambles and epilogues included, so regenerating a
+# (signed) part gives the same text either way. Parts of the message
+# which we do not handle ourselves (message/delivery-status) make us
+# fall back to the standard parser. Lines are assumed to end with \n or
+# \r\n, old Mac-style bare \r line endings are not recognized.
+#
+import email.errors
+import email.message
+import email.parser
+import re
+from email.feedparser import headerRE, NLCRE, NLCRE_bol, NLCRE_eol
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+class LazyMessage(email.message.Message):
+    """
+    A Message which reads its payload from the original file on demand.
+    Once loaded, this behaves exactly like any other Message.
+    """
+    def __init__(self):
+        email.message.Message.__init__(self)
+        self._lazy = None
+
+    def _load(self):
+        fd, start, end = self._lazy
+        self._lazy = None
+        pos = fd.tell()
+        fd.seek(start)
+        self._payload = fd.read(end - start)
+        fd.seek(pos)
+
+    def get_payload(self, i=None, decode=False):
+        if self._lazy is not None:
+            self._load()
+        return email.message.Message.get_payload(self, i, decode)
+
+    def set_payload(self, payload, charset=None):
+        self._lazy = None
+        return email.message.Message.set_payload(self, payload, charset)
+
+    def set_charset(self, charset):
+        if self._lazy is not None:
+            self._load()
+        return email.message.Message.set_charset(self, charset)
+
+    def __getstate__(self):
+        # Copies and pickles should not depend on our file
+        if self._lazy is not None:
+            self._load()
+        return self.__dict__
+
+
+class _FallBack(Exception):
+    pass
+
+
+class _Scanner(object):
+    """
+    Line-oriented, forward-only access to a file. Like the standard
+    parser's BufferedSubFile, lines matching one of the EOF matchers on
+    the stack are treated as the end of the data.
+    """
+    def __init__(self, fd):
+        self.fd = fd
+        self.buf = ''
+        self.offset = 0   # Position of buf[0]
+        self.pos = 0      # Position of the next unread line
+        self.eof = False
+        self.matchers = []
+
+    def _fill(self, keep_from):
+        # Discard data we are done with, but keep a couple of bytes for
+        # looking at line endings.
+        cut = keep_from - 2 - self.offset
+        if cut > 0:
+            self.buf = self.buf[cut:]
+            self.offset += cut
+        data = self.fd.read(CHUNK_SIZE)
+        if not data:
+            self.eof = True
+            return False
+        self.buf += data
+        return True
+
+    def _line(self, pos):
+        while True:
+            i = pos - self.offset
+            eol = self.buf.find('\n', i)
+            if eol >= 0:
+                return self.buf[i:eol + 1]
+            if self.eof:
+                return self.buf[i:]
+            self._fill(pos)
+
+    def _is_eof(self, line):
+        for matcher in reversed(self.matchers):
+            if matcher(line):
+                return True
+        return False
+
+    def eol_length(self, pos):
+        """How long is the line ending which precedes pos?"""
+        i = pos - self.offset
+        before = self.buf[max(0, i - 2):i]
+        if before.endswith('\r\n'):
+            return 2
+        return 1 if before[-1:] in ('\r', '\n') else 0
+
+    def peekline(self):
+        line = self._line(self.pos)
+        return '' if self._is_eof(line) else line
+
+    def readline(self):
+        line = self.peekline()
+        self.pos += len(line)
+        return line
+
+    def skip(self):
+        """
+        Skip ahead to the end of the data, without looking at each line.
+        All our EOF matchers look for MIME boundaries, so only lines which
+        begin with -- are interesting.
+        """
+        pos, at_bol = self.pos, True
+        while True:
+            i = pos - self.offset
+            if at_bol:
+                if len(self.buf) - i < 2 and not self.eof:
+                    self._fill(pos)
+                    continue
+                if (self.buf.startswith('--', i) and
+                        self._is_eof(self._line(pos))):
+                    break
+                i = pos - self.offset
+            nl = self.buf.find('\n--', i)
+            if nl >= 0:
+                pos, at_bol = self.offset + nl + 1, True
+                continue
+            # Read more, taking care not to miss a \n-- split across chunks
+            resume = max(pos, self.offset + len(self.buf) - 2)
+            if self.eof or not self._fill(resume):
+                pos = self.offset + len(self.buf)
+                break
+            if resume > pos:
+                pos, at_bol = resume, False
+        self.pos = pos
+        return pos
+
+
+class LazyParser(object):
+    """
+    Parse a message from a file, reading payloads only when they are
+    needed. The file must stay open (and seekable) for as long as the
+    message is in use.
+
+    >>> import cStringIO
+    >>> data = ('Content-Type: multipart/mixed; boundary="b"\\n\\n'
+    ...         'Hi\\n--b\\n\\nHello world\\n--b\\n'
+    ...         'Content-Type: application/octet-stream; name="x.bin"\\n\\n'
+    ...         + ('x' * 1000000) + '\\n--b--\\n')
+    >>> msg = LazyParser().parse(cStringIO.StringIO(data))
+    >>> [p.get_content_type() for p in msg.walk()]
+    ['multipart/mixed', 'text/plain', 'application/octet-stream']
+    >>> text, attachment = msg.get_payload()
+    >>> (msg.preamble, text.get_payload(), attachment.get_filename())
+    ('Hi', 'Hello world', 'x.bin')
+    >>> attachment._payload is None
+    True
+    >>> msg.as_string() == data
+    True
+    """
+    def __init__(self, _class=LazyMessage):
+        self._class = _class
+
+    def parse(self, fd):
+        base = fd.tell()
+        try:
+            self.fd, self.base = fd, base
+            self.scanner = _Scanner(fd)
+            msg = self._parse_part(None)
+            if (msg.get_content_maintype() == 'multipart' and
+                    not msg.is_multipart()):
+                msg.defects.append(
+                    email.errors.MultipartInvariantViolationDefect())
+            fd.seek(base + self.scanner.pos)
+            return msg
+        except _FallBack:
+            fd.seek(base)
+            return email.parser.Parser().parse(fd)
+        finally:
+            self.fd = self.scanner = None
+
+    def _parse_part(self, parent):
+        scanner = self.scanner
+        headers = []
+        while True:
+            line = scanner.peekline()
+            if not line or not headerRE.match(line):
+                if line and NLCRE.match(line):
+                    scanner.readline()
+                break
+            headers.append(scanner.readline())
+
+        msg = email.parser.HeaderParser(_class=self._class
+                                        ).parsestr(''.join(headers))
+        msg._payload = None
+        msg.defects = [d for d in msg.defects if not isinstance(
+            d, email.errors.MultipartInvariantViolationDefect)]
+        if parent is not None:
+            if parent.get_content_type() == 'multipart/digest':
+                msg.set_default_type('message/rfc822')
+
+        if msg.get_content_type() == 'message/delivery-status':
+            raise _FallBack()
+        elif msg.get_content_maintype() == 'message':
+            msg.attach(self._parse_part(msg))
+        elif msg.get_content_maintype() == 'multipart':
+            boundary = msg.get_boundary()
+            if boundary is None:
+                msg.defects.append(email.errors.NoBoundaryInMultipartDefect())
+                self._set_lazy(msg)
+            else:
+                self._parse_multipart(msg, boundary)
+        else:
+            self._set_lazy(msg)
+        return msg
+
+    def _set_lazy(self, msg):
+        start = self.scanner.pos
+        end = self.scanner.skip()
+        msg._lazy = (self.fd, self.base + start, self.base + end)
+
+    def _parse_multipart(self, msg, boundary):
+        # This mirrors the logic of email.feedparser, see there for details
+        scanner = self.scanner
+        boundaryre = re.compile(
+            '(?P<sep>' + re.escape('--' + boundary) +
+            r')(?P<end>--)?(?P<ws>[ \t]*)(?P<linesep>\r\n|\r|\n)?$')
+        capturing_preamble = True
+        preamble = []
+        linesep = False
+        while True:
+            line = scanner.readline()
+            if not line:
+                break
+            mo = boundaryre.match(line)
+            if not mo:
+                preamble.append(line)
+                continue
+            if mo.group('end'):
+                linesep = mo.group('linesep')
+                break
+            if capturing_preamble:
+                if preamble:
+                    preamble[-1] = NLCRE_eol.sub('', preamble[-1])
+                    msg.preamble = ''.join(preamble)
+                capturing_preamble = False
+            while True:
+                line = scanner.peekline()
+                if not (line and boundaryre.match(line)):
+                    break
+                scanner.readline()
+
+            scanner.matchers.append(boundaryre.match)
+            part = self._parse_part(msg)
+            scanner.matchers.pop()
+            msg.attach(part)
+
+            # The newline preceding a boundary belongs to the boundary,
+            # which email.parser strips from the innermost, last part.
+            while (part.get_content_maintype() == 'message' and
+                    isinstance(part._payload, list)):
+                part = part._payload[-1]
+            if part.get_content_maintype() == 'multipart':
+                if part.epilogue == '':
+                    part.epilogue = None
+                elif part.epilogue is not None:
+                    part.epilogue = NLCRE_eol.sub('', part.epilogue)
+            elif part._lazy is not None:
+                fd, start, end = part._lazy
+                end -= scanner.eol_length(end - self.base)
+                part._lazy = (fd, start, max(start, end))
+            elif isinstance(part._payload, basestring):
+                part._payload = NLCRE_eol.sub('', part._payload)
+
+        if capturing_preamble:
+            msg.defects.append(email.errors.StartBoundaryNotFoundDefect())
+            msg.set_payload(''.join(preamble))
+            msg.epilogue = ''
+            while scanner.readline():
+                pass
+            return
+
+        epilogue = [''] if linesep else []
+        while True:
+            line = scanner.readline()
+            if not line:
+                break
+            epilogue.append(line)
+        if epilogue:
+            bolmo = NLCRE_bol.match(epilogue[0])
+            if bolmo:
+                epilogue[0] = epilogue[0][len(bolmo.group(0)):]
+        msg.epilogue = ''.join(epilogue)
+
+
+if __name__ == "__main__":
+    import doctest
+    import sys
+    result = doctest.testmod(optionflags=doctest.ELLIPSIS)
+    print '%s' % (result, )
+    if result.failed:
+        sys.exit(1)
@@ -1,6 +1,8 @@
 import errno
 import mailbox
+import mmap
 import os
+import struct
 import threading
 
 import mailpile.mailboxes
@@ -10,6 +12,77 @@ from mailpile.mailboxes import MBX_ID_LEN, NoSuchMailboxError
 from mailpile.util import *
 
 
+class PackedToc(object):
+    """
+    A compact, dict-like mbox table of contents. Keys are consecutive
+    integers, values are (start, stop) tuples packed into a bytearray as
+    pairs of 64-bit unsigned integers, so offsets past 2GB work even
+    where a C long is only 32 bits wide.
+
+    >>> toc = PackedToc()
+    >>> toc[0] = (0, 10); toc[1] = (11, 20); toc[2] = (21, 3 << 32)
+    >>> del toc[1]
+    >>> (len(toc), toc.keys(), toc[2], 1 in toc)
+    (2, [0, 2], (21, 12884901888), False)
+    """
+    ENTRY = struct.Struct('=QQ')
+
+    def __init__(self):
+        self.packed = bytearray()
+        self.deleted = set()
+
+    def _count(self):
+        return len(self.packed) // self.ENTRY.size
+
+    def __len__(self):
+        return self._count() - len(self.deleted)
+
+    def __contains__(self, key):
+        return (0 <= key < self._count() and key not in self.deleted)
+
+    def __getitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        return self.ENTRY.unpack_from(self.packed, key * self.ENTRY.size)
+
+    def __setitem__(self, key, value):
+        start, stop = value
+        if key < 0:
+            raise KeyError(key)
+        while key > self._count():
+            self.deleted.add(self._count())
+            self.packed.extend(self.ENTRY.pack(0, 0))
+        if key == self._count():
+            self.packed.extend(self.ENTRY.pack(start, stop))
+        else:
+            self.ENTRY.pack_into(self.packed, key * self.ENTRY.size,
+                                 start, stop)
+        self.deleted.discard(key)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.deleted.add(key)
+
+    def get(self, key, default=None):
+        return self[key] if (key in self) else default
+
+    def iterkeys(self):
+        deleted = self.deleted
+        return (k for k in xrange(0, self._count()) if k not in deleted)
+
+    __iter__ = iterkeys
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def iteritems(self):
+        return ((k, self[k]) for k in self.iterkeys())
+
+    def items(self):
+        return list(self.iteritems())
+
+
 class MailpileMailbox(mailbox.mbox):
     """A mbox class that supports pickling and a few mailpile specifics."""
 
@@ -76,11 +149,72 @@ class MailpileMailbox(mailbox.mbox):
                 del odict[dk]
         return odict
 
+    def _appended_only(self, cur_length):
+        # If the mailbox has only grown and the last message we know about
+        # still starts where it did, we assume new mail was appended and
+        # we only need to rescan from that message onwards.
+        if cur_length <= self._file_length or not self._toc:
+            return None
+        last_key = self._next_key - 1
+        if last_key not in self._toc:
+            return None
+        start = self._toc[last_key][0]
+        try:
+            if self.get_msg_cs80b(start, 80) != self._last_cs80b:
+                return None
+        except IOError:
+            return None
+        return last_key
+
+    def _add_toc(self, start, stop):
+        self._toc[self._next_key] = (start, stop)
+        self._next_key += 1
+
+    def _scan_toc_readline(self, fd, offset):
+        fd.seek(offset)
+        start = None
+        while True:
+            line_pos = fd.tell()
+            line = fd.readline()
+            if line.startswith('From '):
+                if start is not None:
+                    len_nl = ('\r' == line[-2]) and 2 or 1
+                    self._add_toc(start, line_pos - len_nl)
+                start = line_pos
+            elif line == '':
+                if (start is not None) and (start != line_pos):
+                    self._add_toc(start, line_pos)
+                break
+
+    def _scan_toc_mmap(self, fd, offset, length):
+        # This does the same thing as _scan_toc_readline, but lets mmap
+        # search for message boundaries instead of looping over lines.
+        buf = mmap.mmap(fd.fileno(), length, access=mmap.ACCESS_READ)
+        try:
+            start = None
+            if buf[offset:offset + 5] == 'From ':
+                line_pos = offset
+            else:
+                line_pos = buf.find('\nFrom ', offset)
+                line_pos = -1 if (line_pos < 0) else line_pos + 1
+            while line_pos >= 0:
+                if start is not None:
+                    eol = buf.find('\n', line_pos)
+                    crlf = (buf[eol - 1] == '\r') if (eol > 0) else (
+                        buf[length - 2:length - 1] == '\r')
+                    self._add_toc(start, line_pos - (2 if crlf else 1))
+                start = line_pos
+                line_pos = buf.find('\nFrom ', line_pos)
+                line_pos = -1 if (line_pos < 0) else line_pos + 1
+            if (start is not None) and (start != length):
+                self._add_toc(start, length)
+        finally:
+            buf.close()
+
     def update_toc(self):
         with self._lock:
             fd = self._file
 
-            # FIXME: Should also check the mtime.
             fd.seek(0, 2)
             cur_length = fd.tell()
             cur_mtime = os.path.getmtime(self._path)
@@ -88,30 +222,39 @@ class MailpileMailbox(mailbox.mbox):
                 if (self._file_length == cur_length and
                         self._mtime == cur_mtime):
                     return
+                resume_key = self._appended_only(cur_length)
             except (NameError, AttributeError):
-                pass
+                resume_key = None
 
-            fd.seek(0)
-            self._next_key = 0
-            self._toc = {}
-            start = None
-            while True:
-                line_pos = fd.tell()
-                line = fd.readline()
-                if line.startswith('From '):
-                    if start is not None:
-                        len_nl = ('\r' == line[-2]) and 2 or 1
-                        self._toc[self._next_key] = (start, line_pos - len_nl)
-                        self._next_key += 1
-                    start = line_pos
-                elif line == '':
-                    if (start is not None) and (start != line_pos):
-                        self._toc[self._next_key] = (start, line_pos)
-                        self._next_key += 1
-                    break
-
-            self._file_length = fd.tell()
+            if resume_key is not None:
+                # Rescan the last known message, plus whatever follows.
+                offset = self._toc[resume_key][0]
+                del self._toc[resume_key]
+                self._next_key = resume_key
+            else:
+                offset = 0
+                self._next_key = 0
+                self._toc = PackedToc()
+            next_key = self._next_key
+            try:
+                self._scan_toc_mmap(fd, offset, cur_length)
+            except (EnvironmentError, ValueError, OverflowError):
+                # Can't mmap (empty file, file too large for a 32-bit
+                # address space, ...), fall back to reading lines. The
+                # mmap scan may have failed partway, so first forget
+                # whatever it found to avoid adding messages twice.
+                for key in xrange(next_key, self._next_key):
+                    if key in self._toc:
+                        del self._toc[key]
+                self._next_key = next_key
+                self._scan_toc_readline(fd, offset)
+
+            self._file_length = cur_length
             self._mtime = cur_mtime
+            self._last_cs80b = None
+            if self._toc:
+                last_start = self._toc[self._next_key - 1][0]
+                self._last_cs80b = self.get_msg_cs80b(last_start, 80)
         self.save(None)
 
     def save(self, session=None, to=None, pickler=None):
@@ -180,3 +323,12 @@ class MailpileMailbox(mailbox.mbox):
 
 
 mailpile.mailboxes.register(90, MailpileMailbox)
+
+
+if __name__ == "__main__":
+    import doctest
+    import sys
+    result = doctest.testmod()
+    print '%s' % (result, )
+    if result.failed:
+        sys.exit(1)
@@ -32,6 +32,7 @@ from mailpile.crypto.mime import UnwrapMimeCrypto, MessageAsString
 from mailpile.crypto.state import EncryptionInfo, SignatureInfo
 from mailpile.i18n import gettext as _
 from mailpile.i18n import ngettext as _n
+from mailpile.lazy_mime import LazyParser
 from mailpile.mail_generator import Generator
 from mailpile.vcard import AddressInfo
 
@@ -93,10 +94,13 @@ def ClearParseCache(cache_id=None, pgpmime=False, full=False):
 
 
 def ParseMessage(fd, cache_id=None, update_cache=False,
-                     pgpmime=True, config=None):
+                     pgpmime=True, config=None, lazy=False):
     global GLOBAL_PARSE_CACHE
     if not GnuPG:
         pgpmime = False
+    if cache_id is not None:
+        # Lazily parsed messages keep reading from fd, so are not cached
+        lazy = False
 
     if cache_id is not None and not update_cache:
         with GLOBAL_PARSE_CACHE_LOCK:
@@ -107,7 +111,8 @@ def ParseMessage(fd, cache_id=None, update_cache=False,
     if pgpmime:
         message = ParseMessage(fd, cache_id=cache_id,
                                pgpmime=False,
-                               config=config)
+                               config=config,
+                               lazy=lazy)
         if message is None:
             return None
         if cache_id is not None:
@@ -127,7 +132,10 @@ def ParseMessage(fd, cache_id=None, update_cache=False,
         except (TypeError, AssertionError):
             return None
 
-        message = email.parser.Parser().parse(fd)
+        if lazy:
+            message = LazyParser().parse(fd)
+        else:
+            message = email.parser.Parser().parse(fd)
         msi = message.signature_info = SignatureInfo(bubbly=False)
         mei = message.encryption_info = EncryptionInfo(bubbly=False)
         for part in message.walk():
@@ -593,6 +593,23 @@ class PluginManager(object):
             raise PluginError('Already registered: %s' % term)
         self.SEARCH_TERMS[term] = function
 
+    SEARCH_FILTERS = {}
+
+    def get_search_filter(self, term, default=None):
+        self._compat_check(strict=False)
+        return self.SEARCH_FILTERS.get(term, default)
+
+    def register_search_filter(self, term, function):
+        """
+        Register a function which checks a search term against a set of
+        candidate messages, returning the ones which match. This is used
+        instead of the search term itself when there are few candidates.
+        """
+        self._compat_check()
+        if term in self.SEARCH_FILTERS:
+            raise PluginError('Already registered: %s' % term)
+        self.SEARCH_FILTERS[term] = function
+
 
     ##[ Pluggable keyword filters ]###########################################
 
@@ -1,6 +1,7 @@
 import time
 import datetime
 
+from mailpile.bitmap import Bitmap
 from mailpile.plugins import PluginManager
 from mailpile.i18n import gettext as _
 from mailpile.i18n import ngettext as _n
@@ -47,29 +48,34 @@ _date_offsets = {
 }
 
 
+def _date_range(term):
+    word = term.split(':', 1)[1].lower()
+    if '..' in term:
+        start, end = word.split('..')
+    else:
+        start = end = word
+
+    if start in _date_offsets:
+        start = _mk_date(time.time() - _date_offsets[start]*24*3600)
+    if end in _date_offsets:
+        end = _mk_date(time.time() - _date_offsets[end]*24*3600)
+
+    start = [int(p) for p in start.split('-')][:3]
+    end = [int(p) for p in end.split('-')[:3]]
+    while len(start) < 3:
+        start.append(1)
+    if len(end) == 1:
+        end.extend([12, 31])
+    elif len(end) == 2:
+        end.append(31)
+    if not start <= end:
+        raise ValueError()
+    return start, end
+
+
 def search(config, idx, term, hits):
     try:
-        word = term.split(':', 1)[1].lower()
-        if '..' in term:
-            start, end = word.split('..')
-        else:
-            start = end = word
-
-        if start in _date_offsets:
-            start = _mk_date(time.time() - _date_offsets[start]*24*3600)
-        if end in _date_offsets:
-            end = _mk_date(time.time() - _date_offsets[end]*24*3600)
-
-        start = [int(p) for p in start.split('-')][:3]
-        end = [int(p) for p in end.split('-')[:3]]
-        while len(start) < 3:
-            start.append(1)
-        if len(end) == 1:
-            end.extend([12, 31])
-        elif len(end) == 2:
-            end.append(31)
-        if not start <= end:
-            raise ValueError()
+        start, end = _date_range(term)
 
         terms = []
         while start <= end:
@@ -95,13 +101,35 @@ def search(config, idx, term, hits):
             start[2] += 1
             _adjust(start)
 
-        rt = []
+        rt = Bitmap()
         for t in terms:
-            rt.extend(hits(t))
+            rt |= hits(t)
         return rt
     except:
         raise ValueError('Invalid date range: %s' % term)
 
 
+def search_filter(config, idx, term, candidates):
+    # Checking the timestamps of a few messages is cheaper than looking
+    # up posting lists for every year, month or day in the range.
+    try:
+        start, end = _date_range(term)
+    except:
+        raise ValueError('Invalid date range: %s' % term)
+    matches = []
+    for msg_idx in candidates:
+        try:
+            msg_info = idx.get_msg_at_idx_pos(msg_idx)
+            mdate = datetime.date.fromtimestamp(
+                int(msg_info[idx.MSG_DATE], 36))
+        except (ValueError, IndexError):
+            continue
+        if start <= [mdate.year, mdate.month, mdate.day] <= end:
+            matches.append(msg_idx)
+    return matches
+
+
 _plugins.register_search_term('dates', search)
 _plugins.register_search_term('date', search)
+_plugins.register_search_filter('dates', search_filter)
+_plugins.register_search_filter('date', search_filter)
@@ -1,3 +1,4 @@
+from mailpile.bitmap import Bitmap
 from mailpile.commands import Command
 from mailpile.i18n import gettext as _
 from mailpile.i18n import ngettext as _n
@@ -13,7 +14,7 @@ _plugins = PluginManager(builtin=__file__)
 
 def search(config, idx, term, hits):
     group = config._vcards.get(term.split(':', 1)[1])
-    rt, emails = [], []
+    rt, emails = Bitmap(), []
     if group and group.kind == 'group':
         for email, attrs in group.get('EMAIL', []):
             group = config._vcards.get(email.lower(), None)
@@ -23,7 +24,7 @@ def search(config, idx, term, hits):
                 emails.append(email.lower())
     fromto = term.startswith('group:') and 'from' or 'to'
     for email in set(emails):
-        rt.extend(hits('%s:%s' % (email, fromto)))
+        rt |= hits('%s:%s' % (email, fromto))
     return rt
 
 _plugins.register_search_term('group', search)
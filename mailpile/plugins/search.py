@@ -2,6 +2,7 @@ import datetime
 import re
 import time
 
+from mailpile.bitmap import Bitmap
 from mailpile.commands import Command, SearchResults
 from mailpile.i18n import gettext as _
 from mailpile.i18n import ngettext as _n
@@ -170,9 +171,10 @@ class Search(Command):
 
             context = session.results if self.context else None
             session.results = list(idx.search(session, session.searched,
-                                              context=context).as_set())
+                                              context=context).as_bitmap())
             if session.order:
-                idx.sort_results(session, session.results, session.order)
+                session.results = idx.sorted_results(session, session.results,
+                                                     session.order)
 
         return session, idx
 
@@ -257,7 +259,8 @@ class Order(Search):
     def command(self):
         session, idx = self.session, self._idx()
         session.order = self.args and self.args[0] or None
-        idx.sort_results(session, session.results, session.order)
+        session.results = idx.sorted_results(session, session.results,
+                                             session.order)
         session.displayed = SearchResults(session, idx)
         return self._success(_('Changed sort order to %s') % session.order,
                              result=session.displayed)
@@ -445,10 +448,10 @@ def mailbox_search(config, idx, term, hits):
 
     mailboxes = [m for m in config.sys.mailbox.keys()
                  if (mbox_id == m) or word in config.sys.mailbox[m].lower()]
-    rt = []
+    rt = Bitmap()
     for mbox_id in mailboxes:
         mbox_id = FormatMbxId(mbox_id)
-        rt.extend(hits('%s:mailbox' % mbox_id))
+        rt |= hits('%s:mailbox' % mbox_id)
     return rt
 
 
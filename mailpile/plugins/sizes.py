@@ -2,6 +2,7 @@ import math
 import time
 import datetime
 
+from mailpile.bitmap import Bitmap
 from mailpile.i18n import gettext as _
 from mailpile.i18n import ngettext as _n
 from mailpile.plugins import PluginManager
@@ -77,9 +78,9 @@ def search(config, idx, term, hits):
         end = _mk_logsize(end)
         terms = ['%s:ln2sz' % sz for sz in range(start, end+1)]
 
-        rt = []
+        rt = Bitmap()
         for t in terms:
-            rt.extend(hits(t))
+            rt |= hits(t)
         return rt
     except:
         raise ValueError('Invalid size: %s' % term)
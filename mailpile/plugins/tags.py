@@ -165,7 +165,7 @@ def Slugify(tag_name, tags=None):
     return slug
 
 
-def GetTagInfo(cfg, tn, stats=False, unread=None, exclude=None, subtags=None):
+def GetTagInfo(cfg, tn, stats=False, exclude_hidden=False, subtags=None):
     tag = GetTag(cfg, tn)
     tid = tag._key
     info = {
@@ -179,22 +179,22 @@ def GetTagInfo(cfg, tn, stats=False, unread=None, exclude=None, subtags=None):
         info[k] = tag[k]
     if subtags:
         info['subtag_ids'] = [t._key for t in subtags]
-    exclude = exclude or set()
-    if stats and (unread is not None):
-        messages = (cfg.index.TAGS.get(tid, set()) - exclude)
-        stats_all = len(messages)
+    if stats:
+        stats_all, stats_new = cfg.index.get_tag_stats(
+            [tid], exclude_hidden=exclude_hidden)
         info['name'] = _(info['name'])
         info['stats'] = {
             'all': stats_all,
-            'new': len(messages & unread),
+            'new': stats_new,
             'not': len(cfg.index.INDEX) - stats_all
         }
         if subtags:
-            for subtag in subtags:
-                messages |= cfg.index.TAGS.get(subtag._key, set())
+            sum_all, sum_new = cfg.index.get_tag_stats(
+                [tid] + [t._key for t in subtags],
+                exclude_hidden=exclude_hidden)
             info['stats'].update({
-                'sum_all': len(messages),
-                'sum_new': len(messages & unread),
+                'sum_all': sum_all,
+                'sum_new': sum_new,
             })
 
     return info
@@ -545,14 +545,6 @@ class ListTags(TagCommand):
         wanted.extend([t.lower() for t in self.data.get('only', [])])
         unwanted.extend([t.lower() for t in self.data.get('not', [])])
 
-        unread_messages = set()
-        for tag in self.session.config.get_tags(type='unread'):
-            unread_messages |= idx.TAGS.get(tag._key, set())
-
-        excluded_messages = set()
-        for tag in self.session.config.get_tags(flag_hides=True):
-            excluded_messages |= idx.TAGS.get(tag._key, set())
-
         mode = search.get('mode', 'default')
         if 'mode' in search:
             del search['mode']
@@ -582,15 +574,9 @@ class ListTags(TagCommand):
                 subtags = None
 
             # Get tag info (how depends on whether this is a hiding tag)
-            if tag.flag_hides:
-                info = GetTagInfo(self.session.config, tid, stats=True,
-                                  unread=unread_messages,
-                                  subtags=subtags)
-            else:
-                info = GetTagInfo(self.session.config, tid, stats=True,
-                                  unread=unread_messages,
-                                  exclude=excluded_messages,
-                                  subtags=subtags)
+            info = GetTagInfo(self.session.config, tid, stats=True,
+                              exclude_hidden=(not tag.flag_hides),
+                              subtags=subtags)
 
             # This expands out the full tree
             if subtags and recursion == 0:
@@ -1,11 +1,21 @@
+import binascii
+import hashlib
+import heapq
+import mmap
 import os
 import sys
 import random
+import struct
 import threading
 import traceback
 import time
+from array import array
 
 import mailpile.util
+import mailpile.crypto.blocks
+from mailpile.bitmap import Bitmap, AsBitmap
+from mailpile.crypto.blocks import BlockDecryptingReader, BlockEncryptingWriter
+from mailpile.crypto.blocks import IsBlockEncrypted
 from mailpile.crypto.streamer import EncryptingStreamer
 from mailpile.i18n import gettext as _
 from mailpile.i18n import ngettext as _n
@@ -19,9 +29,21 @@ GLOBAL_OPTIMIZE_LOCK = PListLock()
 
 GLOBAL_GPL_LOCK = PListRLock()
 GLOBAL_GPL = None
+GLOBAL_GPL_REMOVED = {}
+
+GLOBAL_PENDING_LOCK = PListLock()
+GLOBAL_PENDING = {}
+GLOBAL_PENDING_MIDS = set()
+GLOBAL_PENDING_SINCE = None
+
+GLOBAL_SEGMENTS_LOCK = PListLock()
+GLOBAL_SEGMENTS = {}
 
 PLC_CACHE_LOCK = PListLock()
-PLC_CACHE = {}
+PLC_EVICTED = {}
+
+PLC_LISTING_LOCK = PListLock()
+PLC_LISTINGS = {}
 
 TIMERS = {
     'render': 0,
@@ -29,45 +51,222 @@ TIMERS = {
     'save_count': 0,
     'load': 0,
     'load_count': 0,
+    'writeback_count': 0,
 }
 
 
-def PLC_CACHE_FlushAndClean(session, min_changes=0, keep=5, runtime=None):
+def _ints(values):
+    """Convert message IDs (base36 strings or ints) to ints."""
+    return [(int(v, 36) if isinstance(v, basestring) else v) for v in values]
+
+
+def EncodePostings(values):
+    """
+    Encode a sorted sequence of message IDs as a compact string: the
+    deltas between consecutive IDs are packed into an array of the
+    narrowest unsigned type that fits, and base64 encoded. Very short
+    lists are written in the older (and then smaller) tab-separated
+    base36 format instead.
+
+    >>> ids = range(0, 2000, 100)
+    >>> EncodePostings(ids)
+    '*BAGRkZGRkZGRkZGRkZGRkZGRkZGQ'
+    >>> list(DecodePostings(EncodePostings(ids))) == ids
+    True
+    >>> EncodePostings([1, 300])
+    '1\\t8C'
+    """
+    deltas, last = [], 0
+    for v in values:
+        deltas.append(v - last)
+        last = v
+    biggest = max(deltas or [0])
+    tc = (biggest < 0x100) and 'B' or (biggest < 0x10000) and 'H' or 'I'
+    packed = array(tc, deltas)
+    if sys.byteorder != 'little':
+        packed.byteswap()
+    encoded = '*%s%s' % (tc, binascii.b2a_base64(packed.tostring()
+                                                 ).strip().rstrip('='))
+    if len(deltas) < 16:
+        legacy = '\t'.join(b36(v) for v in values)
+        if len(legacy) < len(encoded):
+            return legacy
+    return encoded
+
+
+def DecodePostings(data):
+    """Decode the output of EncodePostings to a sorted array of ints."""
+    if data[:1] != '*':
+        return array('l', sorted(set(int(v, 36) for v in data.split('\t'))))
+    packed, data = array(data[1]), data[2:]
+    packed.fromstring(binascii.a2b_base64(data + '=' * (-len(data) % 4)))
+    if sys.byteorder != 'little':
+        packed.byteswap()
+    values, total = array('l', packed), 0
+    for i in xrange(0, len(values)):
+        total += values[i]
+        values[i] = total
+    return values
+
+
+def CountPostings(data):
+    """
+    Count the message IDs in the output of EncodePostings, without
+    decoding it.
+
+    >>> CountPostings(EncodePostings(range(0, 2000, 100)))
+    20
+    >>> CountPostings(EncodePostings([1, 300])), CountPostings('')
+    (2, 0)
+    """
+    if not data:
+        return 0
+    if data[:1] != '*':
+        return data.count('\t') + 1
+    return ((len(data) - 2) * 3 // 4) // array(data[1]).itemsize
+
+
+def _PLC_CACHE_WriteBack(sig, plc):
+    try:
+        if plc.changes:
+            plc.save()
+            TIMERS['writeback_count'] += 1
+    finally:
+        with PLC_CACHE_LOCK:
+            if PLC_EVICTED.get(sig) is plc:
+                del PLC_EVICTED[sig]
+
+
+def _PLC_CACHE_Evicted(sig, plc):
+    # Dirty containers are written back when they fall out of the cache.
+    # Until that is done, Load() must return this very object instead of
+    # reading stale data from disk.
+    #
+    # The writing is queued on the scan worker, so searches and HTTP
+    # requests do not stall on disk (or encryption). If we already are
+    # the scan worker, we just get on with it, so evicted containers
+    # cannot pile up in memory during a long scan.
+    if plc.changes:
+        with PLC_CACHE_LOCK:
+            PLC_EVICTED[sig] = plc
+        worker = plc.config.scan_worker
+        if worker is threading.current_thread():
+            _PLC_CACHE_WriteBack(sig, plc)
+        else:
+            worker.add_unique_task(None, 'Write back PLC %s' % sig,
+                                   lambda: _PLC_CACHE_WriteBack(sig, plc))
+
+
+PLC_CACHE = LRUCache(max_items=0, max_bytes=32 * 1024 * 1024,
+                     sizer=lambda plc: plc.estimated_size(),
+                     on_evict=_PLC_CACHE_Evicted)
+
+
+def PLC_CACHE_Stats():
+    stats = PLC_CACHE.stats()
+    stats.update({
+        'loads': TIMERS['load_count'],
+        'writebacks': TIMERS['writeback_count'],
+    })
+    return stats
+
+
+def PLC_CACHE_FlushAndClean(session, min_changes=0, keep=None, runtime=None):
+    """
+    Save containers with more than min_changes unsaved changes, or which
+    have not been used for a while. Memory use is bounded by the cache
+    itself; if keep is set, all but the keep most recently used
+    containers are evicted as well.
+    """
     def save(plc):
         job_name = _('Save PLC %s') % plc.sig
         session.ui.mark(job_name)
         session.config.save_worker.do(session, job_name, plc.save)
         play_nice_with_threads()
 
-    def remove(ts, plc):
-        with PLC_CACHE_LOCK:
-            if plc.sig in PLC_CACHE and ts == PLC_CACHE[plc.sig][0]:
-               del PLC_CACHE[plc.sig]
-
     startt = int(time.time())
-    expire = startt - max(30, 300 - len(PLC_CACHE))
     savets = startt - 15
 
     def time_up():
         return (runtime and startt + runtime < time.time())
 
-    with PLC_CACHE_LOCK:
-        plc_cache = sorted(PLC_CACHE.values())
-
-    for ts, plc in plc_cache[:-keep]:
-        if plc.changes:
+    plc_cache = PLC_CACHE.items()
+    for sig, plc in plc_cache:
+        if (plc.changes > min_changes) or (plc.changes and
+                                           plc.last_used < savets):
             save(plc)
-        remove(ts, plc)
         if time_up():
             return
 
-    for ts, plc in plc_cache[-keep:]:
-        if (plc.changes > min_changes) or (plc.changes and ts < savets):
-            save(plc)
-        if ts < expire:
-            remove(ts, plc)
-        if time_up():
-            return
+    if keep is not None:
+        for sig, plc in plc_cache[:max(0, len(plc_cache) - keep)]:
+            with PLC_CACHE_LOCK:
+                try:
+                    del PLC_CACHE[sig]
+                except KeyError:
+                    continue
+            _PLC_CACHE_Evicted(sig, plc)
+
+        # Anything still waiting for a writeback gets saved now.
+        with PLC_CACHE_LOCK:
+            evicted = PLC_EVICTED.items()
+        for sig, plc in evicted:
+            _PLC_CACHE_WriteBack(sig, plc)
+
+
+class BloomFilter(object):
+    """
+    A Bloom filter: a compact set of strings which may give false
+    positives, but never false negatives.
+
+    >>> bf = BloomFilter.ForItems(['hello', 'world'])
+    >>> ('hello' in bf, 'world' in bf, 'nope' in bf)
+    (True, True, False)
+    >>> BloomFilter.FromString(bf.to_string()).bits == bf.bits
+    True
+    """
+    MAGIC = 'MPBF'
+    HEADER = struct.Struct('<4sII')
+    BITS_PER_ITEM = 10
+    HASHES = 7
+
+    def __init__(self, nbits, hashes=HASHES, bits=None):
+        self.nbits = max(64, nbits)
+        self.hashes = hashes
+        self.bits = bits or bytearray((self.nbits + 7) // 8)
+
+    @classmethod
+    def ForItems(cls, items):
+        items = list(items)
+        bf = cls(len(items) * cls.BITS_PER_ITEM)
+        for item in items:
+            bf.add(item)
+        return bf
+
+    @classmethod
+    def FromString(cls, data):
+        magic, nbits, hashes = cls.HEADER.unpack_from(data)
+        if magic != cls.MAGIC:
+            raise ValueError('Not a Bloom filter')
+        return cls(nbits, hashes, bytearray(data[cls.HEADER.size:]))
+
+    def to_string(self):
+        return (self.HEADER.pack(self.MAGIC, self.nbits, self.hashes) +
+                str(self.bits))
+
+    def _positions(self, item):
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(str(item)).digest())
+        return [(h1 + i * h2) % self.nbits for i in xrange(self.hashes)]
+
+    def add(self, item):
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= (1 << (pos & 7))
+
+    def __contains__(self, item):
+        for pos in self._positions(item):
+            if not self.bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
 
 
 class PostingListContainer(object):
@@ -76,16 +275,36 @@ class PostingListContainer(object):
     MAX_ITEMS = int((60 * 1024) / 5)  # Target size of about 60KB
     MAX_HASH_LEN = 24
 
+    @classmethod
+    def MightContain(cls, session, sig):
+        """
+        Check whether a search term may be found in our containers, using
+        in-memory data or the container's Bloom filter. A False result
+        means there is no need to load (or decrypt) anything.
+        """
+        fn, csig = cls._GetFilenameAndSig(session.config, sig)
+        with PLC_CACHE_LOCK:
+            plc = PLC_CACHE.peek(csig) or PLC_EVICTED.get(csig)
+        if plc is not None:
+            return (plc.get(sig) is not None)
+        if csig not in cls._Listing(session.config, csig):
+            return False
+        bloom = cls._Bloom(session.config, csig)
+        return (bloom is None) or (sig in bloom)
+
     @classmethod
     def Load(cls, session, sig, uncached_cb=None):
         fn, sig = cls._GetFilenameAndSig(session.config, sig)
-        found = plc = None
         with PLC_CACHE_LOCK:
-            if sig in PLC_CACHE:
-                found = PLC_CACHE[sig][0] = int(time.time())
-            else:
-                PLC_CACHE[sig] = [int(time.time()), cls(session, sig)]
-            plc = PLC_CACHE[sig][1]
+            PLC_CACHE.max_bytes = (session.config.sys.postinglist_cache_mb
+                                   * 1024 * 1024)
+            plc = found = PLC_CACHE.get(sig)
+            if plc is None:
+                plc = PLC_EVICTED.get(sig) or cls(session, sig)
+            plc.last_used = int(time.time())
+        # Storing it again accounts for any growth since it was cached;
+        # this may evict (and write back) other containers.
+        PLC_CACHE[sig] = plc
         if uncached_cb and not found:
             uncached_cb()
         return plc
@@ -97,14 +316,34 @@ class PostingListContainer(object):
         self.lock = PListRLock()
         self.sig = sig
         self.fd = fd
-        self.words = {sig: set()}
+        self.words = {sig: array('l')}
+        self.nbytes = self._entry_size(sig, 0)
 
         self.changes = 0
+        self.last_used = int(time.time())
         self._load()
 
     def get(self, sig, default=None):
         return self.words.get(sig, default)
 
+    @classmethod
+    def _entry_size(cls, sig, count):
+        # A rough estimate of the RAM used by a dict entry and its array
+        return 64 + len(sig) + 8 * count
+
+    def _resized(self, sig, old_count):
+        # Keep a running estimate of our size, for the PLC_CACHE.
+        if old_count is not None:
+            self.nbytes -= self._entry_size(sig, old_count)
+        if sig in self.words:
+            self.nbytes += self._entry_size(sig, len(self.words[sig]))
+
+    def _count(self, sig):
+        return len(self.words[sig]) if (sig in self.words) else None
+
+    def estimated_size(self):
+        return self.nbytes
+
     def add(self, *args, **kwargs):
         with self.lock:
             return self._unlocked_add(*args, **kwargs)
@@ -134,10 +373,11 @@ class PostingListContainer(object):
         with self.lock:
             # Optimizing for fast loads, so deletion only happens on save.
             del_set = self._deleted_set()
-            output = '\n'.join('\t'.join(l) for l
-                               in ([sig] + [str(v) for v in (values-del_set)]
-                                   for sig, values in self.words.iteritems())
-                               if len(l) > 1)
+            output = '\n'.join('%s\t%s' % (sig, EncodePostings(
+                                    [v for v in values if v not in del_set]
+                                    if del_set else values))
+                               for sig, values in self.words.iteritems()
+                               if values)
             t.append(time.time())
 
             if not output:
@@ -145,6 +385,7 @@ class PostingListContainer(object):
                     os.remove(outfile)
                 except OSError:
                     pass
+                self._Listed(self.config, self.sig, None)
             elif self.config.prefs.encrypt_index and encryption_key:
                 subj = self.config.mailpile_path(outfile)
                 with EncryptingStreamer(encryption_key,
@@ -158,6 +399,10 @@ class PostingListContainer(object):
                 with open(outfile, 'wb') as fd:
                     fd.write(output)
 
+            if output:
+                self._SaveBloom(outfile, BloomFilter.ForItems(
+                    sig for sig, values in self.words.iteritems() if values))
+
             t.append(time.time())
             self.changes = 0
 
@@ -191,12 +436,15 @@ class PostingListContainer(object):
                     fn = self._SaveFile(self.config, nsig)
                     if not os.path.exists(fn):
                         open(fn, 'w').close()
+                        self._Listed(self.config, nsig, False)
 
                     plc = PostingListContainer(self.session, nsig)
                     for sig in list(self.words.keys()):
                         if sig.startswith(nsig):
                             plc.add(sig, self.words[sig])
+                            count = self._count(sig)
                             del self.words[sig]
+                            self._resized(sig, count)
                     splits.append(plc)
                 except (OSError, IOError):
                     pass
@@ -229,48 +477,160 @@ class PostingListContainer(object):
     def _unlocked_parse_lines(self, lines):
         for line in lines:
             words = line.strip().split('\t')
-            if len(words) > 1:
-                self._unlocked_add(words[0], words[1:])
+            if len(words) == 2 and words[1][:1] == '*':
+                values = DecodePostings(words[1])
+            elif len(words) > 1:
+                # Legacy format: tab-separated base36 message IDs
+                values = words[1:]
+            else:
+                continue
+            if words[0] in self.words:
+                self._unlocked_add(words[0], values)
+            else:
+                if not isinstance(values, array):
+                    values = array('l', sorted(set(_ints(values))))
+                self.words[words[0]] = values
+                self._resized(words[0], None)
+                self.changes += len(values)
 
     def _unlocked_add(self, sig, values):
-        wset = set(values)
+        wset = set(_ints(values))
         self.changes += len(wset)
+        count = self._count(sig)
         if sig in self.words:
-            self.words[sig] |= wset
-        else:
-            self.words[sig] = wset
+            wset |= set(self.words[sig])
+        self.words[sig] = array('l', sorted(wset))
+        self._resized(sig, count)
 
     def _unlocked_remove(self, sig, values):
-        wset = set(values)
+        wset = set(_ints(values))
         self.changes += len(wset)
         if sig in self.words:
-            self.words[sig] -= wset
+            count = self._count(sig)
+            self.words[sig] = array('l', [v for v in self.words[sig]
+                                          if v not in wset])
             if not self.words[sig]:
                 del self.words[sig]
+            self._resized(sig, count)
 
     @classmethod
     def _SaveFile(cls, config, sig):
         return os.path.join(config.postinglist_dir(sig), sig)
 
+    # A directory listed within this many seconds of being modified gets
+    # listed once more later on, in case its mtime had not ticked yet.
+    LISTING_MTIME_SLACK = 2
+
     @classmethod
-    def _GetFilenameAndSig(cls, config, sig):
-        """Find and the closest matching posting list container file"""
-        sig = sig[:cls.MAX_HASH_LEN]
-        while len(sig) > 0:
-            fn = cls._SaveFile(config, sig)
-            try:
-                if os.path.exists(fn):
-                    return (fn, sig)
-            except (IOError, OSError):
-                pass
+    def _Listing(cls, config, sig):
+        # All the containers which could hold sig live in one directory;
+        # we list it and then keep track of our own changes, but list it
+        # again whenever the directory's mtime says something else (such
+        # as another process) has been changing it. The listing maps
+        # container sigs to their Bloom filters, which are loaded on
+        # demand (None), or False if there is no filter.
+        dn = config.postinglist_dir(sig)
+        try:
+            mtime = os.stat(dn).st_mtime
+        except OSError:
+            mtime = None
+        now = time.time()
+
+        def current(cached):
+            if cached is None or cached[0] != mtime:
+                return False
+            listed = cached[1]
+            return (mtime is not None and
+                    (listed - mtime >= cls.LISTING_MTIME_SLACK or
+                     now - listed < cls.LISTING_MTIME_SLACK))
+
+        cached = PLC_LISTINGS.get(dn)
+        if not current(cached):
+            with PLC_LISTING_LOCK:
+                cached = PLC_LISTINGS.get(dn)
+                if not current(cached):
+                    files = set(os.listdir(dn))
+                    listing = dict((fn, None if (fn + '.bf' in files)
+                                    else False)
+                                   for fn in files if '.' not in fn)
+                    cached = PLC_LISTINGS[dn] = (mtime, now, listing)
+        return cached[2]
 
-            if len(sig) > 1:
-                sig = sig[:-1]
+    @classmethod
+    def _Listed(cls, config, sig, bloom):
+        listing = cls._Listing(config, sig)
+        with PLC_LISTING_LOCK:
+            if bloom is None:
+                listing.pop(sig, None)
+                safe_remove(cls._SaveFile(config, sig) + '.bf')
             else:
-                return (fn, sig)
+                listing[sig] = bloom
 
-        # Not reached
-        return (None, None)
+    @classmethod
+    def _BloomKey(cls, config):
+        # Bloom filters reveal which terms a container holds, so they are
+        # encrypted if the containers are. False means we can't do that,
+        # in which case we don't keep any filters at all.
+        key = config.prefs.encrypt_index and config.master_key
+        if not key:
+            return None
+        return key if mailpile.crypto.blocks.AVAILABLE else False
+
+    @classmethod
+    def _Bloom(cls, config, sig):
+        listing = cls._Listing(config, sig)
+        bloom = listing.get(sig, False)
+        if bloom is None:
+            fn = cls._SaveFile(config, sig) + '.bf'
+            key = cls._BloomKey(config)
+            try:
+                if key and IsBlockEncrypted(fn):
+                    blocks = BlockDecryptingReader(fn, key)
+                    try:
+                        bloom = BloomFilter.FromString(''.join(blocks))
+                    finally:
+                        blocks.close()
+                elif key is None:
+                    with open(fn, 'rb') as fd:
+                        bloom = BloomFilter.FromString(fd.read())
+                else:
+                    # Unprotected filters of an encrypted index are ignored
+                    bloom = False
+            except (IOError, OSError, ValueError, struct.error):
+                bloom = False
+            with PLC_LISTING_LOCK:
+                listing[sig] = bloom
+        return bloom or None
+
+    def _SaveBloom(self, outfile, bloom):
+        key = self._BloomKey(self.config)
+        if key is False:
+            safe_remove(outfile + '.bf')
+            bloom = False
+        else:
+            try:
+                fd = open(outfile + '.bf.tmp', 'wb')
+                if key:
+                    fd = BlockEncryptingWriter(fd, key)
+                with fd:
+                    fd.write(bloom.to_string())
+                if os.path.exists(outfile + '.bf'):
+                    os.remove(outfile + '.bf')
+                os.rename(outfile + '.bf.tmp', outfile + '.bf')
+            except (IOError, OSError):
+                # A stale filter could hide new terms, so drop it
+                safe_remove(outfile + '.bf')
+                bloom = False
+        self._Listed(self.config, self.sig, bloom)
+
+    @classmethod
+    def _GetFilenameAndSig(cls, config, sig):
+        """Find and the closest matching posting list container file"""
+        sig = sig[:cls.MAX_HASH_LEN]
+        listing = cls._Listing(config, sig)
+        while len(sig) > 1 and sig not in listing:
+            sig = sig[:-1]
+        return (cls._SaveFile(config, sig), sig)
 
 
 class NewPostingList(object):
@@ -291,13 +651,21 @@ class NewPostingList(object):
     def __init__(self, session, word):
         self.config = session.config
         self.session = session
+        self._plc = None
         if word:
             self.word = word
             self.sig = self._WordSig(word, self.config)
-            self.plc = PostingListContainer.Load(self.session, self.sig)
+
+    plc = property(lambda self: self._plc or self._load())
+
+    def _load(self):
+        self._plc = PostingListContainer.Load(self.session, self.sig)
+        return self._plc
 
     def hits(self):
-        return self.plc.get(self.sig) or set()
+        if not PostingListContainer.MightContain(self.session, self.sig):
+            return array('l')
+        return self.plc.get(self.sig) or array('l')
 
     def append(self, *eids):
         self.plc.add(self.sig, eids)
@@ -307,6 +675,10 @@ class NewPostingList(object):
         self.plc.remove(self.sig, eids)
         return self
 
+    def save(self):
+        self.plc.save()
+        return self
+
     @classmethod
     def _WordSig(cls, word, config):
         return strhash(word, cls.HASH_LEN,
@@ -315,6 +687,305 @@ class NewPostingList(object):
                                   config.master_key))
 
 
+class PostingSegment(object):
+    """
+    An immutable, sorted map of search term signatures to the message IDs
+    added to (and removed from) them. Segments are written once, renamed
+    into place and never modified, so readers can mmap them and search
+    them without taking any locks.
+
+    The file is a header, the encoded postings and finally a table of
+    fixed width (sig, offset, length) entries, sorted by signature. If
+    the index is encrypted, the segment is stored in a block-encrypted
+    container, so lookups only decrypt the blocks they touch.
+    """
+    MAGIC = 'MPPLSEG1'
+    HEADER = struct.Struct('<8sII')
+    ENTRY = struct.Struct('<24sII')
+    SIG_LEN = 24
+
+    def __init__(self, filename, key=None):
+        self.filename = filename
+        name = os.path.basename(filename).split('.')[0]
+        self.tier, self.first, self.last = [int(p, 16)
+                                            for p in name.split('-')]
+        if IsBlockEncrypted(filename):
+            if not key:
+                raise IOError('Segment is encrypted: %s' % filename)
+            self._data = BlockDecryptingReader(filename, key)
+        else:
+            with open(filename, 'rb') as fd:
+                self._data = mmap.mmap(fd.fileno(), 0,
+                                       access=mmap.ACCESS_READ)
+        magic, self.count, self._table = self.HEADER.unpack(
+            self._data[:self.HEADER.size])
+        if magic != self.MAGIC:
+            raise ValueError('Not a posting list segment: %s' % filename)
+        self.size = len(self._data)
+
+    @classmethod
+    def Name(cls, tier, first, last):
+        return '%2.2x-%8.8x-%8.8x.seg' % (tier, first, last)
+
+    @classmethod
+    def Key(cls, sig):
+        return str(sig)[:cls.SIG_LEN].ljust(cls.SIG_LEN, '\0')
+
+    @classmethod
+    def Write(cls, filename, entries, key=None):
+        """Write (key, adds, removes) entries, sorted by key, to a file."""
+        table, offset = [], cls.HEADER.size
+        tmpfile = filename + '.tmp'
+        fd = open(tmpfile, 'wb')
+        if key:
+            fd = BlockEncryptingWriter(fd, key)
+        with fd:
+            fd.write(cls.HEADER.pack(cls.MAGIC, 0, 0))
+            for sig_key, adds, removes in entries:
+                data = '%s %s' % (adds and EncodePostings(adds) or '',
+                                  removes and EncodePostings(removes) or '')
+                table.append(cls.ENTRY.pack(sig_key, offset, len(data)))
+                fd.write(data)
+                offset += len(data)
+            fd.write(''.join(table))
+            fd.seek(0)
+            fd.write(cls.HEADER.pack(cls.MAGIC, len(table), offset))
+        os.rename(tmpfile, filename)
+        return cls(filename, key=key)
+
+    @classmethod
+    def Decode(cls, data):
+        adds, removes = data.split(' ', 1)
+        return (adds and DecodePostings(adds) or array('l'),
+                removes and DecodePostings(removes) or array('l'))
+
+    def _entry(self, i):
+        pos = self._table + i * self.ENTRY.size
+        return self.ENTRY.unpack(self._data[pos:pos + self.ENTRY.size])
+
+    def _key_at(self, i):
+        pos = self._table + i * self.ENTRY.size
+        return self._data[pos:pos + self.SIG_LEN]
+
+    def get(self, sig):
+        """Return the encoded (adds, removes) for a sig, or None."""
+        key = self.Key(sig)
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key_at(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count:
+            found, offset, length = self._entry(lo)
+            if found == key:
+                return self._data[offset:offset + length]
+        return None
+
+    def entries(self):
+        """Iterate through the (key, encoded data) pairs in order."""
+        for i in xrange(0, self.count):
+            key, offset, length = self._entry(i)
+            yield key, self._data[offset:offset + length]
+
+
+class PostingSegments(object):
+    """
+    The set of posting list segments, in the style of a log-structured
+    merge tree. New postings are flushed from the journal to small tier 0
+    segments, and whenever a tier accumulates FANOUT segments they are
+    merged into one segment of the next tier. Each posting is therefore
+    rewritten about log(N) times, instead of every time a container of
+    posting lists changes.
+
+    Merging all the segments of a tier keeps the tiers ordered by age,
+    which is what lets deletions be recorded as tombstones in newer
+    segments. Tombstones are dropped when merging into the oldest segment.
+
+    Readers use whatever tuple of segments is current; writers replace
+    the tuple and only delete files which have been merged elsewhere.
+
+    If the index is encrypted, new segments are block-encrypted with the
+    master key; segments are only usable if that is possible.
+    """
+    FANOUT = 4
+
+    @classmethod
+    def Enabled(cls, config):
+        return (config.sys.postinglist_segments and
+                (not config.prefs.encrypt_index or
+                 (mailpile.crypto.blocks.AVAILABLE and config.master_key)))
+
+    @classmethod
+    def Get(cls, config):
+        directory = os.path.join(config.workdir, 'search', 'segments')
+        segments = GLOBAL_SEGMENTS.get(directory)
+        if segments is None:
+            with GLOBAL_SEGMENTS_LOCK:
+                if directory not in GLOBAL_SEGMENTS:
+                    GLOBAL_SEGMENTS[directory] = cls(
+                        directory, key=config.master_key)
+                segments = GLOBAL_SEGMENTS[directory]
+        segments.key = config.master_key
+        segments.encrypt = bool(config.prefs.encrypt_index)
+        return segments
+
+    def __init__(self, directory, key=None, encrypt=False):
+        self.directory = directory
+        self.key = key
+        self.encrypt = encrypt
+        self.lock = PListRLock()
+        self.segments = tuple(self._load())
+
+    def _load(self):
+        if not os.path.exists(self.directory):
+            return []
+        segments = []
+        for fn in os.listdir(self.directory):
+            path = os.path.join(self.directory, fn)
+            if fn.endswith('.seg'):
+                try:
+                    segments.append(PostingSegment(path, key=self.key))
+                except (ValueError, struct.error):
+                    safe_remove(path)
+                except (IOError, OSError):
+                    # Unreadable, maybe the wrong key: leave it alone
+                    pass
+            elif fn.endswith('.tmp'):
+                safe_remove(path)
+
+        # If we crashed during a merge, the inputs may still be around;
+        # anything covered by a merged segment is garbage.
+        segments.sort(key=lambda s: (s.first, -s.last))
+        live, last = [], 0
+        for seg in segments:
+            if seg.last > last:
+                live.append(seg)
+                last = seg.last
+            else:
+                safe_remove(seg.filename)
+        return live
+
+    def __len__(self):
+        return len(self.segments)
+
+    def apply(self, sig, values):
+        """Apply the adds and removes recorded for sig to a set or Bitmap."""
+        for seg in self.segments:
+            data = seg.get(sig)
+            if data is not None:
+                adds, removes = PostingSegment.Decode(data)
+                if removes:
+                    values.difference_update(removes)
+                values.update(adds)
+        return values
+
+    def _write(self, tier, first, last, entries):
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        fn = os.path.join(self.directory,
+                          PostingSegment.Name(tier, first, last))
+        return PostingSegment.Write(fn, entries,
+                                    key=(self.key if self.encrypt else None))
+
+    def flush(self, session, words, removed):
+        """Write a new tier 0 segment from dicts of sig -> set of IDs."""
+        with self.lock:
+            seq = (self.segments[-1].last + 1) if self.segments else 1
+            keys = sorted(set(words.keys()) | set(removed.keys()),
+                          key=PostingSegment.Key)
+            session.ui.mark(_('Writing %d keywords to search index')
+                            % len(keys))
+            seg = self._write(0, seq, seq, (
+                (PostingSegment.Key(sig),
+                 sorted(words.get(sig, [])),
+                 sorted(removed.get(sig, []))) for sig in keys))
+            self.segments = self.segments + (seg, )
+            return seg
+
+    def _choose_merge(self, force=False):
+        tiers = {}
+        for seg in self.segments:
+            tiers[seg.tier] = tiers.get(seg.tier, []) + [seg]
+        for tier in sorted(tiers.keys()):
+            if len(tiers[tier]) >= self.FANOUT:
+                return tiers[tier]
+        if force and len(self.segments) > 1:
+            return list(self.segments)
+        return []
+
+    def _merged_entries(self, inputs, bottom):
+        def tagged(age, seg):
+            for key, data in seg.entries():
+                yield key, age, data
+
+        current, adds, removes = None, set(), set()
+        for key, age, data in heapq.merge(*[tagged(age, seg) for age, seg
+                                            in enumerate(inputs)]):
+            if key != current:
+                if current is not None and (adds or removes):
+                    yield current, sorted(adds), sorted(removes)
+                current, adds, removes = key, set(), set()
+            a, r = PostingSegment.Decode(data)
+            adds.difference_update(r)
+            adds.update(a)
+            if not bottom:
+                removes.difference_update(a)
+                removes.update(r)
+        if current is not None and (adds or removes):
+            yield current, sorted(adds), sorted(removes)
+
+    def drain(self, session):
+        """Move all postings back into posting list containers."""
+        with self.lock:
+            for seg in self.segments:
+                session.ui.mark(_('Moving search index segment %s back '
+                                  'to posting lists') % seg.filename)
+                for key, data in seg.entries():
+                    sig = key.rstrip('\0')
+                    adds, removes = PostingSegment.Decode(data)
+                    plc = PostingListContainer.Load(session, sig)
+                    if removes:
+                        plc.remove(sig, removes)
+                    if adds:
+                        plc.add(sig, adds)
+                    play_nice_with_threads()
+            PLC_CACHE_FlushAndClean(session)
+            for seg in self.segments:
+                safe_remove(seg.filename)
+            self.segments = ()
+
+    def merge(self, session, force=False, runtime=None):
+        """Merge full tiers (or everything, if forced) in the background."""
+        started = time.time()
+        merged = 0
+        with self.lock:
+            while not mailpile.util.QUITTING:
+                inputs = self._choose_merge(force=force)
+                if not inputs:
+                    break
+
+                session.ui.mark(_('Merging %d search index segments')
+                                % len(inputs))
+                play_nice_with_threads()
+                bottom = (inputs[0] is self.segments[0])
+                seg = self._write(max(s.tier for s in inputs) + 1,
+                                  inputs[0].first, inputs[-1].last,
+                                  self._merged_entries(inputs, bottom))
+
+                where = list(self.segments).index(inputs[0])
+                self.segments = (self.segments[:where] + (seg, ) +
+                                 self.segments[where + len(inputs):])
+                for old in inputs:
+                    safe_remove(old.filename)
+
+                merged += 1
+                if runtime and started + runtime < time.time():
+                    break
+        return merged
+
+
 ##############################################################################
 
 class OldPostingList(object):
@@ -496,6 +1167,9 @@ class OldPostingList(object):
                 self.session.ui.warning('load(%s) %s'
                                         % (self.filename, sys.exc_info()))
 
+    def _fmt_value(self, value):
+        return '%s' % value
+
     def _fmt_file(self, prefix):
         output = []
         self.session.ui.mark('Formatting prefix %s' % unicode(prefix))
@@ -504,7 +1178,8 @@ class OldPostingList(object):
             if ((prefix == 'ALL' or word.startswith(prefix))
                     and len(data) > 0):
                 output.append(('%s\t%s\n'
-                               ) % (word, '\t'.join(['%s' % x for x in data])))
+                               ) % (word, '\t'.join([self._fmt_value(x)
+                                                     for x in data])))
         return ''.join(output)
 
     def _compact(self, prefix, output):
@@ -576,12 +1251,28 @@ class OldPostingList(object):
 
 class GlobalPostingList(OldPostingList):
 
+    BUFFER_MESSAGES = 100
+    BUFFER_SECONDS = 2.0
+
     @classmethod
     def _Optimize(cls, session, idx,
                   force=False, lazy=False, quick=False, ratio=1.0, runtime=0):
         starttime = time.time()
         count = 0
         global GLOBAL_GPL
+        cls.Flush(session)
+        if PostingSegments.Enabled(session.config):
+            if (GLOBAL_GPL or GLOBAL_GPL_REMOVED) and (
+                    not lazy or len(GLOBAL_GPL) > 5*1024):
+                count = cls._FlushSegment(session)
+            if not quick:
+                PostingSegments.Get(session.config).merge(
+                    session, force=force, runtime=runtime)
+            return count
+        elif not quick and PostingSegments.Get(session.config):
+            # Segments have been disabled, but some are still around
+            PostingSegments.Get(session.config).drain(session)
+
         if (GLOBAL_GPL and (not lazy or len(GLOBAL_GPL) > 5*1024)):
             # Processing keys in order is more efficient, as it lets things
             # accumulate in the PLC_CACHE.
@@ -620,6 +1311,58 @@ class GlobalPostingList(OldPostingList):
         else:
             return OldPostingList._Optimize(session, idx, force=force)
 
+    @classmethod
+    def _FlushSegment(cls, session):
+        # Snapshot the journal into a new segment, and only then forget
+        # about what was written, so readers always find the postings in
+        # at least one place.
+        with GLOBAL_GPL_LOCK:
+            words = dict((sig, set(v))
+                         for sig, v in (GLOBAL_GPL or {}).iteritems() if v)
+            removed = dict((sig, set(v))
+                           for sig, v in GLOBAL_GPL_REMOVED.iteritems() if v)
+        if not (words or removed):
+            return 0
+
+        PostingSegments.Get(session.config).flush(session, words, removed)
+
+        with GLOBAL_POSTING_LOCK, GLOBAL_GPL_LOCK:
+            for pending, flushed in ((GLOBAL_GPL, words),
+                                     (GLOBAL_GPL_REMOVED, removed)):
+                for sig, values in flushed.iteritems():
+                    if sig in pending:
+                        pending[sig] -= values
+                        if not pending[sig]:
+                            del pending[sig]
+            # Rewrite the journal with whatever arrived in the meantime
+            GlobalPostingList(session, '').save()
+        return len(words)
+
+    @classmethod
+    def Estimate(cls, session, word):
+        """
+        Estimate how many messages match a word, without loading anything
+        from disk. Returns None if we cannot tell without loading.
+        """
+        config = session.config
+        sig = cls.WordSig(word, config)
+        cls.Flush(session)
+        count = len((GLOBAL_GPL or {}).get(sig, ()))
+        if PostingSegments.Enabled(config):
+            for seg in PostingSegments.Get(config).segments:
+                data = seg.get(sig)
+                if data is not None:
+                    count += CountPostings(data.split(' ', 1)[0])
+
+        fn, csig = PostingListContainer._GetFilenameAndSig(config, sig)
+        with PLC_CACHE_LOCK:
+            plc = PLC_CACHE.peek(csig) or PLC_EVICTED.get(csig)
+        if plc is not None:
+            count += len(plc.get(sig) or ())
+        elif PostingListContainer.MightContain(session, sig):
+            return None
+        return count
+
     @classmethod
     def SaveFile(cls, session, prefix):
         return os.path.join(session.config.workdir, 'kw-journal.dat')
@@ -633,24 +1376,112 @@ class GlobalPostingList(OldPostingList):
             return (None, 'kw-journal.dat')
 
     @classmethod
-    def _Append(cls, session, word, mail_ids, compact=True):
-        super(GlobalPostingList, cls)._Append(session, word, mail_ids,
-                                              compact=compact)
+    def _Remember(cls, postings):
         with GLOBAL_GPL_LOCK:
             global GLOBAL_GPL
-            sig = cls.WordSig(word, session.config)
             if GLOBAL_GPL is None:
                 GLOBAL_GPL = {}
-            if sig not in GLOBAL_GPL:
-                GLOBAL_GPL[sig] = set()
-            for mail_id in mail_ids:
-                GLOBAL_GPL[sig].add(mail_id)
+            for sig, mail_ids in postings.iteritems():
+                if sig not in GLOBAL_GPL:
+                    GLOBAL_GPL[sig] = set()
+                GLOBAL_GPL[sig] |= set(_ints(mail_ids))
+                if sig in GLOBAL_GPL_REMOVED:
+                    GLOBAL_GPL_REMOVED[sig] -= GLOBAL_GPL[sig]
+
+    @classmethod
+    def _Append(cls, session, word, mail_ids, compact=True):
+        super(GlobalPostingList, cls)._Append(session, word, mail_ids,
+                                              compact=compact)
+        cls._Remember({cls.WordSig(word, session.config): mail_ids})
 
-    def __init__(self, *args, **kwargs):
+    @classmethod
+    def Buffer(cls, session, words, mail_id):
+        """
+        Queue up the postings for a message, to be written to the journal
+        along with those of other messages. Appending word by word costs
+        a lock, a hash and a file write for each of the hundreds of words
+        in a typical message, so batching saves a lot of work.
+
+        Buffered postings are flushed once enough messages have been
+        queued or the oldest has waited long enough, before anything
+        reads or removes postings, and on shutdown.
+        """
+        global GLOBAL_PENDING_SINCE
+        with GLOBAL_PENDING_LOCK:
+            for word in words:
+                if word in GLOBAL_PENDING:
+                    GLOBAL_PENDING[word].add(mail_id)
+                else:
+                    GLOBAL_PENDING[word] = set([mail_id])
+            GLOBAL_PENDING_MIDS.add(mail_id)
+            if GLOBAL_PENDING_SINCE is None:
+                GLOBAL_PENDING_SINCE = time.time()
+            full = ((len(GLOBAL_PENDING_MIDS) >= cls.BUFFER_MESSAGES) or
+                    (time.time() - GLOBAL_PENDING_SINCE >= cls.BUFFER_SECONDS))
+        if full:
+            cls.Flush(session)
+
+    @classmethod
+    def Flush(cls, session):
+        """Write all buffered postings to the journal, in one go."""
+        global GLOBAL_PENDING, GLOBAL_PENDING_SINCE
+        if not GLOBAL_PENDING:
+            return 0
+
+        # Holding the posting lock until the postings have been recorded
+        # makes concurrent readers wait for them, instead of missing them.
+        with GLOBAL_POSTING_LOCK:
+            with GLOBAL_PENDING_LOCK:
+                pending, GLOBAL_PENDING = GLOBAL_PENDING, {}
+                GLOBAL_PENDING_MIDS.clear()
+                GLOBAL_PENDING_SINCE = None
+
+            postings = {}
+            for word, mail_ids in pending.iteritems():
+                try:
+                    sig = cls.WordSig(word, session.config)
+                except UnicodeDecodeError:
+                    # FIXME: we just ignore garbage
+                    continue
+                if sig in postings:
+                    postings[sig] |= mail_ids
+                else:
+                    postings[sig] = mail_ids
+            if not postings:
+                return 0
+
+            # If the journal cannot be written, the postings still live in
+            # memory and will be saved when the journal is next rewritten.
+            cls._Remember(postings)
+            lines = ['%s\t%s\n' % (sig, '\t'.join(mail_ids))
+                     for sig, mail_ids in postings.iteritems()]
+            fd, fn = cls.GetFile(session, '', mode='a')
+            if fd:
+                with fd:
+                    fd.write(''.join(lines))
+        return len(postings)
+
+    def __init__(self, session, *args, **kwargs):
+        self.Flush(session)
         with GLOBAL_GPL_LOCK:
-            OldPostingList.__init__(self, *args, **kwargs)
+            OldPostingList.__init__(self, session, *args, **kwargs)
             self.lock = GLOBAL_GPL_LOCK
 
+    def _parse_lines(self, lines):
+        # The journal uses base36 message IDs, we keep them as ints.
+        for line in lines:
+            self.size += len(line)
+            words = line.strip().split('\t')
+            if len(words) > 1:
+                wset = set(_ints(words[1:]))
+                if words[0] in self.WORDS:
+                    self.WORDS[words[0]] |= wset
+                else:
+                    self.WORDS[words[0]] = wset
+
+    def _fmt_value(self, value):
+        return b36(value)
+
     def _fmt_file(self, prefix):
         return OldPostingList._fmt_file(self, 'ALL')
 
@@ -676,15 +1507,37 @@ class GlobalPostingList(OldPostingList):
                 del self.WORDS[sig]
 
     def remove(self, eids):
+        eids = _ints(eids)
         PostingList(self.session, self.word).remove(eids).save()
+        if (PostingSegments.Enabled(self.config) and
+                PostingSegments.Get(self.config)):
+            # Record a tombstone, to be flushed with the next segment
+            with self.lock:
+                if self.sig not in GLOBAL_GPL_REMOVED:
+                    GLOBAL_GPL_REMOVED[self.sig] = set()
+                GLOBAL_GPL_REMOVED[self.sig] |= set(eids)
         return OldPostingList.remove(self, eids)
 
     def hits(self):
-        return (self.WORDS.get(self.sig, set())
-                | PostingList(self.session, self.word).hits())
+        values = Bitmap(PostingList(self.session, self.word).hits())
+        segments = (PostingSegments.Enabled(self.config) and
+                    PostingSegments.Get(self.config))
+        if segments:
+            values = segments.apply(self.sig, values)
+            values -= AsBitmap(GLOBAL_GPL_REMOVED.get(self.sig, ()))
+        return values | AsBitmap(self.WORDS.get(self.sig, ()))
 
 
 if NEW_POSTING_LIST:
     PostingList = NewPostingList
 else:
     PostingList = OldPostingList
+
+
+if __name__ == "__main__":
+    import doctest
+    import sys
+    result = doctest.testmod()
+    print '%s' % (result, )
+    if result.failed:
+        sys.exit(1)
@@ -1,30 +1,102 @@
+import bisect
 import cStringIO
-import email
+import email.parser
+import heapq
 import lxml.html
+import os
 import re
 import rfc822
+import struct
+import sys
 import time
 import threading
 import traceback
+from array import array
 from urllib import quote, unquote
 
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+
 import mailpile.util
+import mailpile.crypto.blocks
+from mailpile.bitmap import Bitmap, AsBitmap
 from mailpile.crypto.gpgi import GnuPG
 from mailpile.crypto.state import CryptoInfo, SignatureInfo, EncryptionInfo
 from mailpile.i18n import gettext as _
 from mailpile.i18n import ngettext as _n
+from mailpile.index_columns import ColumnarIndex, ColumnarIndexList
+from mailpile.index_columns import DigestIndex
 from mailpile.plugins import PluginManager
 from mailpile.mailutils import FormatMbxId, MBX_ID_LEN, NoSuchMailboxError
 from mailpile.mailutils import AddressHeaderParser
 from mailpile.mailutils import ExtractEmails, ExtractEmailAndName
 from mailpile.mailutils import Email, ParseMessage, HeaderPrint
 from mailpile.postinglist import GlobalPostingList
+from mailpile.tokenizer import Tokenize
 from mailpile.ui import *
 from mailpile.util import *
 
 
 _plugins = PluginManager()
 
+# The config and session used by the parse workers. This is set before the
+# worker processes are forked, so they inherit it instead of having it
+# pickled and sent their way. Each worker creates its own MailIndex the
+# first time it is used.
+_PARSE_WORKER_CONTEXT = None
+_PARSE_WORKER_INDEX = None
+
+
+def _parse_worker(job):
+    global _PARSE_WORKER_INDEX
+    config, session = _PARSE_WORKER_CONTEXT
+    try:
+        if _PARSE_WORKER_INDEX is None:
+            _PARSE_WORKER_INDEX = MailIndex(config)
+        return _PARSE_WORKER_INDEX.parse_for_index(session, *job)
+    except Exception:
+        # Anything unexpected is left for the main process to deal with.
+        return None
+
+
+# The pool of mail parsing processes, and how many processes it has.
+# Forking while other threads are running is risky: the children inherit
+# any locks those threads happen to hold. So the pool is created once,
+# early on (before the worker threads get started), and reused by every
+# scan, instead of being forked for each large mailbox.
+PARSE_POOL_LOCK = SearchLock()
+PARSE_POOL = None
+
+
+def ConfigureParsePool(config, processes):
+    """Create, resize or (if processes is 0) shut down the parse pool."""
+    global PARSE_POOL, _PARSE_WORKER_CONTEXT
+    with PARSE_POOL_LOCK:
+        if PARSE_POOL is not None:
+            pool, size = PARSE_POOL
+            if size == processes:
+                return pool
+            PARSE_POOL = None
+            pool.terminate()
+        if (processes < 1 or multiprocessing is None
+                or not hasattr(os, 'fork') or getattr(sys, 'frozen', False)):
+            return None
+
+        from mailpile.ui import Session, SilentInteraction
+        worker_session = Session(config)
+        worker_session.ui = SilentInteraction(config)
+        _PARSE_WORKER_CONTEXT = (config, worker_session)
+        try:
+            pool = multiprocessing.Pool(processes)
+        except (IOError, OSError, ImportError):
+            if 'rescan' in config.sys.debug:
+                traceback.print_exc()
+            return None
+        PARSE_POOL = (pool, processes)
+        return pool
+
 
 class SearchResultSet:
     """
@@ -36,18 +108,22 @@ class SearchResultSet:
         self.set_results(results, exclude)
 
     def set_results(self, results, exclude):
+        results = AsBitmap(results)
         self._results = {
-            'raw': set(results),
-            'excluded': set(exclude) & set(results)
+            'raw': results,
+            'excluded': AsBitmap(exclude) & results
         }
         return self
 
     def __len__(self):
         return len(self._results.get('raw', []))
 
-    def as_set(self, order='raw'):
+    def as_bitmap(self, order='raw'):
         return self._results[order] - self._results['excluded']
 
+    def as_set(self, order='raw'):
+        return set(self.as_bitmap(order))
+
     def excluded(self):
         return self._results['excluded']
 
@@ -83,6 +159,168 @@ class CachedSearchResultSet(SearchResultSet):
         SEARCH_RESULT_CACHE = {}
 
 
+class RankedSortColumn(object):
+    """
+    A compact sort column for string keys, such as senders or subjects.
+
+    Each distinct key is stored only once, as a truncated UTF-8 prefix,
+    and messages just record the integer ID of their key. New keys are
+    inserted into a sorted key list with bisect; the rank of each key is
+    derived from that list lazily, in a single pass, the next time the
+    column is used for sorting.
+
+    >>> rsc = RankedSortColumn(2)
+    >>> rsc[0] = u'zebra'
+    >>> rsc[1] = u'aardvark'
+    >>> rsc.append(u'zebra')
+    >>> sorted([0, 1, 2], key=rsc.__getitem__)
+    [1, 0, 2]
+    >>> (len(rsc), len(rsc.sorted_keys))
+    (3, 3)
+    >>> rsc.append(u'mongoose')
+    >>> [rsc[i] for i in range(0, 4)]
+    [3, 1, 3, 2]
+    >>> saved = RankedSortColumn.Load(rsc.dump(3))
+    >>> (len(saved), [saved[i] for i in range(0, 3)])
+    (3, [3, 1, 3])
+    """
+    KEY_BYTES = 32
+
+    def __init__(self, size=0):
+        self.sorted_keys = ['']
+        self.key_ids = {'': 0}
+        self.msg_keys = array('l', [0]) * size
+        self.ranks = array('l', [0])
+
+    def __len__(self):
+        return len(self.msg_keys)
+
+    def _key_id(self, key):
+        if key:
+            key = key.encode('utf-8')[:self.KEY_BYTES]
+        else:
+            key = ''
+        kid = self.key_ids.get(key)
+        if kid is None:
+            kid = self.key_ids[key] = len(self.key_ids)
+            bisect.insort(self.sorted_keys, key)
+        return kid
+
+    def _rank(self):
+        ranks = array('l', [0]) * len(self.sorted_keys)
+        key_ids = self.key_ids
+        for rank, key in enumerate(self.sorted_keys):
+            ranks[key_ids[key]] = rank
+        self.ranks = ranks
+        return ranks
+
+    def __setitem__(self, pos, key):
+        self.msg_keys[pos] = self._key_id(key)
+
+    def __getitem__(self, pos):
+        kid = self.msg_keys[pos]
+        ranks = self.ranks
+        if len(ranks) != len(self.sorted_keys):
+            ranks = self._rank()
+        return ranks[kid]
+
+    def append(self, key):
+        self.msg_keys.append(self._key_id(key))
+
+    def dump(self, count):
+        """Return the first count entries in a form marshal can save."""
+        key_ids = array('l', [self.key_ids[k] for k in self.sorted_keys])
+        return (self.sorted_keys[:], key_ids.tostring(),
+                self.msg_keys[:count].tostring())
+
+    @classmethod
+    def Load(cls, data):
+        """Recreate a sort column from the output of dump()."""
+        sorted_keys, key_ids, msg_keys = data
+        rsc = cls()
+        rsc.sorted_keys = list(sorted_keys)
+        ids = array('l')
+        ids.fromstring(key_ids)
+        rsc.key_ids = dict(zip(rsc.sorted_keys, ids))
+        if len(rsc.key_ids) != len(rsc.sorted_keys):
+            raise ValueError('Corrupt sort column')
+        rsc.msg_keys.fromstring(msg_keys)
+        return rsc
+
+
+class LazySortedResults(object):
+    """
+    A list-like view of search results which only sorts as far as it
+    has to. Results are kept in a heap and popped off as consumers ask
+    for them, so displaying the first page of a huge result set costs
+    O(n + k log n) instead of a full sort. If threads is given, only the
+    first message of each conversation is kept, also incrementally.
+
+    >>> lsr = LazySortedResults([4, 1, 3, 2], [0, 40, 10, 30, 20], False)
+    >>> (lsr[0], len(lsr._ordered), lsr[1:3], len(lsr))
+    (2, 1, [4, 3], 4)
+    >>> list(LazySortedResults([1, 2, 3], [0, 5, 5, 1], True, [0, 1, 1, 0]))
+    [2, 3]
+    """
+    def __init__(self, results, sort_key, reverse, threads=None):
+        sign = -1 if reverse else 1
+        self._heap = [(sign * sort_key[r], sign * r, r) for r in results]
+        heapq.heapify(self._heap)
+        self._threads = threads
+        self._seen = set()
+        self._ordered = []
+        if threads is not None:
+            self._count = len(set(threads[r] for r in results))
+        else:
+            self._count = len(results)
+
+    def _fill(self, count=None):
+        ordered, heap, threads = self._ordered, self._heap, self._threads
+        while heap and (count is None or len(ordered) < count):
+            r = heapq.heappop(heap)[2]
+            if threads is not None:
+                if threads[r] in self._seen:
+                    continue
+                self._seen.add(threads[r])
+            ordered.append(r)
+        if not heap:
+            self._seen = set()
+        return ordered
+
+    def __len__(self):
+        return self._count
+
+    def __nonzero__(self):
+        return (self._count > 0)
+
+    def __iter__(self):
+        return iter(self._fill())
+
+    def __contains__(self, r):
+        return (r in self._fill())
+
+    def __getitem__(self, pos):
+        if isinstance(pos, slice):
+            stop = pos.stop
+            if stop is None or stop < 0 or (pos.start or 0) < 0:
+                return self._fill()[pos]
+            return self._fill(stop)[pos]
+        return self._fill(None if (pos < 0) else pos + 1)[pos]
+
+    def __getslice__(self, start, stop):
+        return self.__getitem__(slice(start, stop))
+
+    def __setslice__(self, start, stop, values):
+        self._fill()[start:stop] = values
+        self._count = len(self._ordered)
+
+    def sort(self, *args, **kwargs):
+        self._fill().sort(*args, **kwargs)
+
+    def reverse(self):
+        self._fill().reverse()
+
+
 class MailIndex(object):
     """This is a lazily parsing object representing a mailpile index."""
 
@@ -107,6 +345,11 @@ class MailIndex(object):
                       '(not in index)', '', '', '', '-1']
 
     MAX_INCREMENTAL_SAVES = 25
+    SAVE_CHUNK_BYTES = 4 * 1024 * 1024
+
+    PARSE_MIN_MESSAGES = 50
+    PARSE_BATCH_SIZE = 250
+    HEADERS_FIRST_MIN_MESSAGES = 1000
 
     def __init__(self, config):
         self.config = config
@@ -114,18 +357,23 @@ class MailIndex(object):
         self.INDEX = []
         self.INDEX_SORT = {}
         self.INDEX_THR = []
-        self.PTRS = {}
+        self.PTRS = DigestIndex()
         self.TAGS = {}
-        self.MSGIDS = {}
+        self.TAG_COUNTS = None
+        self.MSGIDS = DigestIndex()
+        self.MAILBOX_MSGS = {}
         self.EMAILS = []
         self.EMAIL_IDS = {}
-        self.CACHE = {}
+        self.CACHE = self._new_cache()
         self.MODIFIED = set()
         self.EMAILS_SAVED = 0
         self._scanned = {}
+        self._scanning = 0
+        self.DEFERRED = None
         self._saved_changes = 0
         self._lock = SearchRLock()
         self._save_lock = SearchRLock()
+        self._tag_classes = None
         self._prepare_sorting()
 
     @classmethod
@@ -186,13 +434,179 @@ class MailIndex(object):
         d = self.get_body(msg_info)
         msg_info[self.MSG_BODY] = self.encode_body(d, **kwargs)
 
+    def _columns_enabled(self):
+        # The columnar index is plain-text, unless we can block-encrypt it,
+        # so we refuse to use it if the user has asked for the index to be
+        # encrypted and we can't.
+        return (self.config.sys.metadata_columns and
+                (self._columns_key() or not self._columns_encrypted()))
+
+    def _columns_encrypted(self):
+        gpgr = self.config.prefs.gpg_recipient
+        return (self.config.prefs.encrypt_index or
+                gpgr not in (None, '', '!CREATE'))
+
+    def _columns_key(self):
+        if (self._columns_encrypted() and mailpile.crypto.blocks.AVAILABLE
+                and self.config.master_key):
+            return self.config.master_key
+        return None
+
+    def _load_columns(self, session):
+        colfile = self.config.mailindex_columns_file()
+        if not self._columns_enabled():
+            if os.path.exists(colfile):
+                safe_remove(colfile)
+            return 0
+        try:
+            columns = ColumnarIndex(colfile,
+                                    source=self.config.mailindex_file(),
+                                    key=self._columns_key())
+        except (IOError, OSError, ValueError, struct.error):
+            return 0
+
+        if session:
+            session.ui.mark(_('Loading metadata index...'))
+        self.INDEX = ColumnarIndexList(columns, self.l2m, self.m2l)
+        self.PTRS = columns.digest_index('ptrs')
+        self.MSGIDS = columns.digest_index('msgids')
+        self.EMAILS = columns.emails()
+        for pos, email in enumerate(self.EMAILS):
+            if email:
+                self.EMAIL_IDS[email.split()[0].lower()] = pos
+
+        try:
+            state = columns.state()
+        except (ValueError, EOFError, TypeError):
+            state = None
+        if state and self._load_column_state(state, len(columns)):
+            return columns.source_size
+
+        # No usable derived state, rebuild it from the rows themselves.
+        self.INDEX_THR = [-1] * len(columns)
+        self._prepare_sorting(len(columns))
+        for pos in xrange(0, len(columns)):
+            msg_info = columns.get_msg_info(pos)
+            if len(msg_info) == self.MSG_FIELDS_V2:
+                self.INDEX_THR[pos] = int(msg_info[self.MSG_THREAD_MID], 36)
+                self._index_mailbox_ptrs(pos, msg_info)
+                self.update_msg_sorting(pos, msg_info)
+                self.update_msg_tags(pos, msg_info, fresh=True)
+                self._update_deferred(pos, msg_info)
+            if session and pos % 1009 == 1000:
+                session.ui.mark(_('Loading metadata index...') +
+                                ' %s' % pos)
+        return columns.source_size
+
+    def _column_state(self, count):
+        # Everything load() would otherwise rebuild by decoding every row.
+        # Bitmaps are trimmed to the snapshot, as positions beyond it get
+        # replayed from mailpile.idx as if they were new.
+        snapshot = Bitmap.Range(count)
+        sorting = {}
+        with self._lock:
+            for order, column in self.INDEX_SORT.iteritems():
+                if order in self.SORT_COLUMNS:
+                    sorting[order] = column.dump(count)
+                else:
+                    sorting[order] = column[:count].tostring()
+            return {
+                'long_bytes': array('l').itemsize,
+                'threads': array('l', self.INDEX_THR[:count]).tostring(),
+                'sorting': sorting,
+                'tags': dict((tid, (msgs & snapshot).dump())
+                             for tid, msgs in self.TAGS.iteritems()),
+                'mailboxes': dict((mbx_id, (msgs & snapshot).dump())
+                                  for mbx_id, msgs
+                                  in self.MAILBOX_MSGS.iteritems()),
+                'deferred': (None if (self.DEFERRED is None) else
+                             (Bitmap(list(self.DEFERRED)) & snapshot).dump())
+            }
+
+    def _load_column_state(self, state, count):
+        try:
+            if state['long_bytes'] != array('l').itemsize:
+                return False
+            threads = array('l')
+            threads.fromstring(state['threads'])
+            sorting = {}
+            for order in self.SORT_ORDERS:
+                data = state['sorting'][order]
+                if order in self.SORT_COLUMNS:
+                    sorting[order] = self.SORT_COLUMNS[order].Load(data)
+                else:
+                    sorting[order] = array('l')
+                    sorting[order].fromstring(data)
+                if len(sorting[order]) != count:
+                    return False
+            tags = dict((tid, Bitmap.Load(data))
+                        for tid, data in state['tags'].iteritems())
+            mailboxes = dict((mbx_id, Bitmap.Load(data))
+                             for mbx_id, data
+                             in state['mailboxes'].iteritems())
+            deferred = state['deferred']
+            if deferred is not None:
+                deferred = set(Bitmap.Load(deferred))
+        except (KeyError, TypeError, ValueError):
+            return False
+        if len(threads) != count:
+            return False
+
+        self._prepare_sorting()
+        self.INDEX_SORT = sorting
+        self.INDEX_THR = threads.tolist()
+        if 'tags' in self.config:
+            tags = dict((tid, msgs) for tid, msgs in tags.iteritems()
+                        if tid in self.config.tags)
+        self.TAGS = tags
+        self.MAILBOX_MSGS = mailboxes
+        self.DEFERRED = deferred
+        return True
+
+    def _save_columns(self, session, index_counter, email_counter):
+        if not self._columns_enabled():
+            return
+        if session:
+            session.ui.mark(_("Saving columnar metadata index..."))
+
+        def msg_infos():
+            for pos in xrange(0, index_counter):
+                try:
+                    yield self._get_msg_info(pos)
+                except (IndexError, ValueError):
+                    yield None
+
+        try:
+            idxfile = self.config.mailindex_file()
+            ColumnarIndex.Write(self.config.mailindex_columns_file(),
+                                idxfile, os.path.getsize(idxfile),
+                                msg_infos(), self.EMAILS[:email_counter],
+                                tempdir=self.config.tempfile_dir(),
+                                key=self._columns_key(),
+                                state=self._column_state(index_counter))
+        except (IOError, OSError, OverflowError):
+            # This is just an optimization, failing is not fatal.
+            if session:
+                session.ui.warning(_('Failed to save columnar index'))
+            if self.config.sys.debug:
+                traceback.print_exc()
+
+    def _new_cache(self):
+        return LRUCache(max_items=self.config.sys.metadata_cache,
+                        max_bytes=1024 * self.config.sys.metadata_cache_kb,
+                        sizer=lambda mi: sum(len(f) for f in mi))
+
     def load(self, session=None):
         self.INDEX = []
-        self.CACHE = {}
-        self.PTRS = {}
-        self.MSGIDS = {}
+        self.TAGS = {}
+        self.TAG_COUNTS = None
+        self.CACHE = self._new_cache()
+        self.PTRS = DigestIndex()
+        self.MSGIDS = DigestIndex()
+        self.MAILBOX_MSGS = {}
         self.EMAILS = []
         self.EMAIL_IDS = {}
+        self.DEFERRED = set()
         CachedSearchResultSet.DropCaches()
         bogus_lines = []
 
@@ -236,6 +650,7 @@ class MailIndex(object):
                             pos = int(words[self.MSG_MID], 36)
                             self.set_msg_at_idx_pos(pos, words,
                                                     original_line=line)
+                            self._update_deferred(pos, words)
                             if session and len(self.INDEX) % 107 == 100:
                                 session.ui.mark(
                                     _('Loading metadata index...') +
@@ -258,13 +673,18 @@ class MailIndex(object):
         try:
             import mailpile.mail_source
             with self._save_lock, self._lock:
+                # If we have an up-to-date columnar snapshot of the index,
+                # start with that and then parse the lines added since.
+                columns_size = self._load_columns(session)
                 with open(self.config.mailindex_file(), 'r') as fd:
+                    fd.seek(columns_size)
                     # We don't raise on errors, in case only some of the chunks
                     # are corrupt - we want to read the rest of them.
                     # FIXME: Differentiate between partial index and no index?
+                    threads = self.config.sys.index_threads
                     decrypt_and_parse_lines(fd, process_lines, self.config,
                                             newlines=True, decode=False,
-                                            _raise=False)
+                                            _raise=False, threads=threads)
         except IOError:
             if session:
                 session.ui.warning(_('Metadata index not found: %s'
@@ -289,15 +709,130 @@ class MailIndex(object):
                                ) % len(self.INDEX))
         self.EMAILS_SAVED = len(self.EMAILS)
 
-    def update_msg_tags(self, msg_idx_pos, msg_info):
+    def update_msg_tags(self, msg_idx_pos, msg_info, fresh=False):
         tags = set(self.get_tags(msg_info=msg_info))
         with self._lock:
-            for tid in (set(self.TAGS.keys()) - tags):
-                self.TAGS[tid] -= set([msg_idx_pos])
-            for tid in tags:
+            if fresh:
+                # A brand new position cannot be in any of the bitmaps yet
+                old_tags = set()
+            else:
+                old_tags = set([tid for tid, msgs in self.TAGS.iteritems()
+                                if msg_idx_pos in msgs])
+            for tid in (old_tags - tags):
+                self.TAGS[tid].discard(msg_idx_pos)
+            for tid in (tags - old_tags):
                 if tid not in self.TAGS:
-                    self.TAGS[tid] = set()
+                    self.TAGS[tid] = Bitmap()
                 self.TAGS[tid].add(msg_idx_pos)
+            self._update_tag_counts(old_tags, tags)
+
+    def _get_tag_classes(self):
+        # Messages are counted in four buckets per tag, depending on
+        # whether they are unread and whether they are hidden.
+        if 'tags' not in self.config:
+            return (frozenset(), frozenset())
+        return (frozenset(t._key for t in self.config.get_tags(type='unread')),
+                frozenset(t._key for t in
+                          self.config.get_tags(flag_hides=True)))
+
+    def _tag_class(self, tags):
+        unread, hides = self._tag_classes
+        return ((1 if (unread & tags) else 0) +
+                (2 if (hides & tags) else 0))
+
+    def _update_tag_counts(self, old_tags, new_tags):
+        # Adjust the per-tag counters for a single message whose tags
+        # changed from old_tags to new_tags. If the counters have not been
+        # built yet, we leave that to get_tag_stats().
+        if self.TAG_COUNTS is None:
+            return
+        old_class = self._tag_class(old_tags)
+        new_class = self._tag_class(new_tags)
+        for tid in old_tags:
+            self.TAG_COUNTS.setdefault(tid, [0, 0, 0, 0])[old_class] -= 1
+        for tid in new_tags:
+            self.TAG_COUNTS.setdefault(tid, [0, 0, 0, 0])[new_class] += 1
+
+    def _tag_class_bitmaps(self):
+        unread, hides = Bitmap(), Bitmap()
+        for tid in self._tag_classes[0]:
+            unread |= self.TAGS.get(tid, Bitmap())
+        for tid in self._tag_classes[1]:
+            hides |= self.TAGS.get(tid, Bitmap())
+        return unread, hides
+
+    def _count_tags(self):
+        unread, hides = self._tag_class_bitmaps()
+        counts = {}
+        for tid, msgs in self.TAGS.iteritems():
+            read_msgs = msgs - unread
+            unread_msgs = msgs & unread
+            counts[tid] = [len(read_msgs - hides),
+                           len(unread_msgs - hides),
+                           len(read_msgs & hides),
+                           len(unread_msgs & hides)]
+        return counts
+
+    def get_tag_stats(self, tag_ids, exclude_hidden=False):
+        """
+        Return a tuple of (all, new) message counts for the given tags,
+        optionally excluding messages which are hidden by other tags.
+
+        For a single tag this is a lookup in counters which are maintained
+        as messages get tagged and untagged; counting the union of more
+        than one tag requires bitmap operations.
+        """
+        with self._lock:
+            tag_classes = self._get_tag_classes()
+            if (self.TAG_COUNTS is None or
+                    tag_classes != self._tag_classes):
+                self._tag_classes = tag_classes
+                self.TAG_COUNTS = self._count_tags()
+
+            if len(tag_ids) == 1:
+                counts = self.TAG_COUNTS.get(tag_ids[0], [0, 0, 0, 0])
+                if exclude_hidden:
+                    return (counts[0] + counts[1], counts[1])
+                return (sum(counts), counts[1] + counts[3])
+
+            unread, hides = self._tag_class_bitmaps()
+            messages = Bitmap()
+            for tid in tag_ids:
+                messages |= self.TAGS.get(tid, Bitmap())
+            if exclude_hidden:
+                messages -= hides
+            return (len(messages), len(messages & unread))
+
+    def _write_chunked(self, fd, lines, progress=None):
+        # Write lines to the index in bounded chunks, so we never need to
+        # hold the entire index (or its ciphertext) in RAM. If the index is
+        # to be encrypted, each chunk becomes its own PGP message; the
+        # loader already knows how to handle multiple encrypted blocks.
+        gpgr = self.config.prefs.gpg_recipient
+        gpgr = gpgr if gpgr not in (None, '', '!CREATE') else None
+
+        def write(chunk):
+            data = ''.join(chunk)
+            if gpgr:
+                status, edata = GnuPG(self.config).encrypt(data, tokeys=[gpgr])
+                if status == 0:
+                    data = edata
+            fd.write(data)
+
+        chunk, chunk_bytes, count = [], 0, 0
+        for line in lines:
+            chunk.append(line)
+            chunk_bytes += len(line)
+            count += 1
+            if chunk_bytes >= self.SAVE_CHUNK_BYTES:
+                write(chunk)
+                chunk, chunk_bytes = [], 0
+                if progress:
+                    progress(count)
+                play_nice_with_threads()
+        if chunk:
+            write(chunk)
+        return count
 
     def save_changes(self, session=None):
         self._save_lock.acquire()
@@ -327,15 +862,9 @@ class MailIndex(object):
                 self.EMAILS_SAVED = total
 
             # Unlocked, try to write this out
-            gpgr = self.config.prefs.gpg_recipient
-            gpgr = gpgr if gpgr not in (None, '', '!CREATE') else None
-            data = ''.join(emails + [self.INDEX[pos] + '\n' for pos in mods])
-            if gpgr:
-                status, edata = GnuPG(self.config).encrypt(data, tokeys=[gpgr])
-                if status == 0:
-                    data = edata
             with open(self.config.mailindex_file(), 'a') as fd:
-                fd.write(data)
+                self._write_chunked(fd, emails + [self.INDEX[pos] + '\n'
+                                                  for pos in mods])
                 self._saved_changes += 1
 
             if session:
@@ -361,33 +890,33 @@ class MailIndex(object):
             idxfile = self.config.mailindex_file()
             newfile = '%s.new' % idxfile
 
-            data = [
-                '# This is the mailpile.py index file.\n',
-                '# We have %d messages!\n' % len(self.INDEX)
-            ]
             self.EMAILS_SAVED = email_counter = len(self.EMAILS)
-            for eid in range(0, email_counter):
-                quoted_email = quote(self.EMAILS[eid].encode('utf-8'))
-                data.append('@%s\t%s\n' % (b36(eid), quoted_email))
             index_counter = len(self.INDEX)
-            for i in range(0, index_counter):
-                data.append(self.INDEX[i] + '\n')
-            data = ''.join(data)
+            total = email_counter + index_counter
 
-            gpgr = self.config.prefs.gpg_recipient
-            gpgr = gpgr if gpgr not in (None, '', '!CREATE') else None
-            if gpgr:
-                status, edata = GnuPG(self.config).encrypt(data, tokeys=[gpgr])
-                if status == 0:
-                    data = edata
+            def lines():
+                yield '# This is the mailpile.py index file.\n'
+                yield '# We have %d messages!\n' % index_counter
+                for eid in xrange(0, email_counter):
+                    quoted_email = quote(self.EMAILS[eid].encode('utf-8'))
+                    yield '@%s\t%s\n' % (b36(eid), quoted_email)
+                for i in xrange(0, index_counter):
+                    yield self.INDEX[i] + '\n'
+
+            def progress(count):
+                if session:
+                    session.ui.mark(_("Saving metadata index...") +
+                                    ' %d/%d' % (min(count, total), total))
 
             with open(newfile, 'w') as fd:
-                fd.write(data)
+                self._write_chunked(fd, lines(), progress=progress)
 
             # Keep the last 5 index files around... just in case.
             backup_file(idxfile, backups=5, min_age_delta=10)
             os.rename(newfile, idxfile)
 
+            self._save_columns(session, index_counter, email_counter)
+
             self._saved_changes = 0
             if session:
                 session.ui.mark(_("Saved metadata index"))
@@ -408,6 +937,7 @@ class MailIndex(object):
                 self.MSGIDS[message[self.MSG_ID]] = offset
                 for msg_ptr in message[self.MSG_PTRS].split(','):
                     self.PTRS[msg_ptr] = offset
+                self._index_mailbox_ptrs(offset, message)
             else:
                 session.ui.warning(_('Bogus line: %s') % line)
 
@@ -486,6 +1016,37 @@ class MailIndex(object):
         # Finally, return the unicode data, with white-space normalized
         return value.replace('\r', ' ').replace('\t', ' ').replace('\n', ' ')
 
+    def _index_mailbox_ptrs(self, msg_idx, msg_info):
+        for msg_ptr in msg_info[self.MSG_PTRS].split(','):
+            mbx_id = msg_ptr[:MBX_ID_LEN]
+            if mbx_id not in self.MAILBOX_MSGS:
+                self.MAILBOX_MSGS[mbx_id] = Bitmap()
+            self.MAILBOX_MSGS[mbx_id].add(msg_idx)
+
+    def _mailbox_ptrs(self, mailbox_idx):
+        # PTRS only stores digests, so we find the pointers themselves
+        # by looking at the pointer field of the messages we know have
+        # been seen in this mailbox. Messages which have moved elsewhere
+        # get dropped from the bitmap as we go.
+        ptrs, gone = [], []
+        msg_idxs = self.MAILBOX_MSGS.get(mailbox_idx)
+        for pos in (msg_idxs or []):
+            try:
+                msg_ptrs = self._get_msg_ptrs(pos)
+            except IndexError:
+                msg_ptrs = u''
+            found = False
+            for p in msg_ptrs.split(','):
+                if (p[:MBX_ID_LEN] == mailbox_idx and
+                        self.PTRS.get(p) == pos):
+                    ptrs.append(p)
+                    found = True
+            if not found:
+                gone.append(pos)
+        for pos in gone:
+            msg_idxs.discard(pos)
+        return ptrs
+
     def _remove_location(self, session, msg_ptr):
         msg_idx_pos = self.PTRS[msg_ptr]
         del self.PTRS[msg_ptr]
@@ -625,9 +1186,53 @@ class MailIndex(object):
             })
         return progress
 
+    def _parse_pool(self, session):
+        # This is normally created by prepare_workers, but the number of
+        # processes may have been changed since then.
+        return ConfigureParsePool(session.config,
+                                  session.config.sys.index_processes)
+
+    def _parse_in_pool(self, session, pool, jobs):
+        try:
+            return pool.map(_parse_worker, jobs)
+        except (IOError, OSError, ValueError, AssertionError):
+            if 'rescan' in session.config.sys.debug:
+                session.ui.debug(traceback.format_exc())
+            return None
+
+    def _parse_new_messages(self, session, pool, mailbox_idx, mbox, messages,
+                            start, limit=None):
+        """
+        Read the next batch of new messages and parse them in parallel.
+        Returns a dict mapping positions in the messages list to tuples of
+        (raw message, parse results), or None if the pool has failed.
+        """
+        limit = min(limit or self.PARSE_BATCH_SIZE, self.PARSE_BATCH_SIZE)
+        batch = []
+        for ui in range(start, len(messages)):
+            if len(batch) >= limit:
+                break
+            msg_ptr = mbox.get_msg_ptr(mailbox_idx, messages[ui])
+            if msg_ptr in self.PTRS:
+                continue
+            try:
+                msg_data = mbox.get_file(messages[ui]).read()
+            except (IOError, OSError, ValueError, IndexError, KeyError):
+                # The serial code will report this, let it deal with it.
+                continue
+            batch.append((ui, msg_ptr, msg_data))
+
+        results = self._parse_in_pool(session, pool, [
+            (mailbox_idx, msg_ptr, msg_data)
+            for ui, msg_ptr, msg_data in batch])
+        if results is None:
+            return None
+        return dict((ui, (msg_data, result))
+                    for (ui, msg_ptr, msg_data), result in zip(batch, results))
+
     def scan_mailbox(self, session, mailbox_idx, mailbox_fn, mailbox_opener,
                      process_new=None, apply_tags=None, stop_after=None,
-                     editable=False, event=None):
+                     editable=False, event=None, headers_only=None):
         mailbox_idx = FormatMbxId(mailbox_idx)
         progress = self._get_scan_progress(mailbox_idx,
                                            event=event, reset=True)
@@ -658,7 +1263,7 @@ class MailIndex(object):
                                 ) % (mailbox_idx, mailbox_fn, e),
                           error=True)
 
-        if len(self.PTRS.keys()) == 0:
+        if not self.PTRS:
             self.update_ptrs_and_msgids(session)
 
         existing_ptrs = set()
@@ -683,64 +1288,106 @@ class MailIndex(object):
 
         # Figure out which messages exist at all (so we can remove
         # stale pointers later on).
+        new_messages = 0
         for ui in range(0, len(messages)):
             msg_ptr = mbox.get_msg_ptr(mailbox_idx, messages[ui])
             existing_ptrs.add(msg_ptr)
+            if msg_ptr not in self.PTRS:
+                new_messages += 1
             if (ui % 317) == 0:
                 play_nice_with_threads()
 
+        # If there is a whole lot of new mail, we make it usable sooner by
+        # only indexing the headers now and the rest in the background.
+        # Otherwise, if there is a lot, we parse it in parallel.
+        if headers_only is None:
+            headers_only = (session.config.sys.index_headers_first and
+                            session.config.scan_worker !=
+                            session.config.dumb_worker and
+                            new_messages >= self.HEADERS_FIRST_MIN_MESSAGES)
+        parse_pool = None
+        if new_messages >= self.PARSE_MIN_MESSAGES and not headers_only:
+            parse_pool = self._parse_pool(session)
+        parsed = {}
+
         added = updated = 0
         last_date = long(time.time())
         not_done_yet = 'NOT DONE YET'
-        for ui in range(0, len(messages)):
-            if mailpile.util.QUITTING or self.interrupt:
-                self.interrupt = None
-                return finito(-1, _('Rescan interrupted: %s'
-                                    ) % self.interrupt)
-            if stop_after and added >= stop_after:
-                messages_md5 = not_done_yet
-                break
-
-            i = messages[ui]
-            msg_ptr = mbox.get_msg_ptr(mailbox_idx, i)
-            if msg_ptr in self.PTRS:
-                if (ui % 317) == 0:
+        with self._lock:
+            self._scanning += 1
+        try:
+            for ui in range(0, len(messages)):
+                if mailpile.util.QUITTING or self.interrupt:
+                    self.interrupt = None
+                    return finito(-1, _('Rescan interrupted: %s'
+                                        ) % self.interrupt)
+                if stop_after and added >= stop_after:
+                    messages_md5 = not_done_yet
+                    break
+
+                i = messages[ui]
+                msg_ptr = mbox.get_msg_ptr(mailbox_idx, i)
+                if msg_ptr in self.PTRS:
+                    if (ui % 317) == 0:
+                        session.ui.mark(parse_status(ui))
+                    elif (ui % 129) == 0:
+                        play_nice_with_threads()
+                    continue
+                else:
                     session.ui.mark(parse_status(ui))
-                elif (ui % 129) == 0:
-                    play_nice_with_threads()
-                continue
-            else:
-                session.ui.mark(parse_status(ui))
 
-            # Message new or modified, let's parse it.
-            try:
-                last_date, a, u = self.scan_one_message(session,
-                                                        mailbox_idx, mbox, i,
-                                                        wait=True,
-                                                        msg_ptr=msg_ptr,
-                                                        last_date=last_date,
-                                                        process_new=process_new,
-                                                        apply_tags=apply_tags,
-                                                        stop_after=stop_after,
-                                                        editable=editable,
-                                                        event=event,
-                                                        progress=progress)
-            except TypeError:
-                a = u = 0
-
-            added += a
-            updated += u
+                if parse_pool is not None and ui not in parsed:
+                    parsed = self._parse_new_messages(
+                        session, parse_pool, mailbox_idx, mbox, messages, ui,
+                        (stop_after - added) if stop_after else None)
+                    if parsed is None:
+                        # The pool is broken; shut it down, it will be
+                        # recreated the next time it is needed.
+                        ConfigureParsePool(session.config, 0)
+                        parse_pool, parsed = None, {}
+                msg_data, msg_parsed = parsed.get(ui, (None, None))
+
+                # Message new or modified, let's parse it.
+                try:
+                    last_date, a, u = self.scan_one_message(
+                        session, mailbox_idx, mbox, i,
+                        wait=True,
+                        msg_ptr=msg_ptr,
+                        msg_data=msg_data,
+                        parsed=msg_parsed,
+                        headers_only=headers_only,
+                        last_date=last_date,
+                        process_new=process_new,
+                        apply_tags=apply_tags,
+                        stop_after=stop_after,
+                        editable=editable,
+                        event=event,
+                        progress=progress)
+                except TypeError:
+                    a = u = 0
+
+                added += a
+                updated += u
+        finally:
+            with self._lock:
+                self._scanning -= 1
+            # Don't leave the last messages' postings sitting in memory
+            # until something else happens to flush them.
+            GlobalPostingList.Flush(session)
 
         with self._lock:
-            for msg_ptr in self.PTRS.keys():
-                if (msg_ptr[:MBX_ID_LEN] == mailbox_idx and
-                        msg_ptr not in existing_ptrs):
+            for msg_ptr in self._mailbox_ptrs(mailbox_idx):
+                if msg_ptr not in existing_ptrs:
                     self._remove_location(session, msg_ptr)
                     updated += 1
         progress.update({
             'added': added,
             'updated': updated,
         })
+        if headers_only:
+            progress['deferred'] = added
+        if self.DEFERRED is None or self.DEFERRED:
+            self.schedule_deferred(session, event=event)
         play_nice_with_threads()
 
         self._scanned[mailbox_idx] = messages_md5
@@ -764,9 +1411,50 @@ class MailIndex(object):
                 session, task, lambda: self._real_scan_one(*args, **kwargs))
             return 0, 0, 0
 
+    def parse_for_index(self, session, mailbox_idx, msg_ptr, msg_data):
+        """
+        Do the expensive, read-only part of indexing a message: parse it
+        and extract keywords and a snippet. This changes nothing, so it is
+        safe to run in a worker process. Returns (msg_ts, keywords,
+        body_info), or None if the message needs more than that (crypto,
+        or a date which depends on the previous message) and has to be
+        indexed the usual way.
+        """
+        msg = ParseMessage(cStringIO.StringIO(msg_data), pgpmime=False,
+                           config=session.config, lazy=True)
+        for part in msg.walk():
+            ctype = part.get_content_type()
+            if ctype in ('multipart/signed', 'multipart/encrypted'):
+                return None
+
+        msg_id = self.get_msg_id(msg, msg_ptr)
+        msg_ts = self._extract_date_ts(session, '', msg_id, msg, -1)
+        if msg_ts == -1:
+            return None
+
+        keywords, body_info = self.read_message(session, '', msg_id, msg,
+                                                len(msg_data), msg_ts,
+                                                mailbox=mailbox_idx)
+        if 'crypto:has' in keywords:
+            return None
+        return msg_ts, keywords, body_info
+
+    def _parse_headers(self, msg_fd):
+        lines = []
+        for line in iter(msg_fd.readline, ''):
+            if not line.strip():
+                break
+            lines.append(line)
+        msg_fd.seek(0, 2)
+        msg = email.parser.HeaderParser().parsestr(''.join(lines))
+        msg.signature_info = SignatureInfo(bubbly=False)
+        msg.encryption_info = EncryptionInfo(bubbly=False)
+        return msg
+
     def _real_scan_one(self, session,
                        mailbox_idx, mbox, msg_mbox_idx,
-                       msg_ptr=None, msg_data=None, last_date=None,
+                       msg_ptr=None, msg_data=None, parsed=None,
+                       headers_only=False, last_date=None,
                        process_new=None, apply_tags=None, stop_after=None,
                        editable=False, event=None, progress=None):
         added = updated = 0
@@ -783,9 +1471,17 @@ class MailIndex(object):
                 msg_fd = cStringIO.StringIO(msg_data)
             else:
                 msg_fd = mbox.get_file(msg_mbox_idx)
-            msg = ParseMessage(msg_fd,
-                               pgpmime=session.config.prefs.index_encrypted,
-                               config=session.config)
+            if parsed:
+                # The hard work is done, the headers are all we need now.
+                msg = email.parser.HeaderParser().parse(msg_fd)
+            elif headers_only:
+                msg = self._parse_headers(msg_fd)
+            else:
+                pgpmime = session.config.prefs.index_encrypted
+                # Attachments are only read if something needs them.
+                msg = ParseMessage(msg_fd, pgpmime=pgpmime,
+                                   config=session.config, lazy=True)
+            msg_size = msg_fd.tell()
         except (IOError, OSError, ValueError, IndexError, KeyError):
             if session.config.sys.debug:
                 traceback.print_exc()
@@ -801,8 +1497,9 @@ class MailIndex(object):
                 updated += 1
         else:
             msg_info = self._index_incoming_message(
-                session, msg_id, msg_ptr, msg_fd.tell(), msg,
-                last_date + 1, mailbox_idx, process_new, apply_tags)
+                session, msg_id, msg_ptr, msg_size, msg,
+                last_date + 1, mailbox_idx, process_new, apply_tags,
+                parsed=parsed, headers_only=headers_only)
             last_date = long(msg_info[self.MSG_DATE], 36)
             added += 1
 
@@ -841,21 +1538,31 @@ class MailIndex(object):
     def _extract_info_and_index(self, session, mailbox_idx,
                                 msg_mid, msg_id,
                                 msg_size, msg, default_date,
-                                **index_kwargs):
+                                parsed=None, **index_kwargs):
         # Extract info from the message headers
-        msg_ts = self._extract_date_ts(session, msg_mid, msg_id, msg,
-                                       default_date)
+        if parsed:
+            msg_ts, keywords, body_info = parsed
+        else:
+            msg_ts = self._extract_date_ts(session, msg_mid, msg_id, msg,
+                                           default_date)
+            keywords = body_info = None
         msg_to = AddressHeaderParser(msg.get('to', ''))
         msg_cc = (AddressHeaderParser(msg.get('cc', '')) +
                   AddressHeaderParser(msg.get('bcc', '')))
         msg_subj = self.hdr(msg, 'subject')
 
-        filters = _plugins.get_filter_hooks([self.filter_keywords])
+        if index_kwargs.get('headers_only'):
+            # Filters and autotaggers need the body, they get run when
+            # the deferred pass indexes it; see index_email().
+            filters = []
+        else:
+            filters = _plugins.get_filter_hooks([self.filter_keywords])
         kw, bi = self.index_message(session, msg_mid, msg_id,
                                     msg, msg_size, msg_ts,
                                     mailbox=mailbox_idx,
-                                    compact=False,
                                     filter_hooks=filters,
+                                    keywords=keywords,
+                                    snippet=body_info,
                                     **index_kwargs)
 
         snippet_max = session.config.sys.snippet_max
@@ -869,7 +1576,8 @@ class MailIndex(object):
 
     def _index_incoming_message(self, session,
                                 msg_id, msg_ptr, msg_size, msg, default_date,
-                                mailbox_idx, process_new, apply_tags):
+                                mailbox_idx, process_new, apply_tags,
+                                parsed=None, headers_only=False):
         # First, add the message to the index so we can index terms to
         # the right MID.
         msg_idx_pos, msg_info = self.add_new_msg(
@@ -882,8 +1590,10 @@ class MailIndex(object):
          ) = self._extract_info_and_index(session, mailbox_idx,
                                           msg_mid, msg_id, msg_size, msg,
                                           default_date,
+                                          parsed=parsed,
                                           process_new=process_new,
                                           apply_tags=apply_tags,
+                                          headers_only=headers_only,
                                           incoming=True)
 
         # Finally, update the metadata index with whatever we learned
@@ -897,9 +1607,11 @@ class MailIndex(object):
 
         self.set_msg_at_idx_pos(msg_idx_pos, msg_info)
         self.set_conversation_ids(msg_info[self.MSG_MID], msg)
+        if headers_only and self.DEFERRED is not None:
+            self.DEFERRED.add(msg_idx_pos)
         return msg_info
 
-    def index_email(self, session, email):
+    def index_email(self, session, email, incoming=False, deferred=False):
         # Extract info from the email object...
         msg = email.get_msg(pgpmime=session.config.prefs.index_encrypted,
                             crypto_state_feedback=False)
@@ -910,11 +1622,25 @@ class MailIndex(object):
         mailbox_idx = msg_info[self.MSG_PTRS].split(',')[0][:MBX_ID_LEN]
         default_date = long(msg_info[self.MSG_DATE], 36)
 
+        # When finishing a header-only scan, the filters see the tags the
+        # message has now and may remove them as well as add new ones.
+        old_tags = []
+        if deferred:
+            for tag_id in self.get_tags(msg_info=msg_info):
+                tag = session.config.get_tag(tag_id)
+                if tag and not tag.slug.startswith('mp_'):
+                    old_tags.append(tag_id)
+
         (msg_ts, msg_to, msg_cc, msg_subj, msg_body, tags
          ) = self._extract_info_and_index(session, mailbox_idx,
                                           msg_mid, msg_id, msg_size, msg,
                                           default_date,
-                                          incoming=False)
+                                          # The mail source defaults were
+                                          # applied when the message was
+                                          # first added, don't repeat them.
+                                          process_new=False,
+                                          apply_tags=old_tags,
+                                          incoming=incoming)
         self.edit_msg_info(msg_info,
                            msg_ts=msg_ts,
                            msg_from=self.hdr(msg, 'from'),
@@ -931,10 +1657,98 @@ class MailIndex(object):
             if tag and tag.slug.startswith('mp_'):
                 self.remove_tag(session, tag_id, msg_idxs=[email.msg_idx_pos])
 
+        # Remove tags the filters took away
+        for tag_id in set(old_tags) - set(tags):
+            self.remove_tag(session, tag_id, msg_idxs=[email.msg_idx_pos])
+
         # Add normal tags implied by a rescan
         for tag_id in tags:
             self.add_tag(session, tag_id, msg_idxs=[email.msg_idx_pos])
 
+    def _update_deferred(self, msg_idx_pos, msg_info):
+        if self.DEFERRED is None:
+            return
+        if ('"deferred"' in msg_info[self.MSG_BODY] and
+                self.get_body(msg_info).get('deferred')):
+            self.DEFERRED.add(msg_idx_pos)
+        else:
+            self.DEFERRED.discard(msg_idx_pos)
+
+    def _find_deferred(self):
+        deferred = set()
+        for msg_idx_pos in range(0, len(self.INDEX)):
+            try:
+                msg_info = self._get_msg_info(msg_idx_pos)
+                if ('"deferred"' in msg_info[self.MSG_BODY] and
+                        self.get_body(msg_info).get('deferred')):
+                    deferred.add(msg_idx_pos)
+            except (IndexError, ValueError):
+                pass
+            if (msg_idx_pos % 1009) == 0:
+                play_nice_with_threads()
+        return deferred
+
+    def index_deferred(self, session, event=None, should_stop=None):
+        """
+        Index the bodies of messages which a header-only scan skipped,
+        newest first, stopping early if should_stop() returns True.
+        Returns the number of messages still waiting.
+        """
+        if self.DEFERRED is None:
+            self.DEFERRED = self._find_deferred()
+
+        indexed = 0
+        for msg_idx_pos in sorted(self.DEFERRED, reverse=True):
+            if mailpile.util.QUITTING or (should_stop and should_stop()):
+                break
+            if (indexed % 97) == 0:
+                session.ui.mark(_('Indexing message contents: %d left'
+                                  ) % (len(self.DEFERRED)))
+            try:
+                self.index_email(session, Email(self, msg_idx_pos),
+                                 incoming=True, deferred=True)
+            except (IOError, OSError, ValueError, IndexError, KeyError):
+                if 'rescan' in session.config.sys.debug:
+                    session.ui.debug(traceback.format_exc())
+                session.ui.warning(_('Failed to index: %s'
+                                     ) % b36(msg_idx_pos))
+            self.DEFERRED.discard(msg_idx_pos)
+            indexed += 1
+            play_nice_with_threads()
+        GlobalPostingList.Flush(session)
+
+        if event:
+            progress = event.data.get('deferred', {})
+            progress.update({
+                'indexed': progress.get('indexed', 0) + indexed,
+                'pending': len(self.DEFERRED)
+            })
+            event.data['deferred'] = progress
+            session.config.event_log.log_event(event)
+        return len(self.DEFERRED)
+
+    def schedule_deferred(self, session, event=None):
+        """Index deferred message bodies as a low priority scan task."""
+        config = session.config
+        worker = config.scan_worker
+        if worker == config.dumb_worker:
+            return
+        if self.DEFERRED is not None and not self.DEFERRED:
+            return
+
+        def should_stop():
+            # Yield to any other scanning work; new mail comes first.
+            return self._scanning or worker.JOBS
+
+        def index_deferred():
+            if (self.index_deferred(config.background, event=event,
+                                    should_stop=should_stop)
+                    and not self._scanning):
+                self.schedule_deferred(session, event=event)
+
+        worker.add_unique_task(config.background, 'index_deferred',
+                               index_deferred)
+
     def set_conversation_ids(self, msg_mid, msg, subject_threading=True):
         msg_thr_mid = None
         refs = set((self.hdr(msg, 'references') + ' ' +
@@ -1181,12 +1995,12 @@ class MailIndex(object):
                 # FIXME: These should be tags!
                 keywords.append('attachment:has')
                 keywords.extend([t + ':att' for t
-                                 in re.findall(WORD_REGEXP, att.lower())])
+                                 in Tokenize(att, stoplist=None)])
                 textpart = (textpart or '') + ' ' + att
 
             if textpart:
                 # FIXME: Does this lowercase non-ASCII characters correctly?
-                keywords.extend(re.findall(WORD_REGEXP, textpart.lower()))
+                keywords.extend(Tokenize(textpart))
 
                 # NOTE: As a side effect here, the cryptostate plugin will
                 #       add a 'crypto:has' keyword which we check for below
@@ -1223,15 +2037,29 @@ class MailIndex(object):
             # Index the contents, if configured to do so
             if session.config.prefs.index_encrypted:
                 for text in [t['data'] for t in tree['text_parts']]:
-                    keywords.extend(re.findall(WORD_REGEXP, text.lower()))
+                    keywords.extend(Tokenize(text))
                     for kwe in _plugins.get_text_kw_extractors():
                         keywords.extend(kwe(self, msg, 'text/plain', text))
 
-        keywords.append('%s:id' % msg_id)
-        keywords.extend(re.findall(WORD_REGEXP,
-                                   self.hdr(msg, 'subject').lower()))
-        keywords.extend(re.findall(WORD_REGEXP,
-                                   self.hdr(msg, 'from').lower()))
+        keywords.extend(self.read_headers(session, msg_mid, msg_id, msg,
+                                          msg_size, msg_ts, mailbox=mailbox))
+
+        # FIXME: Allow plugins to augment the body_info
+
+        if snippet_text.strip() != '':
+            body_info['snippet'] = self.clean_snippet(snippet_text[:1024])
+        else:
+            body_info['snippet'] = self.clean_snippet(snippet_html[:1024])
+
+        return (set(keywords) - STOPLIST), body_info
+
+    def read_headers(self, session,
+                     msg_mid, msg_id, msg, msg_size, msg_ts,
+                     mailbox=None):
+        """Extract the keywords which only depend on the message headers."""
+        keywords = ['%s:id' % msg_id]
+        keywords.extend(Tokenize(self.hdr(msg, 'subject')))
+        keywords.extend(Tokenize(self.hdr(msg, 'from')))
         if mailbox:
             keywords.append('%s:mailbox' % FormatMbxId(mailbox).lower())
         keywords.append('%s:hp' % HeaderPrint(msg))
@@ -1239,10 +2067,9 @@ class MailIndex(object):
         for key in msg.keys():
             key_lower = key.lower()
             if key_lower not in BORING_HEADERS:
-                emails = ExtractEmails(self.hdr(msg, key).lower())
-                words = set(re.findall(WORD_REGEXP,
-                                       self.hdr(msg, key).lower()))
-                words -= STOPLIST
+                value = self.hdr(msg, key).lower()
+                emails = ExtractEmails(value)
+                words = Tokenize(value)
                 keywords.extend(['%s:%s' % (t, key_lower) for t in words])
                 keywords.extend(['%s:%s' % (e, key_lower) for e in emails])
                 keywords.extend(['%s:email' % e for e in emails])
@@ -1255,14 +2082,7 @@ class MailIndex(object):
         for extract in _plugins.get_meta_kw_extractors():
             keywords.extend(extract(self, msg_mid, msg, msg_size, msg_ts))
 
-        # FIXME: Allow plugins to augment the body_info
-
-        if snippet_text.strip() != '':
-            body_info['snippet'] = self.clean_snippet(snippet_text[:1024])
-        else:
-            body_info['snippet'] = self.clean_snippet(snippet_html[:1024])
-
-        return (set(keywords) - STOPLIST), body_info
+        return keywords
 
     # FIXME: Here it would be nice to recognize more boilerplate junk in
     #        more languages!
@@ -1284,12 +2104,23 @@ class MailIndex(object):
                 ).strip()
 
     def index_message(self, session, msg_mid, msg_id, msg, msg_size, msg_ts,
-                      mailbox=None, compact=True, filter_hooks=None,
-                      process_new=None, apply_tags=None, incoming=False):
-        keywords, snippet = self.read_message(session,
-                                              msg_mid, msg_id, msg,
-                                              msg_size, msg_ts,
-                                              mailbox=mailbox)
+                      mailbox=None, filter_hooks=None,
+                      process_new=None, apply_tags=None, incoming=False,
+                      keywords=None, snippet=None, headers_only=False):
+        if keywords is not None:
+            pass
+        elif headers_only:
+            # The body gets indexed later on, see index_deferred()
+            keywords = set(self.read_headers(session,
+                                             msg_mid, msg_id, msg,
+                                             msg_size, msg_ts,
+                                             mailbox=mailbox)) - STOPLIST
+            snippet = {'snippet': '', 'deferred': True}
+        else:
+            keywords, snippet = self.read_message(session,
+                                                  msg_mid, msg_id, msg,
+                                                  msg_size, msg_ts,
+                                                  mailbox=mailbox)
 
         # Apply the defaults for this mail source / mailbox.
         if apply_tags:
@@ -1312,40 +2143,48 @@ class MailIndex(object):
         if 'keywords' in self.config.sys.debug:
             print 'KEYWORDS: %s' % keywords
 
-        for word in keywords:
-            if (word.startswith('__') or
-                    # Tags are now handled outside the posting lists
-                    word.endswith(':tag') or word.endswith(':in')):
-                continue
-            try:
-                GlobalPostingList.Append(session, word, [msg_mid],
-                                         compact=compact)
-            except UnicodeDecodeError:
-                # FIXME: we just ignore garbage
-                pass
+        GlobalPostingList.Buffer(session, [
+            word for word in keywords if not (
+                word.startswith('__') or
+                # Tags are now handled outside the posting lists
+                word.endswith(':tag') or word.endswith(':in'))], msg_mid)
 
         self.config.command_cache.mark_dirty(set([u'mail:all']) | keywords)
         return keywords, snippet
 
+    def _get_msg_info(self, msg_idx):
+        get_msg_info = getattr(self.INDEX, 'get_msg_info', None)
+        if get_msg_info is not None:
+            return get_msg_info(msg_idx)
+        return self.l2m(self.INDEX[msg_idx])
+
+    def _get_msg_ptrs(self, msg_idx):
+        # Cheaper than _get_msg_info, as only one field gets decoded.
+        get_msg_ptrs = getattr(self.INDEX, 'get_msg_ptrs', None)
+        if get_msg_ptrs is not None:
+            return get_msg_ptrs(msg_idx)
+        fields = self.INDEX[msg_idx].split('\t', 2)
+        return fields[1].decode('utf-8') if (len(fields) > 1) else u''
+
     def get_msg_at_idx_pos(self, msg_idx):
         try:
             rv = self.CACHE.get(msg_idx)
             if rv is None:
-                if len(self.CACHE) > 20000:
-                    self.CACHE = {}
-                rv = self.CACHE[msg_idx] = self.l2m(self.INDEX[msg_idx])
+                rv = self.CACHE[msg_idx] = self._get_msg_info(msg_idx)
             if len(rv) != self.MSG_FIELDS_V2:
                 raise ValueError()
             return rv
         except (IndexError, ValueError):
             return self.BOGUS_METADATA[:]
 
-    def update_msg_sorting(self, msg_idx, msg_info):
-        for order, sorter in self.SORT_ORDERS.iteritems():
+    def update_msg_sorting(self, msg_idx, msg_info, orders=None):
+        for order in (orders or self.SORT_ORDERS):
+            sorter = self.SORT_ORDERS[order]
             self.INDEX_SORT[order][msg_idx] = sorter(self, msg_info)
 
     def set_msg_at_idx_pos(self, msg_idx, msg_info, original_line=None):
         with self._lock:
+            fresh = (msg_idx >= len(self.INDEX))
             while len(self.INDEX) <= msg_idx:
                 self.INDEX.append('')
                 self.INDEX_THR.append(-1)
@@ -1358,8 +2197,9 @@ class MailIndex(object):
         self.MSGIDS[msg_info[self.MSG_ID]] = msg_idx
         for msg_ptr in msg_info[self.MSG_PTRS].split(','):
             self.PTRS[msg_ptr] = msg_idx
+        self._index_mailbox_ptrs(msg_idx, msg_info)
         self.update_msg_sorting(msg_idx, msg_info)
-        self.update_msg_tags(msg_idx, msg_info)
+        self.update_msg_tags(msg_idx, msg_info, fresh=fresh)
 
         if not original_line:
             dirty_tags = [u'%s:in' % self.config.tags[t].slug for t in
@@ -1424,25 +2264,31 @@ class MailIndex(object):
         eids = set()
         added = set()
         threads = set()
+        added_tags = []
         for msg_idx in msg_idxs:
             if msg_idx >= 0 and msg_idx < len(self.INDEX):
                 msg_info = self.get_msg_at_idx_pos(msg_idx)
                 tags = set([r for r in msg_info[self.MSG_TAGS].split(',')
                             if r])
                 if tag_id not in tags:
+                    added_tags.append(set([t for t in tags if msg_idx
+                                        in self.TAGS.get(t, ())]))
                     tags.add(tag_id)
                     msg_info[self.MSG_TAGS] = ','.join(list(tags))
                     self.INDEX[msg_idx] = self.m2l(msg_info)
                     self.MODIFIED.add(msg_idx)
-                    self.update_msg_sorting(msg_idx, msg_info)
+                    self.update_msg_sorting(msg_idx, msg_info,
+                                            self.TAG_SORT_ORDERS)
                     added.add(msg_idx)
                     threads.add(msg_info[self.MSG_THREAD_MID])
                 eids.add(msg_idx)
         with self._lock:
             if tag_id in self.TAGS:
-                self.TAGS[tag_id] |= eids
+                self.TAGS[tag_id] |= AsBitmap(eids)
             elif eids:
-                self.TAGS[tag_id] = eids
+                self.TAGS[tag_id] = Bitmap(eids)
+            for old_tags in added_tags:
+                self._update_tag_counts(old_tags, old_tags | set([tag_id]))
         try:
             self.config.command_cache.mark_dirty(
                 [u'mail:all', u'%s:in' % self.config.tags[tag_id].slug] +
@@ -1477,23 +2323,29 @@ class MailIndex(object):
         eids = set()
         removed = set()
         threads = set()
+        removed_tags = []
         for msg_idx in msg_idxs:
             if msg_idx >= 0 and msg_idx < len(self.INDEX):
                 msg_info = self.get_msg_at_idx_pos(msg_idx)
                 tags = set([r for r in msg_info[self.MSG_TAGS].split(',')
                             if r])
                 if tag_id in tags:
+                    removed_tags.append(set([t for t in tags if msg_idx
+                                        in self.TAGS.get(t, ())]))
                     tags.remove(tag_id)
                     msg_info[self.MSG_TAGS] = ','.join(list(tags))
                     self.INDEX[msg_idx] = self.m2l(msg_info)
                     self.MODIFIED.add(msg_idx)
-                    self.update_msg_sorting(msg_idx, msg_info)
+                    self.update_msg_sorting(msg_idx, msg_info,
+                                            self.TAG_SORT_ORDERS)
                     removed.add(msg_idx)
                     threads.add(msg_info[self.MSG_THREAD_MID])
                 eids.add(msg_idx)
         with self._lock:
             if tag_id in self.TAGS:
-                self.TAGS[tag_id] -= eids
+                self.TAGS[tag_id] -= AsBitmap(eids)
+            for old_tags in removed_tags:
+                self._update_tag_counts(old_tags, old_tags - set([tag_id]))
         try:
             self.config.command_cache.mark_dirty(
                 [u'%s:in' % self.config.tags[tag_id].slug] +
@@ -1506,17 +2358,152 @@ class MailIndex(object):
     def search_tag(self, session, term, hits, recursion=0):
         t = term.split(':', 1)
         tag_id, tag = t[1], self.config.get_tag(t[1])
-        results = []
+        results = Bitmap()
         if tag:
             tag_id = tag._key
             for subtag in self.config.get_tags(parent=tag_id):
-                results.extend(hits('%s:in' % subtag._key))
+                results |= hits('%s:in' % subtag._key)
             if tag.magic_terms and recursion < 5:
-                results.extend(self.search(session, [tag.magic_terms],
-                                           recursion=recursion+1).as_set())
-        results.extend(hits('%s:in' % tag_id))
+                results |= self.search(session, [tag.magic_terms],
+                                       recursion=recursion+1).as_bitmap()
+        results |= hits('%s:in' % tag_id)
         return results
 
+    def _search_term(self, session, term, hits, recursion=0):
+        """Find the messages matching a single (lowercased) search term."""
+        rt = Bitmap()
+        if ':' in term:
+            if term.startswith('in:'):
+                rt |= self.search_tag(session, term, hits,
+                                      recursion=recursion)
+            elif term.startswith('body:'):
+                rt |= hits(term[5:])
+            elif term == 'all:mail':
+                return Bitmap.Range(len(self.INDEX))
+            elif term in ('to:me', 'cc:me', 'from:me'):
+                vcards = self.config.vcards
+                emails = []
+                for vc in vcards.find_vcards([], kinds=['profile']):
+                    emails += [vcl.value for vcl in vc.get_all('email')]
+                for email in set(emails):
+                    if email:
+                        rt |= hits('%s:%s' % (email, term.split(':')[0]))
+            elif term == 'is:encrypted':
+                for status in EncryptionInfo.STATUSES:
+                    if status in CryptoInfo.STATUSES:
+                        continue
+                    rt |= self.search_tag(session, 'in:mp_enc-%s' % status,
+                                          hits, recursion=recursion)
+            elif term == 'is:signed':
+                for status in SignatureInfo.STATUSES:
+                    if status in CryptoInfo.STATUSES:
+                        continue
+                    rt |= self.search_tag(session, 'in:mp_sig-%s' % status,
+                                          hits, recursion=recursion)
+            else:
+                t = term.split(':', 1)
+                fnc = _plugins.get_search_term(t[0])
+                if fnc:
+                    rt |= AsBitmap(fnc(self.config, self, term, hits))
+                else:
+                    rt |= hits('%s:%s' % (t[1], t[0]))
+        else:
+            rt |= hits(term)
+        return rt
+
+    # Cost classes for the query planner
+    PLAN_EXACT = 0      # Tags and all:mail: we know exactly what we'll get
+    PLAN_KEYWORD = 1    # A single posting list lookup
+    PLAN_COMPLEX = 2    # Several lookups, plugins or recursive searches
+
+    # Plugin search filters are used if there are at most this many
+    # candidate messages left to check.
+    SEARCH_FILTER_MAX = 5000
+
+    def _plan_term(self, session, term, keywords=None):
+        """
+        Estimate the cost of a search term and the number of messages it
+        will match, returning a sort key for the query planner.
+        """
+        if keywords is not None:
+            return (self.PLAN_KEYWORD, 0)
+        if term == 'all:mail':
+            return (self.PLAN_EXACT, len(self.INDEX))
+        if term.startswith('in:'):
+            tag = ('tags' in self.config) and self.config.get_tag(term[3:])
+            if not tag:
+                return (self.PLAN_EXACT, 0)
+            if tag.magic_terms:
+                return (self.PLAN_COMPLEX, len(self.INDEX))
+            return (self.PLAN_EXACT, sum(
+                len(self.TAGS.get(t._key, ())) for t in
+                [tag] + self.config.get_tags(parent=tag._key)))
+
+        if term.startswith('body:'):
+            word = term[5:]
+        elif ':' in term:
+            t = term.split(':', 1)
+            if (term in ('to:me', 'cc:me', 'from:me') or
+                    t[0] == 'is' or _plugins.get_search_term(t[0])):
+                return (self.PLAN_COMPLEX, len(self.INDEX))
+            word = '%s:%s' % (t[1], t[0])
+        else:
+            word = term
+        estimate = GlobalPostingList.Estimate(session, word)
+        if estimate is None:
+            estimate = len(self.INDEX)
+        return (self.PLAN_KEYWORD, estimate)
+
+    def _filter_term(self, term, candidates, keywords=None):
+        """Use a plugin filter on a small candidate set, if we can."""
+        if keywords is not None or len(candidates) > self.SEARCH_FILTER_MAX:
+            return None
+        fnc = _plugins.get_search_filter(term.split(':', 1)[0])
+        if fnc is None:
+            return None
+        return AsBitmap(fnc(self.config, self, term, candidates))
+
+    def _planned_search(self, session, terms, hits,
+                        keywords=None, recursion=0, context=None):
+        """
+        Evaluate a conjunction of positive and negative terms, starting
+        with the terms we expect to be cheapest and most selective. Once
+        the set of candidates is empty, we stop; expensive plugin terms
+        can filter the candidates directly instead of fetching all their
+        matches.
+        """
+        plan = [(self._plan_term(session, term, keywords=keywords), op, term)
+                for op, term in terms]
+        plan.sort(key=lambda p: (p[1] == '-',
+                                 p[0][0] == self.PLAN_COMPLEX,
+                                 p[0][1], p[0][0]))
+
+        results = AsBitmap(context).copy() if context else None
+        for cost, op, term in plan:
+            if op == '-' and results is None:
+                results = Bitmap()
+            if results is not None and not results:
+                break
+            if results is not None:
+                found = self._filter_term(term, results, keywords=keywords)
+                if found is not None:
+                    if op == '-':
+                        results -= found
+                    else:
+                        results = found
+                    continue
+
+            found = self._search_term(session, term, hits,
+                                      recursion=recursion)
+            if op == '-':
+                results -= found
+            elif results is None:
+                results = found.copy()
+            else:
+                results = results & found
+
+        return results if (results is not None) else Bitmap()
+
     def search(self, session, searchterms,
                keywords=None, order=None, recursion=0, context=None):
         # Stash the raw search terms, decide if this is cached or not
@@ -1531,15 +2518,14 @@ class MailIndex(object):
         # Choose how we are going to search
         if keywords is not None:
             def hits(term):
-                return [int(h, 36) for h in keywords.get(term, [])]
+                return Bitmap(int(h, 36) for h in keywords.get(term, []))
         else:
             def hits(term):
                 if term.endswith(':in'):
-                    return self.TAGS.get(term.rsplit(':', 1)[0], [])
+                    return self.TAGS.get(term.rsplit(':', 1)[0]) or Bitmap()
                 else:
                     session.ui.mark(_('Searching for %s') % term)
-                    return [int(h, 36) for h
-                            in GlobalPostingList(session, term).hits()]
+                    return GlobalPostingList(session, term).hits()
 
         # Replace some GMail-compatible terms with what we really use
         if 'tags' in self.config:
@@ -1558,82 +2544,50 @@ class MailIndex(object):
         if searchterms and searchterms[0] and searchterms[0][0] == '-':
             searchterms[:0] = ['all:mail']
 
-        if context:
-            r = [(None, set(context))]
-        else:
-            r = []
-
+        terms = []
         for term in searchterms:
             if term in STOPLIST:
                 if session:
                     session.ui.warning(_('Ignoring common word: %s') % term)
                 continue
-
             if term[0] in ('-', '+'):
-                op = term[0]
-                term = term[1:]
+                terms.append((term[0], term[1:].lower()))
+            else:
+                terms.append((None, term.lower()))
+
+        if [op for op, term in terms if op == '+']:
+            # Unions make the order of evaluation significant, so we
+            # just go from left to right.
+            if context:
+                r = [(None, AsBitmap(context))]
             else:
-                op = None
-
-            r.append((op, []))
-            rt = r[-1][1]
-            term = term.lower()
-
-            if ':' in term:
-                if term.startswith('in:'):
-                    rt.extend(self.search_tag(session, term, hits,
-                                              recursion=recursion))
-                elif term.startswith('body:'):
-                    rt.extend(hits(term[5:]))
-                elif term == 'all:mail':
-                    rt.extend(range(0, len(self.INDEX)))
-                elif term in ('to:me', 'cc:me', 'from:me'):
-                    vcards = self.config.vcards
-                    emails = []
-                    for vc in vcards.find_vcards([], kinds=['profile']):
-                        emails += [vcl.value for vcl in vc.get_all('email')]
-                    for email in set(emails):
-                        if email:
-                            rt.extend(hits('%s:%s' % (email,
-                                                      term.split(':')[0])))
-                elif term == 'is:encrypted':
-                    for status in EncryptionInfo.STATUSES:
-                        if status in CryptoInfo.STATUSES:
-                            continue
-                        rt.extend(self.search_tag(session,
-                                                  'in:mp_enc-%s' % status,
-                                                  hits, recursion=recursion))
-                elif term == 'is:signed':
-                    for status in SignatureInfo.STATUSES:
-                        if status in CryptoInfo.STATUSES:
-                            continue
-                        rt.extend(self.search_tag(session,
-                                                  'in:mp_sig-%s' % status,
-                                                  hits, recursion=recursion))
+                r = []
+            for op, term in terms:
+                if term == 'all:mail':
+                    r.append((op, Bitmap.Range(len(self.INDEX))))
                 else:
-                    t = term.split(':', 1)
-                    fnc = _plugins.get_search_term(t[0])
-                    if fnc:
-                        rt.extend(fnc(self.config, self, term, hits))
+                    r.append((op, self._search_term(session, term, hits,
+                                                    recursion=recursion)))
+            if r:
+                results = r[0][1].copy()
+                for (op, rt) in r[1:]:
+                    if op == '+':
+                        results |= rt
+                    elif op == '-':
+                        results -= rt
                     else:
-                        rt.extend(hits('%s:%s' % (t[1], t[0])))
+                        results &= rt
             else:
-                rt.extend(hits(term))
-
-        if r:
-            results = set(r[0][1])
-            for (op, rt) in r[1:]:
-                if op == '+':
-                    results |= set(rt)
-                elif op == '-':
-                    results -= set(rt)
-                else:
-                    results &= set(rt)
-            # Sometimes the scan gets aborted...
-            if keywords is None:
-                results -= set([len(self.INDEX)])
+                results = Bitmap()
         else:
-            results = set()
+            results = self._planned_search(session, terms, hits,
+                                           keywords=keywords,
+                                           recursion=recursion,
+                                           context=context)
+
+        # Sometimes the scan gets aborted...
+        if keywords is None:
+            results.discard(len(self.INDEX))
 
         # Unless we are searching for invisible things, remove them from
         # results by default.
@@ -1655,7 +2609,7 @@ class MailIndex(object):
                 exclude_terms = ([exclude_terms[0]] +
                                  ['+%s' % e for e in exclude_terms[1:]])
             # Recursing to pull the excluded terms from cache as well
-            exclude = self.search(session, exclude_terms).as_set()
+            exclude = self.search(session, exclude_terms).as_bitmap()
 
         srs.set_results(results, exclude)
         if session:
@@ -1675,21 +2629,75 @@ class MailIndex(object):
                 return ts + self.FRESHNESS_SORT_BOOST
         return ts
 
+    @classmethod
+    def _sort_text(self, msg_info, field):
+        # Lines replayed by load() are not decoded, the keys should match
+        # the ones for decoded rows.
+        value = msg_info[field]
+        if isinstance(value, str):
+            value = value.decode('utf-8', 'replace')
+        return value
+
+    def _from_sorter(self, msg_info):
+        sender = self._sort_text(msg_info, self.MSG_FROM)
+        return ExtractEmailAndName(sender)[1].lower()
+
+    SUBJECT_PREFIX = re.compile(r'^((re|fwd?|aw|sv)(\[\d+\])?:\s*)+', re.I)
+
+    def _subject_sorter(self, msg_info):
+        subject = self._sort_text(msg_info, self.MSG_SUBJECT).strip()
+        return self.SUBJECT_PREFIX.sub('', subject).lower()
+
     FRESHNESS_SORT_BOOST = (5 * 24 * 3600)
     SORT_ORDERS = {
         'freshness': _freshness_sorter,
         'date': lambda s, mi: long(mi[s.MSG_DATE], 36),
-# FIXME: The following are disabled for now for being memory hogs
-#       'from': lambda s, mi: s.mi[s.MSG_FROM]),
-#       'subject': lambda s, mi: s.mi[s.MSG_SUBJECT]),
+        'from': _from_sorter,
+        'subject': _subject_sorter
     }
+    SORT_COLUMNS = {
+        'from': RankedSortColumn,
+        'subject': RankedSortColumn
+    }
+
+    # Only these sort orders depend on tags, so only these need updating
+    # when messages are tagged or untagged.
+    TAG_SORT_ORDERS = ('freshness', )
 
-    def _prepare_sorting(self):
+    def _prepare_sorting(self, size=0):
         self._sort_freshness_tags = [tag._key for tag in
                                      self.config.get_tags(type='unread')]
         self.INDEX_SORT = {}
         for order, sorter in self.SORT_ORDERS.iteritems():
-            self.INDEX_SORT[order] = []
+            if order in self.SORT_COLUMNS:
+                self.INDEX_SORT[order] = self.SORT_COLUMNS[order](size)
+            else:
+                self.INDEX_SORT[order] = array('l', [0]) * size
+
+    def sorted_results(self, session, results, how):
+        """
+        Return a sorted version of the results, which may be lazy: when
+        sorting by one of our sort columns, only as many results as are
+        actually requested will get sorted.
+        """
+        how = how or 'flat-unsorted'
+        order = [o for o in self.INDEX_SORT if how.endswith(o)]
+        if order and results:
+            try:
+                threads = None if ('flat' in how) else self.INDEX_THR
+                session.ui.mark(_n('Sorting %d message by %s...',
+                                   'Sorting %d messages by %s...',
+                                   len(results)
+                                   ) % (len(results), _(how)))
+                return LazySortedResults(results, self.INDEX_SORT[order[0]],
+                                         how.startswith('rev'),
+                                         threads=threads)
+            except IndexError:
+                # Bogus results, let sort_results deal with that.
+                pass
+        results = list(results)
+        self.sort_results(session, results, how)
+        return results
 
     def sort_results(self, session, results, how):
         if not results:
@@ -0,0 +1,99 @@
+import hashlib
+import os
+import tempfile
+import threading
+import unittest
+
+import mailpile.crypto.streamer
+import mailpile.crypto.workers
+from mailpile.crypto.streamer import DecryptingStreamer, DecryptWithWorkers
+from mailpile.crypto.streamer import DecryptInProcess
+from mailpile.crypto.streamer import EncryptingDelimitedStreamer
+from mailpile.crypto.streamer import EncryptingStreamer
+
+
+class TestCryptoWorkers(unittest.TestCase):
+    DATA = 'Hello world! This is great!\nHooray, lalalalla!\n' * 10
+
+    def setUp(self):
+        mailpile.crypto.workers.Configure(2)
+        self.pool = mailpile.crypto.workers.CRYPTO_WORKERS
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        mailpile.crypto.workers.Configure(0)
+        for fn in os.listdir(self.tempdir):
+            os.remove(os.path.join(self.tempdir, fn))
+        os.rmdir(self.tempdir)
+
+    def test_round_trip(self):
+        encrypted = self.pool.run('enc', 'aes-256-cbc', 'key', self.DATA)
+        self.assertEqual(self.pool.run('dec', 'aes-256-cbc', 'key',
+                                       encrypted), self.DATA)
+        self.assertRaises(IOError, self.pool.run,
+                          'dec', 'aes-256-cbc', 'bad key', encrypted)
+
+        status = mailpile.crypto.workers.Status()
+        self.assertEqual(status['jobs'], 3)
+        self.assertEqual(status['errors'], 1)
+        self.assertEqual(status['started'], 1)
+        self.assertEqual(status['busy'], 0)
+
+    def test_streamers(self):
+        fn = os.path.join(self.tempdir, 'encrypted.aes')
+        with EncryptingStreamer('test key', dir=self.tempdir) as es:
+            self.assertTrue(es.workers is self.pool)
+            es.write(self.DATA)
+            es.save(fn)
+        self.assertEqual(self.pool.status()['jobs'], 1)
+
+        with open(fn, 'rb') as fd:
+            encrypted = fd.read()
+        self.assertEqual(DecryptWithWorkers(encrypted, 'test key'),
+                         self.DATA)
+        self.assertEqual(DecryptWithWorkers(encrypted, 'bad key'), None)
+
+        # The pool's output must be readable by the plain openssl path
+        mailpile.crypto.workers.Configure(0)
+        with open(fn, 'rb') as fd:
+            with DecryptingStreamer(fd, mep_key='test key',
+                                    md5sum=es.outer_md5sum) as ds:
+                self.assertEqual(ds.read(), self.DATA)
+                self.assertTrue(ds.verify())
+
+    def test_large_streams_use_coprocess(self):
+        fn = os.path.join(self.tempdir, 'large.aes')
+        data = 'x' * (EncryptingDelimitedStreamer.MAX_POOLED_BYTES + 1)
+        with EncryptingStreamer('test key', dir=self.tempdir) as es:
+            es.write(data)
+            es.save(fn)
+        self.assertEqual(self.pool.status()['jobs'], 0)
+        with open(fn, 'rb') as fd:
+            with DecryptingStreamer(fd, mep_key='test key') as ds:
+                self.assertEqual(ds.read(), data)
+                self.assertTrue(ds.verify())
+
+    @unittest.skipIf(mailpile.crypto.streamer.AES is None, 'No AES module')
+    def test_concurrent_in_process(self):
+        fn = os.path.join(self.tempdir, 'concurrent.aes')
+        with EncryptingStreamer('test key', dir=self.tempdir,
+                                delimited=True) as es:
+            es.write(self.DATA)
+            es.save(fn)
+        with open(fn, 'rb') as fd:
+            encrypted = fd.read()
+
+        # Start with the wrong digest, so every thread switches it
+        mailpile.crypto.streamer.OPENSSL_KDF_PREFERRED = hashlib.md5
+        results = []
+
+        def decrypt():
+            for i in range(0, 10):
+                results.append(DecryptInProcess(encrypted, 'test key'))
+
+        threads = [threading.Thread(target=decrypt) for i in range(0, 8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, [self.DATA] * 80)
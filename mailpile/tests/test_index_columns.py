@@ -0,0 +1,159 @@
+import os
+import unittest
+from mock import patch
+
+import mailpile.crypto.blocks
+from mailpile.index_columns import ColumnarIndex, ColumnarIndexList
+from mailpile.index_columns import DigestIndex
+from mailpile.tests import MailPileUnittest
+
+
+class TestColumnarIndex(MailPileUnittest):
+    def test_round_trip(self):
+        idx = self.config.index
+        idx.save(self.session)
+        colfile = self.config.mailindex_columns_file()
+        self.assertTrue(os.path.exists(colfile))
+
+        columns = ColumnarIndex(colfile, source=self.config.mailindex_file())
+        try:
+            self.assertEqual(len(columns), len(idx.INDEX))
+            self.assertEqual(columns.emails(), idx.EMAILS)
+            for pos in range(0, len(idx.INDEX)):
+                self.assertEqual(idx.m2l(columns.get_msg_info(pos)),
+                                 idx.INDEX[pos])
+        finally:
+            columns.close()
+
+    def test_reload(self):
+        idx = self.config.index
+        idx.save(self.session)
+        lines = list(idx.INDEX)
+        tags = dict((t, set(m)) for t, m in idx.TAGS.iteritems())
+        mailboxes = dict((b, set(m)) for b, m in idx.MAILBOX_MSGS.iteritems())
+        threads = list(idx.INDEX_THR)
+        count = len(idx.INDEX)
+        sorting = dict((o, [idx.INDEX_SORT[o][i] for i in range(0, count)])
+                       for o in idx.INDEX_SORT)
+
+        msgids = [(mi[idx.MSG_ID], i) for i, mi in
+                  enumerate(idx.get_msg_at_idx_pos(i)
+                            for i in range(0, len(idx.INDEX)))]
+
+        # Loading the snapshot should not need to decode any rows
+        with patch.object(ColumnarIndex, 'get_msg_info',
+                          side_effect=AssertionError('Decoded a row')):
+            idx.load(self.session)
+        self.assertTrue(isinstance(idx.INDEX, ColumnarIndexList))
+        self.assertEqual(list(idx.INDEX), lines)
+        self.assertEqual(dict((t, set(m)) for t, m in idx.TAGS.iteritems()),
+                         tags)
+        self.assertEqual(dict((b, set(m)) for b, m
+                              in idx.MAILBOX_MSGS.iteritems()), mailboxes)
+        self.assertEqual(idx.INDEX_THR, threads)
+        for order, keys in sorting.iteritems():
+            self.assertEqual([idx.INDEX_SORT[order][i]
+                              for i in range(0, count)], keys)
+        for msgid, pos in msgids:
+            self.assertEqual(idx.MSGIDS[msgid], pos)
+            msg_info = idx.get_msg_at_idx_pos(pos)
+            self.assertEqual(idx._get_msg_ptrs(pos), msg_info[idx.MSG_PTRS])
+            for ptr in msg_info[idx.MSG_PTRS].split(','):
+                self.assertEqual(idx.PTRS[ptr], pos)
+
+    def test_deferred(self):
+        idx = self.config.index
+        msg_info = idx.get_msg_at_idx_pos(0)
+        original = list(msg_info)
+        msg_info[idx.MSG_BODY] = idx.encode_body({'snippet': '',
+                                                  'deferred': True})
+        idx.set_msg_at_idx_pos(0, msg_info)
+        idx.DEFERRED = set([0])
+        try:
+            idx.save(self.session)
+
+            # The deferred set is part of the snapshot, no scan needed
+            with patch.object(idx, '_find_deferred',
+                              side_effect=AssertionError('Scanned')):
+                idx.load(self.session)
+                self.assertEqual(idx.DEFERRED, set([0]))
+
+                # Lines written after the snapshot update it
+                idx.set_msg_at_idx_pos(0, original)
+                idx.save_changes(self.session)
+                idx.load(self.session)
+                self.assertEqual(idx.DEFERRED, set())
+        finally:
+            idx.set_msg_at_idx_pos(0, original)
+            idx.save(self.session)
+            idx.DEFERRED = None
+        self.assertEqual(idx.get_msg_at_idx_pos(0), original)
+
+    @unittest.skipIf(not mailpile.crypto.blocks.AVAILABLE, 'No AES module')
+    def test_encrypted(self):
+        idx = self.config.index
+        idx.save(self.session)
+        source = self.config.mailindex_file()
+        colfile = self.config.mailindex_columns_file() + '.test'
+        ColumnarIndex.Write(colfile, source, os.path.getsize(source),
+                            (idx.get_msg_at_idx_pos(i)
+                             for i in range(0, len(idx.INDEX))),
+                            idx.EMAILS, key='key')
+        try:
+            self.assertTrue(mailpile.crypto.blocks.IsBlockEncrypted(colfile))
+            self.assertRaises(IOError, ColumnarIndex, colfile, source=source)
+            columns = ColumnarIndex(colfile, source=source, key='key')
+            try:
+                self.assertEqual(len(columns), len(idx.INDEX))
+                self.assertEqual(columns.emails(), idx.EMAILS)
+                for pos in range(0, len(idx.INDEX)):
+                    self.assertEqual(idx.m2l(columns.get_msg_info(pos)),
+                                     idx.INDEX[pos])
+            finally:
+                columns.close()
+        finally:
+            os.remove(colfile)
+
+    def test_digest_index(self):
+        di = DigestIndex()
+        di['a'] = 1
+        di[u'b\xe9'] = 2
+        di['a'] = 3
+        self.assertEqual(len(di), 2)
+        self.assertEqual(di['a'], 3)
+        self.assertEqual(di.get(u'b\xe9'), 2)
+        self.assertEqual(di.get('c', 'nope'), 'nope')
+        del di['a']
+        self.assertFalse('a' in di)
+        self.assertEqual(len(di), 1)
+        self.assertRaises(KeyError, di.__delitem__, 'a')
+
+    def test_digest_index_compact(self):
+        di = DigestIndex()
+        di.COMPACT_MIN = 8
+        for i in range(0, 100):
+            di['key-%d' % i] = i
+        for i in range(0, 100, 3):
+            del di['key-%d' % i]
+        self.assertTrue(len(di.overlay) <= 25)
+        di.compact()
+        self.assertEqual(di.overlay, {})
+        self.assertEqual(len(di), 66)
+        self.assertEqual(len(di._sorted[2]), 66)
+        for i in range(0, 100):
+            self.assertEqual(di.get('key-%d' % i),
+                             None if (i % 3 == 0) else i)
+
+    def test_stale(self):
+        idx = self.config.index
+        idx.save(self.session)
+        colfile = self.config.mailindex_columns_file()
+        with open(self.config.mailindex_file(), 'r+') as fd:
+            data = fd.read()
+            fd.seek(0)
+            fd.write(data.replace('mailpile.py', 'MAILPILE.py', 1))
+        try:
+            self.assertRaises(ValueError, ColumnarIndex, colfile,
+                              source=self.config.mailindex_file())
+        finally:
+            idx.save(self.session)
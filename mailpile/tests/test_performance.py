@@ -1,7 +1,13 @@
+import os
+import re
+import time
 import unittest
 from nose.tools import assert_equal, assert_less
 
-from mailpile.tests import get_shared_mailpile, MailPileUnittest
+from mailpile.tests import get_mailpile_root, get_shared_mailpile
+from mailpile.tests import MailPileUnittest
+from mailpile.tokenizer import Tokenize
+from mailpile.util import WORD_REGEXP, STOPLIST
 
 
 def checkSearch(postinglist_kb, query):
@@ -23,3 +29,27 @@ def test_generator():
     for postinglist_kb in postinglist_kbs:
         for search_query in search_queries:
             yield checkSearch(postinglist_kb, [search_query])
+
+
+def test_keyword_extraction():
+    mbx = os.path.join(get_mailpile_root(), 'mailpile', 'tests', 'data',
+                       'tests.mbx')
+    with open(mbx, 'rb') as fd:
+        sample = fd.read().decode('utf-8', 'replace')
+    text = sample * (1 + (1024 * 1024) // len(sample))
+    megabytes = len(text.encode('utf-8')) / (1024.0 * 1024)
+
+    def mb_per_second(tokenize):
+        elapsed = []
+        for i in range(0, 3):
+            t0 = time.time()
+            words = tokenize(text)
+            elapsed.append(time.time() - t0)
+        return words, megabytes / min(elapsed)
+
+    before, before_speed = mb_per_second(
+        lambda t: set(re.findall(WORD_REGEXP, t.lower())) - STOPLIST)
+    after, after_speed = mb_per_second(Tokenize)
+    print ('Keyword extraction: %.1f MB/s before, %.1f MB/s after'
+           % (before_speed, after_speed))
+    assert_equal(after, before)
@@ -0,0 +1,278 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from mock import patch
+
+import mailpile.crypto.blocks
+import mailpile.postinglist
+from mailpile.postinglist import BloomFilter, GlobalPostingList
+from mailpile.postinglist import PostingSegment, PostingSegments
+from mailpile.postinglist import PostingListContainer
+from mailpile.postinglist import PLC_CACHE_FlushAndClean, PLC_CACHE_Stats
+from mailpile.postinglist import PLC_CACHE, PLC_CACHE_LOCK, PLC_EVICTED
+from mailpile.postinglist import _PLC_CACHE_Evicted
+from mailpile.tests import MailPileUnittest
+from mailpile.util import b36
+
+
+class TestPostingSegments(MailPileUnittest):
+    WORDS = ['brennan', 'twitter', 'kde', 'mailpile', 'nosuchword']
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _hits(self):
+        return dict((w, GlobalPostingList(self.session, w).hits())
+                    for w in self.WORDS)
+
+    def test_write_and_get(self):
+        segs = PostingSegments(self.tempdir)
+        segs.flush(self.session, {'abc': set([1, 5, 3]), 'b': set([7])},
+                   {'b': set([2])})
+        self.assertEqual(len(segs), 1)
+        seg = segs.segments[0]
+        self.assertEqual(PostingSegment.Decode(seg.get('abc'))[0].tolist(),
+                         [1, 3, 5])
+        self.assertEqual(seg.get('nope'), None)
+        self.assertEqual(segs.apply('b', set([2, 4])), set([4, 7]))
+
+    def test_tiered_merge(self):
+        segs = PostingSegments(self.tempdir)
+        segs.flush(self.session, {'w': set([0])}, {})
+        segs.flush(self.session, {'x': set([0])}, {})
+        self.assertEqual(segs.merge(self.session, force=True), 1)
+        for i in range(1, PostingSegments.FANOUT):
+            segs.flush(self.session, {'w': set([i])}, {})
+        self.assertEqual(segs.merge(self.session), 0)
+        segs.flush(self.session, {}, {'w': set([0])})
+        self.assertEqual(segs.merge(self.session), 1)
+        self.assertEqual([s.tier for s in segs.segments], [1, 1])
+        self.assertEqual(segs.apply('w', set()), set([1, 2, 3]))
+
+        # Merging into the oldest segment discards the tombstones
+        self.assertEqual(segs.merge(self.session, force=True), 1)
+        self.assertEqual(len(segs), 1)
+        self.assertEqual(PostingSegment.Decode(segs.segments[0].get('w')
+                                               )[1].tolist(), [])
+
+        # Reloading finds the same segments, and nothing else
+        self.assertEqual(len(os.listdir(self.tempdir)), 1)
+        reloaded = PostingSegments(self.tempdir)
+        self.assertEqual(reloaded.apply('w', set()), set([1, 2, 3]))
+
+    @unittest.skipIf(not mailpile.crypto.blocks.AVAILABLE, 'No AES module')
+    def test_encrypted(self):
+        segs = PostingSegments(self.tempdir, key='key', encrypt=True)
+        seg = segs.flush(self.session, {'abc': set([1, 5, 3])}, {})
+        self.assertTrue(mailpile.crypto.blocks.IsBlockEncrypted(seg.filename))
+
+        reloaded = PostingSegments(self.tempdir, key='key')
+        self.assertEqual(reloaded.apply('abc', set()), set([1, 3, 5]))
+
+        # Without the right key, segments are ignored but not deleted
+        self.assertEqual(len(PostingSegments(self.tempdir, key='bad')), 0)
+        self.assertEqual(len(PostingSegments(self.tempdir)), 0)
+        self.assertTrue(os.path.exists(seg.filename))
+
+    def test_optimize(self):
+        before = self._hits()
+        GlobalPostingList.Optimize(self.session, self.config.index,
+                                   force=True)
+        self.assertTrue(len(PostingSegments.Get(self.config)) > 0)
+        self.assertFalse([v for v in mailpile.postinglist.GLOBAL_GPL.values()
+                          if v])
+        self.assertEqual(self._hits(), before)
+
+        gpl = GlobalPostingList(self.session, 'brennan')
+        gpl.remove(list(before['brennan'])[:1])
+        self.assertEqual(set(gpl.hits()), set(list(before['brennan'])[1:]))
+        GlobalPostingList.Append(self.session, 'brennan',
+                                 [b36(i) for i in before['brennan']][:1])
+        self.assertEqual(self._hits(), before)
+
+    def test_segments_disabled(self):
+        GlobalPostingList.Append(self.session, 'zzsegmented', ['zzz4'])
+        before = self._hits()
+        GlobalPostingList.Optimize(self.session, self.config.index,
+                                   force=True)
+        self.assertTrue(len(PostingSegments.Get(self.config)) > 0)
+        enabled = self.config.sys.postinglist_segments
+        self.config.sys.postinglist_segments = False
+        try:
+            with patch.object(PostingSegments, 'Get',
+                              side_effect=AssertionError('Used segments')):
+                GlobalPostingList.Estimate(self.session, 'brennan')
+                GlobalPostingList(self.session, 'brennan').hits()
+
+            # Optimizing moves the postings back into the containers
+            GlobalPostingList.Optimize(self.session, self.config.index,
+                                       force=True)
+            self.assertEqual(len(PostingSegments.Get(self.config)), 0)
+            self.assertEqual(self._hits(), before)
+            self.assertEqual(set(GlobalPostingList(self.session,
+                                                   'zzsegmented').hits()),
+                             set([int('zzz4', 36)]))
+        finally:
+            self.config.sys.postinglist_segments = enabled
+            GlobalPostingList(self.session, 'zzsegmented').remove(['zzz4'])
+
+    def test_buffered_appends(self):
+        journal = GlobalPostingList.SaveFile(self.session, '')
+        size = os.path.exists(journal) and os.path.getsize(journal)
+        words = ['zzbuffered', 'zzbatched']
+        for mid in ('zzz1', 'zzz2'):
+            GlobalPostingList.Buffer(self.session, words, mid)
+        self.assertEqual(os.path.exists(journal) and
+                         os.path.getsize(journal), size)
+
+        # Reads flush the buffer, writing both words at once
+        gpl = GlobalPostingList(self.session, 'zzbuffered')
+        self.assertEqual(set(gpl.hits()), set([int('zzz1', 36),
+                                               int('zzz2', 36)]))
+        with open(journal, 'rb') as fd:
+            fd.seek(size)
+            self.assertEqual(len(fd.read().splitlines()), 2)
+        for word in words:
+            GlobalPostingList(self.session, word).remove(['zzz1', 'zzz2'])
+        self.assertFalse(gpl.hits())
+
+    def test_flushed_after_indexing(self):
+        GlobalPostingList.Buffer(self.session, ['zzflushed'], 'zzz3')
+        self.assertTrue(mailpile.postinglist.GLOBAL_PENDING)
+        self.config.index.index_deferred(self.session)
+        self.assertFalse(mailpile.postinglist.GLOBAL_PENDING)
+        GlobalPostingList(self.session, 'zzflushed').remove(['zzz3'])
+
+
+class TestPostingListCache(MailPileUnittest):
+    def test_writeback(self):
+        sig = 'zzcachetest'
+        plc = PostingListContainer.Load(self.session, sig)
+        plc.add(sig, [12345])
+        self.assertTrue(plc.estimated_size() > 8)
+
+        loads = PLC_CACHE_Stats()['loads']
+        PLC_CACHE_FlushAndClean(self.session, keep=0)
+        self.assertEqual(PLC_CACHE_Stats()['items'], 0)
+        self.assertEqual(plc.changes, 0)
+
+        plc = PostingListContainer.Load(self.session, sig)
+        self.assertEqual(PLC_CACHE_Stats()['loads'], loads + 1)
+        self.assertEqual(list(plc.get(sig)), [12345])
+
+        plc.remove(sig, [12345])
+        PLC_CACHE_FlushAndClean(self.session, keep=0)
+
+    def test_queued_writeback(self):
+        class QueueWorker(object):
+            def __init__(self):
+                self.tasks = []
+
+            def add_unique_task(self, session, name, task):
+                self.tasks.append(task)
+
+        sig = 'zzqueuetest'
+        plc = PostingListContainer.Load(self.session, sig)
+        plc.add(sig, [23456])
+        scan_worker = self.config.scan_worker
+        self.config.scan_worker = worker = QueueWorker()
+        try:
+            with PLC_CACHE_LOCK:
+                del PLC_CACHE[plc.sig]
+            _PLC_CACHE_Evicted(plc.sig, plc)
+        finally:
+            self.config.scan_worker = scan_worker
+        self.assertEqual(len(worker.tasks), 1)
+        self.assertTrue(plc.changes > 0)
+
+        # Until the writeback is done, loading returns the same object
+        self.assertTrue(PostingListContainer.Load(self.session, sig) is plc)
+        worker.tasks[0]()
+        self.assertEqual(plc.changes, 0)
+        self.assertFalse(plc.sig in PLC_EVICTED)
+
+        plc.remove(sig, [23456])
+        PLC_CACHE_FlushAndClean(self.session, keep=0)
+
+    def test_status(self):
+        res = self.mp.ps()
+        self.assertTrue('hit_rate' in res.as_dict()['result']['pl_cache'])
+        self.assertTrue('Postinglist cache:' in res.as_text())
+
+    def test_bloom_filters(self):
+        sig = 'zzbloomtest'
+        plc = PostingListContainer.Load(self.session, sig)
+        plc.add(sig, [54321])
+        PLC_CACHE_FlushAndClean(self.session, keep=0)
+        try:
+            fn, csig = PostingListContainer._GetFilenameAndSig(self.config,
+                                                               sig)
+            self.assertTrue(os.path.exists(fn + '.bf'))
+
+            loads = PLC_CACHE_Stats()['loads']
+            self.assertFalse(PostingListContainer.MightContain(
+                self.session, sig + 'nope'))
+            self.assertFalse(PostingListContainer.MightContain(
+                self.session, 'q' + sig))
+            self.assertEqual(PLC_CACHE_Stats()['loads'], loads)
+            self.assertTrue(PostingListContainer.MightContain(
+                self.session, sig))
+        finally:
+            plc = PostingListContainer.Load(self.session, sig)
+            plc.remove(sig, [54321])
+            PLC_CACHE_FlushAndClean(self.session, keep=0)
+
+    def test_listing_changes(self):
+        sig = 'zzlistingtest'
+        fn, csig = PostingListContainer._GetFilenameAndSig(self.config, sig)
+        self.assertFalse(PostingListContainer.MightContain(self.session,
+                                                           sig))
+
+        # Another process writes a container we have not seen
+        newfn = PostingListContainer._SaveFile(self.config, sig)
+        with open(newfn, 'wb') as fd:
+            fd.write('%s\t%s\n' % (sig, b36(54321)))
+        dn = os.path.dirname(newfn)
+        os.utime(dn, (time.time() + 10, time.time() + 10))
+        try:
+            self.assertTrue(PostingListContainer.MightContain(self.session,
+                                                              sig))
+        finally:
+            os.remove(newfn)
+
+    @unittest.skipIf(not mailpile.crypto.blocks.AVAILABLE, 'No AES module')
+    def test_encrypted_bloom_filters(self):
+        sig = 'zzbloomcrypt'
+        prefs = self.config.prefs
+        encrypt_index, master_key = prefs.encrypt_index, self.config.master_key
+        prefs.encrypt_index = True
+        self.config.master_key = master_key or 'test key'
+        try:
+            plc = PostingListContainer.Load(self.session, sig)
+            plc.add(sig, [54321])
+            PLC_CACHE_FlushAndClean(self.session, keep=0)
+            fn, csig = PostingListContainer._GetFilenameAndSig(self.config,
+                                                               sig)
+            self.assertTrue(mailpile.crypto.blocks.IsBlockEncrypted(
+                fn + '.bf'))
+            with open(fn + '.bf', 'rb') as fd:
+                self.assertFalse(fd.read().startswith(BloomFilter.MAGIC))
+
+            # Forget the filters we have in memory, and read them back
+            mailpile.postinglist.PLC_LISTINGS.clear()
+            self.assertFalse(PostingListContainer.MightContain(
+                self.session, sig + 'nope'))
+            self.assertTrue(PostingListContainer.MightContain(
+                self.session, sig))
+        finally:
+            plc = PostingListContainer.Load(self.session, sig)
+            plc.remove(sig, [54321])
+            PLC_CACHE_FlushAndClean(self.session, keep=0)
+            prefs.encrypt_index = encrypt_index
+            self.config.master_key = master_key
+            mailpile.postinglist.PLC_LISTINGS.clear()
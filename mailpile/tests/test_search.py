@@ -1,7 +1,7 @@
 import unittest
 from nose.tools import assert_equal, assert_less
 
-from mailpile.tests import get_shared_mailpile
+from mailpile.tests import get_shared_mailpile, MailPileUnittest
 
 
 def checkSearch(query, expected_count=1):
@@ -48,3 +48,418 @@ def test_generator():
 
     # Test that we do not crash when searching for a non-existant tag.
     yield checkSearch(['in:doesnotexist'], 0)
+
+
+class TestIndexSave(MailPileUnittest):
+    def test_chunked_save(self):
+        idx = self.config.index
+        lines = list(idx.INDEX)
+        emails = list(idx.EMAILS)
+        marks = []
+        mark, self.session.ui.mark = self.session.ui.mark, marks.append
+        try:
+            idx.SAVE_CHUNK_BYTES = 1024
+            idx.save(self.session)
+        finally:
+            del idx.SAVE_CHUNK_BYTES
+            self.session.ui.mark = mark
+        self.assertTrue(len(marks) > 3)
+
+        idx.load(self.session)
+        self.assertEqual(list(idx.INDEX), lines)
+        self.assertEqual(idx.EMAILS, emails)
+
+
+class TestParallelLoad(MailPileUnittest):
+    def _loaded(self, idx):
+        ptrs = []
+        for pos in range(0, len(idx.INDEX)):
+            msg_info = idx.get_msg_at_idx_pos(pos)
+            ptrs.append((idx.MSGIDS.get(msg_info[idx.MSG_ID]),
+                         [idx.PTRS.get(p)
+                          for p in msg_info[idx.MSG_PTRS].split(',')]))
+        return list(idx.INDEX), list(idx.EMAILS), ptrs
+
+    def test_threaded_load(self):
+        import os
+        import shutil
+        import tempfile
+        from mock import patch
+        import mailpile.crypto.streamer
+        import mailpile.util
+        from mailpile.crypto.streamer import EncryptingStreamer
+
+        idx = self.config.index
+        idx.save(self.session)
+        expected = self._loaded(idx)
+        index_threads = self.config.sys.index_threads
+        idxfile = self.config.mailindex_file()
+        with open(idxfile, 'rb') as fd:
+            plaintext = fd.read()
+        lines = plaintext.splitlines(True)
+
+        # Rewrite the index as a series of Mailpile encrypted blocks
+        key = self.config.master_key or 'missing'
+        tempdir = tempfile.mkdtemp()
+        try:
+            with open(idxfile, 'wb') as fd:
+                for i in range(0, len(lines), 10):
+                    fn = os.path.join(tempdir, 'block-%d' % i)
+                    with EncryptingStreamer(key, dir=tempdir,
+                                            delimited=True) as es:
+                        es.write(''.join(lines[i:i + 10]))
+                        es.save(fn)
+                    with open(fn, 'rb') as block:
+                        fd.write(block.read())
+
+            with patch.object(idx, '_load_columns', return_value=0):
+                self.config.sys.index_threads = 1
+                idx.load(self.session)
+                serial = self._loaded(idx)
+
+                # Force the blocks out to coprocesses, in parallel
+                decrypt = patch.object(mailpile.util, '_decrypt_lines',
+                                       wraps=mailpile.util._decrypt_lines)
+                with patch.object(mailpile.crypto.streamer,
+                                  'DecryptInProcess', return_value=None):
+                    with decrypt as decrypt_mock:
+                        self.config.sys.index_threads = 4
+                        idx.load(self.session)
+                        threaded = self._loaded(idx)
+
+            self.assertTrue(decrypt_mock.call_count > 1)
+            for args, kwargs in decrypt_mock.call_args_list:
+                self.assertEqual(kwargs.get('in_process'), False)
+            self.assertEqual(serial, expected)
+            self.assertEqual(threaded, serial)
+        finally:
+            self.config.sys.index_threads = index_threads
+            shutil.rmtree(tempdir)
+            with open(idxfile, 'wb') as fd:
+                fd.write(plaintext)
+            idx.load(self.session)
+
+
+class TestMailboxPtrs(MailPileUnittest):
+    def test_mailbox_ptrs(self):
+        from mailpile.bitmap import Bitmap
+        from mailpile.mailutils import MBX_ID_LEN
+        idx = self.config.index
+        expected = {}
+        for msg_idx in range(0, len(idx.INDEX)):
+            msg_info = idx.get_msg_at_idx_pos(msg_idx)
+            for ptr in msg_info[idx.MSG_PTRS].split(','):
+                expected.setdefault(ptr[:MBX_ID_LEN], set()).add(ptr)
+        self.assertTrue(expected)
+        for mbx_id, ptrs in expected.iteritems():
+            self.assertTrue(isinstance(idx.MAILBOX_MSGS[mbx_id], Bitmap))
+            self.assertEqual(set(idx._mailbox_ptrs(mbx_id)), ptrs)
+
+
+class TestTagStats(MailPileUnittest):
+    def _counted(self, tids, exclude_hidden=False):
+        idx = self.config.index
+        messages, unread, hides = set(), set(), set()
+        for tid in tids:
+            messages |= set(idx.TAGS.get(tid, []))
+        for tag in self.config.get_tags(type='unread'):
+            unread |= set(idx.TAGS.get(tag._key, []))
+        for tag in self.config.get_tags(flag_hides=True):
+            hides |= set(idx.TAGS.get(tag._key, []))
+        if exclude_hidden:
+            messages -= hides
+        return (len(messages), len(messages & unread))
+
+    def test_incremental_counts(self):
+        idx = self.config.index
+        new = self.config.get_tags(type='unread')[0]._key
+        tids = list(idx.TAGS.keys())
+        for tid in tids:
+            idx.get_tag_stats([tid])
+        self.assertTrue(idx.TAG_COUNTS is not None)
+
+        msg_idxs = list(idx.TAGS[tids[0]])[:2] + [0]
+        idx.add_tag(self.session, new, msg_idxs=msg_idxs)
+        try:
+            for tid in tids:
+                for exclude_hidden in (True, False):
+                    self.assertEqual(idx.get_tag_stats([tid], exclude_hidden),
+                                     self._counted([tid], exclude_hidden))
+            self.assertEqual(idx.get_tag_stats(tids), self._counted(tids))
+        finally:
+            idx.remove_tag(self.session, new, msg_idxs=msg_idxs)
+        for tid in tids:
+            self.assertEqual(idx.get_tag_stats([tid]), self._counted([tid]))
+
+
+class TestQueryPlanner(MailPileUnittest):
+    def _search(self, *terms):
+        from mailpile.search import CachedSearchResultSet
+        CachedSearchResultSet.DropCaches()
+        return self.config.index.search(self.session, list(terms)).as_set()
+
+    def test_planned_matches_sequential(self):
+        everything = self._search('all:mail')
+        for a, b in (('brennan', 'twitter'),
+                     ('dates:2000..2030', 'twitter'),
+                     ('in:inbox', 'brennan'),
+                     ('nosuchword', 'brennan')):
+            both = self._search(a, b)
+            self.assertEqual(both, self._search(a) & self._search(b))
+            self.assertEqual(self._search(b, a), both)
+            self.assertEqual(self._search(a, '-' + b),
+                             self._search(a) - self._search(b))
+            self.assertEqual(self._search('-' + a),
+                             everything - self._search(a))
+
+    def test_term_bitmaps(self):
+        from mailpile.bitmap import Bitmap
+        from mailpile.postinglist import GlobalPostingList
+        idx = self.config.index
+
+        def hits(term):
+            return GlobalPostingList(self.session, term).hits()
+
+        for term in ('brennan', 'nosuchword', 'dates:2013', 'body:brennan',
+                     'from:twitter'):
+            rt = idx._search_term(self.session, term, hits)
+            self.assertTrue(isinstance(rt, Bitmap))
+            self.assertEqual(set(rt), self._search(term))
+        self.assertEqual(self._search('in:inbox', '-in:spam'),
+                         self._search('in:inbox') - self._search('in:spam'))
+
+    def test_search_filters(self):
+        idx = self.config.index
+        filtered = self._search('all:mail', 'dates:2014')
+        idx.SEARCH_FILTER_MAX = 0
+        try:
+            self.assertEqual(self._search('all:mail', 'dates:2014'),
+                             filtered)
+        finally:
+            del idx.SEARCH_FILTER_MAX
+
+    def test_plan_estimates(self):
+        idx = self.config.index
+        self.assertEqual(idx._plan_term(self.session, 'nosuchword'),
+                         (idx.PLAN_KEYWORD, 0))
+        self.assertEqual(idx._plan_term(self.session, 'all:mail'),
+                         (idx.PLAN_EXACT, len(idx.INDEX)))
+        self.assertEqual(idx._plan_term(self.session, 'dates:2013')[0],
+                         idx.PLAN_COMPLEX)
+
+
+class TestLazyParsing(MailPileUnittest):
+    def test_matches_full_parse(self):
+        from cStringIO import StringIO
+        from mailpile.mailutils import Email, ParseMessage
+        idx = self.config.index
+        for msg_idx in range(0, len(idx.INDEX)):
+            with Email(idx, msg_idx).get_file() as fd:
+                msg_data = fd.read()
+            results = []
+            for lazy in (False, True):
+                msg_fd = StringIO(msg_data)
+                msg = ParseMessage(msg_fd, config=self.config, lazy=lazy)
+                self.assertEqual(msg_fd.tell(), len(msg_data))
+                msg_id = idx.get_msg_id(msg, '')
+                results.append(idx.read_message(
+                    self.session, '', msg_id, msg, len(msg_data), 0))
+            self.assertEqual(results[0], results[1])
+
+
+class TestParallelParsing(MailPileUnittest):
+    def _jobs(self):
+        from mailpile.mailutils import Email, MBX_ID_LEN
+        idx = self.config.index
+        jobs = []
+        for msg_idx in range(0, len(idx.INDEX)):
+            msg_info = idx.get_msg_at_idx_pos(msg_idx)
+            msg_ptr = msg_info[idx.MSG_PTRS].split(',')[0]
+            with Email(idx, msg_idx).get_file() as fd:
+                jobs.append((msg_ptr[:MBX_ID_LEN], msg_ptr, fd.read()))
+        return jobs
+
+    def test_matches_serial(self):
+        from cStringIO import StringIO
+        from mailpile.mailutils import ParseMessage
+        idx = self.config.index
+        skipped = 0
+        for mailbox_idx, msg_ptr, msg_data in self._jobs():
+            parsed = idx.parse_for_index(self.session,
+                                         mailbox_idx, msg_ptr, msg_data)
+            if parsed is None:
+                skipped += 1
+                continue
+            msg = ParseMessage(StringIO(msg_data), config=self.config)
+            msg_id = idx.get_msg_id(msg, msg_ptr)
+            msg_ts = idx._extract_date_ts(self.session, '', msg_id, msg, 0)
+            self.assertEqual(parsed, (msg_ts, ) + idx.read_message(
+                self.session, '', msg_id, msg, len(msg_data), msg_ts,
+                mailbox=mailbox_idx))
+
+        # Encrypted and signed messages are left for the main process
+        self.assertTrue(0 < skipped < len(idx.INDEX))
+
+    def test_pool(self):
+        idx = self.config.index
+        jobs = self._jobs()
+        self.config.sys.index_processes = 2
+        pool = idx._parse_pool(self.session)
+        try:
+            self.assertEqual(idx._parse_in_pool(self.session, pool, jobs),
+                             [idx.parse_for_index(self.session, *job)
+                              for job in jobs])
+            self.assertTrue(idx._parse_pool(self.session) is pool)
+        finally:
+            self.config.sys.index_processes = 0
+            self.assertEqual(idx._parse_pool(self.session), None)
+
+
+class TestSortColumns(MailPileUnittest):
+    def test_undecoded_lines(self):
+        idx = self.config.index
+        msg_info = list(idx.get_msg_at_idx_pos(0))
+        msg_info[idx.MSG_FROM] = u'\xc9mile Zola <zola@example.zz>'
+        msg_info[idx.MSG_SUBJECT] = u'Re: \xc9t\xe9'
+        raw = [field.encode('utf-8') for field in msg_info]
+
+        # Lines replayed at load time get the same keys as decoded rows
+        for order in idx.SORT_COLUMNS:
+            sorter = idx.SORT_ORDERS[order]
+            self.assertEqual(sorter(idx, raw), sorter(idx, msg_info))
+            column = idx.SORT_COLUMNS[order](1)
+            column[0] = sorter(idx, raw)
+            self.assertEqual(len(column.sorted_keys), 2)
+
+
+class TestHeadersFirst(MailPileUnittest):
+    def test_deferred_indexing(self):
+        from mailpile.mailutils import Email
+        from mailpile.util import STOPLIST
+        idx = self.config.index
+        msg_idx = 0
+        msg_info = idx.get_msg_at_idx_pos(msg_idx)
+        original = list(msg_info)
+        email = Email(idx, msg_idx)
+        args = (self.session, msg_info[idx.MSG_MID], msg_info[idx.MSG_ID])
+        msg_size = email.get_msg_size()
+        msg_ts = long(msg_info[idx.MSG_DATE], 36)
+
+        with email.get_file() as fd:
+            msg = idx._parse_headers(fd)
+            self.assertEqual(fd.tell(), msg_size)
+        headers = set(idx.read_headers(*(args + (msg, msg_size, msg_ts))))
+        keywords = idx.read_message(*(args + (email.get_msg(), msg_size,
+                                              msg_ts)))[0]
+        self.assertTrue(headers - STOPLIST < keywords)
+
+        # Messages marked as deferred get found and fully indexed
+        msg_info[idx.MSG_BODY] = idx.encode_body({'snippet': '',
+                                                  'deferred': True})
+        idx.set_msg_at_idx_pos(msg_idx, msg_info)
+        idx.DEFERRED = None
+        self.assertEqual(idx.index_deferred(self.session), 0)
+        self.assertEqual(idx.get_msg_at_idx_pos(msg_idx), original)
+
+    MBOX = ''.join(
+        'From zz@example.zz Fri Jan  1 00:00:0%d 1999\n'
+        'From: Zz Headfirst <zz@example.zz>\n'
+        'To: yy@example.zz\n'
+        'Subject: zzheadline %d\n'
+        'Message-ID: <zzheadersfirst%d@example.zz>\n'
+        'Date: Fri, 1 Jan 1999 00:00:0%d +0000\n'
+        '\n'
+        'The zzbodyword only appears down here.\n'
+        '\n' % (i, i, i, i) for i in range(0, 3))
+
+    def test_headers_only_scan(self):
+        import os
+        import shutil
+        import tempfile
+        from mock import patch
+        from mailpile.mailboxes.mbox import MailpileMailbox
+        from mailpile.mailutils import ClearParseCache
+        from mailpile.postinglist import GlobalPostingList
+        from mailpile.search import MailIndex
+
+        # A scratch index keeps the shared one (and its counts) unchanged
+        idx = MailIndex(self.config)
+        idx.DEFERRED = set()
+        tempdir = tempfile.mkdtemp()
+        mbox_fn = os.path.join(tempdir, 'headers-first.mbx')
+        with open(mbox_fn, 'wb') as fd:
+            fd.write(self.MBOX)
+
+        def hits(word):
+            return set(GlobalPostingList(self.session, word).hits())
+
+        open_mailbox = self.config.open_mailbox
+
+        def scratch_mailbox(session, mbx_id, *args, **kwargs):
+            if mbx_id == 'fff0':
+                return MailpileMailbox(mbox_fn)
+            return open_mailbox(session, mbx_id, *args, **kwargs)
+
+        # A filter which would match on the headers alone
+        unread = [tag._key for tag in self.config.get_tags(type='unread')]
+        filtered = patch.object(self.config, 'get_filters', return_value=[
+            ('zz', 'zzheadline', ' '.join('-%s' % tid for tid in unread),
+             'Read zzheadline', 'incoming')])
+        filtered.start()
+        buffered = patch.object(GlobalPostingList, 'Buffer',
+                                wraps=GlobalPostingList.Buffer)
+        buffer_mock = buffered.start()
+        opener = patch.object(self.config, 'open_mailbox',
+                              side_effect=scratch_mailbox)
+        opener.start()
+        try:
+            self.assertEqual(idx.scan_mailbox(
+                self.session, 'fff0', mbox_fn,
+                lambda session, mbx_id: MailpileMailbox(mbox_fn),
+                headers_only=True), 3)
+            msg_idxs = set(range(0, len(idx.INDEX)))
+            self.assertEqual(len(msg_idxs), 3)
+
+            # Only the headers were indexed, the bodies are deferred
+            self.assertEqual(idx.DEFERRED, msg_idxs)
+            self.assertEqual(idx._find_deferred(), msg_idxs)
+            for msg_idx in msg_idxs:
+                msg_info = idx.get_msg_at_idx_pos(msg_idx)
+                self.assertTrue(idx.get_body(msg_info).get('deferred'))
+            self.assertTrue(msg_idxs <= hits('zzheadline'))
+            self.assertFalse(msg_idxs & hits('zzbodyword'))
+
+            # The filters wait for the deferred pass
+            self.assertTrue(unread)
+            for tag_id in unread:
+                self.assertEqual(set(idx.TAGS.get(tag_id, [])), msg_idxs)
+
+            # Pretend the user has archived the new mail
+            auto_tags = set()
+            for tag in self.config.get_tags(type='inbox'):
+                if msg_idxs & set(idx.TAGS.get(tag._key, [])):
+                    auto_tags.add(tag._key)
+                idx.remove_tag(self.session, tag._key, msg_idxs=msg_idxs)
+            self.assertTrue(auto_tags)
+
+            # The later pass indexes the bodies, without retagging; the
+            # parse cache is keyed by position, so drop the shared index's.
+            ClearParseCache(full=True)
+            self.assertEqual(idx.index_deferred(self.session), 0)
+            self.assertEqual(idx.DEFERRED, set())
+            self.assertEqual(idx._find_deferred(), set())
+            self.assertTrue(msg_idxs <= hits('zzbodyword'))
+            self.assertTrue(msg_idxs <= hits('zzheadline'))
+            for tag_id in auto_tags | set(unread):
+                self.assertFalse(msg_idxs & set(idx.TAGS.get(tag_id, [])))
+        finally:
+            ClearParseCache(full=True)
+            opener.stop()
+            buffered.stop()
+            filtered.stop()
+            shutil.rmtree(tempdir)
+            # The scratch index used the shared posting lists, clean up
+            for args, kwargs in buffer_mock.call_args_list:
+                session, words, mid = args
+                for word in words:
+                    GlobalPostingList(self.session, word).remove([mid])
@@ -16,6 +16,7 @@ import tempfile
 import threading
 import time
 import StringIO
+from collections import OrderedDict
 from distutils import spawn
 
 from mailpile.i18n import gettext as _
@@ -189,6 +190,110 @@ class MultiContext:
             raise raised[0]
 
 
+class LRUCache(object):
+    """
+    A thread-safe least-recently-used cache, bounded by number of items
+    and (optionally) by an estimate of the total size of the values.
+
+    Values are sized when they are stored; storing a value again updates
+    its size. If on_evict is given, it is called with each evicted key
+    and value, after the cache's lock has been released.
+
+    >>> evicted = []
+    >>> c = LRUCache(max_items=2, on_evict=lambda k, v: evicted.append(k))
+    >>> c[1] = 'one'; c[2] = 'two'
+    >>> c.get(1)
+    'one'
+    >>> c[3] = 'three'
+    >>> (c.get(2), c.get(1), c.get(3), evicted)
+    (None, 'one', 'three', [2])
+    >>> s = c.stats()
+    >>> (s['items'], s['hits'], s['misses'], s['evictions'])
+    (2, 3, 1, 1)
+    >>> [k for k, v in c.items()]
+    [1, 3]
+    """
+    def __init__(self, max_items=1000, max_bytes=0, sizer=len,
+                 on_evict=None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.sizer = sizer
+        self.on_evict = on_evict
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+        self._bytes = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return (key in self._data)
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value, size = self._data.pop(key)
+                self._data[key] = (value, size)
+                self.hits += 1
+                return value
+            except KeyError:
+                self.misses += 1
+                return default
+
+    def peek(self, key, default=None):
+        """Look up a value without counting it as a use."""
+        with self.lock:
+            found = self._data.get(key)
+            return found[0] if (found is not None) else default
+
+    def __setitem__(self, key, value):
+        evicted = []
+        size = self.sizer(value)
+        with self.lock:
+            if key in self._data:
+                self._bytes -= self._data.pop(key)[1]
+            self._data[key] = (value, size)
+            self._bytes += size
+            while len(self._data) > 1 and (
+                    (self.max_items and len(self._data) > self.max_items) or
+                    (self.max_bytes and self._bytes > self.max_bytes)):
+                k, (v, sz) = self._data.popitem(last=False)
+                self._bytes -= sz
+                self.evictions += 1
+                evicted.append((k, v))
+        if self.on_evict is not None:
+            for k, v in evicted:
+                self.on_evict(k, v)
+
+    def __delitem__(self, key):
+        with self.lock:
+            self._bytes -= self._data.pop(key)[1]
+
+    def items(self):
+        """Return a list of (key, value) pairs, least recently used first."""
+        with self.lock:
+            return [(k, v) for k, (v, sz) in self._data.iteritems()]
+
+    def clear(self):
+        with self.lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'items': len(self._data),
+            'bytes': self._bytes,
+            'max_items': self.max_items,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': (float(self.hits) / lookups) if lookups else 0.0
+        }
+
+
 def FixupForWith(obj):
     if not hasattr(obj, '__enter__'):
         obj.__enter__ = lambda: obj
@@ -445,10 +550,80 @@ def friendly_number(number, base=1000, decimals=0, suffix='',
     return fmt % (number, powers[count], suffix)
 
 
+def _decrypt_in_process(lines, config):
+    import mailpile.crypto.streamer as cstrm
+    symmetric_key = config and config.master_key or 'missing'
+    plaintext = cstrm.DecryptInProcess(''.join(lines), symmetric_key)
+    return plaintext.splitlines(True) if (plaintext is not None) else None
+
+
+def _decrypt_lines(lines, config, _raise, in_process=True):
+    import mailpile.crypto.streamer as cstrm
+    symmetric_key = config and config.master_key or 'missing'
+
+    # Try to avoid the fork/exec overhead of the openssl coprocess
+    if in_process:
+        plaintext = _decrypt_in_process(lines, config)
+        if plaintext is not None:
+            return plaintext
+    plaintext = cstrm.DecryptWithWorkers(''.join(lines), symmetric_key)
+    if plaintext is not None:
+        return plaintext.splitlines(True)
+
+    with cstrm.PartialDecryptingStreamer(
+            lines[:1], iter(lines[1:]),
+            name='decrypt_and_parse',
+            mep_key=symmetric_key,
+            gpg_pass=(config.gnupg_passphrase.get_reader()
+                      if config else None)) as pdsfd:
+        data = pdsfd.readlines()
+        pdsfd.verify(_raise=_raise)
+    return data
+
+
+def _encrypted_chunks(fd, max_plain_lines=1000):
+    """
+    Split a file into runs of plain-text lines and individual encrypted
+    blocks, yielding (encrypted, lines) tuples.
+    """
+    import mailpile.crypto.streamer as cstrm
+    chunk, encrypted = [], False
+    for line in fd:
+        if encrypted:
+            chunk.append(line)
+            if cstrm.PartialDecryptingStreamer.EndEncrypted(line):
+                yield True, chunk
+                chunk, encrypted = [], False
+        elif cstrm.PartialDecryptingStreamer.StartEncrypted(line):
+            if chunk:
+                yield False, chunk
+            chunk, encrypted = [line], True
+        else:
+            chunk.append(line)
+            if len(chunk) >= max_plain_lines:
+                yield False, chunk
+                chunk = []
+    if chunk:
+        yield encrypted, chunk
+
+
 def decrypt_and_parse_lines(fd, parser, config,
                             newlines=False, decode='utf-8',
-                            _raise=IOError):
+                            _raise=IOError, threads=1):
+    """
+    Parse the lines of a file, decrypting any encrypted blocks on the way.
+
+    If an AES module is available, Mailpile's own encrypted blocks are
+    decrypted in-process (see DecryptInProcess), otherwise by the crypto
+    worker pool if that is running.
+
+    If threads > 1, up to that many of the blocks which have to go to the
+    openssl or GnuPG coprocesses will be decrypted in parallel; in-process
+    decryption holds the GIL, so threads would not speed that up. The
+    parser is always called from this thread, with the lines in file order.
+    """
     import mailpile.crypto.streamer as cstrm
+    import mailpile.crypto.workers
     symmetric_key = config and config.master_key or 'missing'
 
     if not newlines:
@@ -462,6 +637,60 @@ def decrypt_and_parse_lines(fd, parser, config,
     else:
         _parser = parser
 
+    if threads > 1:
+        class DecryptJob(threading.Thread):
+            def __init__(self, lines):
+                threading.Thread.__init__(self, name='decrypt_and_parse')
+                self.daemon = True
+                self.lines = lines
+                self.result = self.error = None
+
+            def run(self):
+                try:
+                    self.result = _decrypt_lines(self.lines, config, _raise,
+                                                 in_process=False)
+                except Exception, e:
+                    self.error = e
+                self.lines = None
+
+        def finish(job):
+            if isinstance(job, list):
+                _parser(job)
+            else:
+                job.join()
+                if job.error is not None:
+                    raise job.error
+                _parser(job.result)
+
+        pending, running = [], 0
+        for encrypted, lines in _encrypted_chunks(fd):
+            job = lines
+            if encrypted:
+                job = _decrypt_in_process(lines, config)
+                if job is None:
+                    job = DecryptJob(lines)
+                    job.start()
+                    running += 1
+            pending.append(job)
+            while pending and (running >= threads or
+                               len(pending) > threads or
+                               isinstance(pending[0], list)):
+                job = pending.pop(0)
+                finish(job)
+                if not isinstance(job, list):
+                    running -= 1
+        for job in pending:
+            finish(job)
+        return
+
+    if (cstrm.AES is not None or
+            mailpile.crypto.workers.CRYPTO_WORKERS is not None):
+        for encrypted, lines in _encrypted_chunks(fd):
+            if encrypted:
+                lines = _decrypt_lines(lines, config, _raise)
+            _parser(lines)
+        return
+
     for line in fd:
         if cstrm.PartialDecryptingStreamer.StartEncrypted(line):
             with cstrm.PartialDecryptingStreamer(